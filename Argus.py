@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Argus Panoptes
+
+The hundred-eyed giant of Greek myth, who never had all of his eyes
+closed at once and so could keep watch over everything.
+
+Printzini and Clausius in one process, sharing a single poller; each
+printer is asked once per cycle and what it said goes to the monitor,
+the LEDs and the database collector.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+from ligmos import utils
+
+from ultimonitor import confparser, monitoring, apitools, printer
+from ultimonitor import poller, sinks, metrics
+from ultimonitor.notifier import notificationWorker
+
+
+def main(conffile):
+    """
+    """
+    cDict = confparser.parseConf(conffile)
+
+    # Start logging to a file
+    utils.logs.setup_logging(logName="./logs/argus.log", nLogs=10)
+
+    # Material profiles we've already looked up and parsed before
+    printer.loadMaterialCache("./config/materials.json")
+
+    # Set up our signal
+    runner = utils.common.HowtoStopNicely()
+
+    # What the printer's state codes mean, and what color goes with each
+    flowStateMap, statusColors = monitoring.stateMaps()
+
+    # The database (and maybe the archive), all written in the background
+    outputs, lwriter = sinks.makeOutputs(cDict,
+                                         spoolfile="./spool/argus.spool")
+
+    # Metrics, if asked for; they only go to the database, since the
+    #   archive is for the printer data
+    dbOutputs = [o for o in outputs if isinstance(o, sinks.influxSink)]
+    mserver, mreporter = metrics.startMetrics(cDict['metrics'],
+                                              outputs=dbOutputs,
+                                              tags={"program": "argus"})
+
+    notifier = notificationWorker()
+    notifier.start()
+
+    subscribers = [poller.monitorSubscriber(cDict, flowStateMap,
+                                            statusColors, notifier,
+                                            loopInterval=30),
+                   poller.ledSubscriber(flowStateMap, statusColors),
+                   poller.collectorSubscriber(outputs, loopInterval=30)]
+    for sub in subscribers:
+        sub.start()
+
+    print("Watching %d printer(s)" % (len(cDict['printers'])))
+    shared = poller.sharedPoller(cDict['printers'], subscribers,
+                                 loopInterval=30)
+    shared.run(runner)
+
+    # We were asked to stop nicely, so let everyone finish up
+    for sub in subscribers:
+        sub.stop()
+    notifier.stop()
+    metrics.stopMetrics(mserver, mreporter)
+    sinks.closeOutputs(outputs, lwriter)
+
+    # Show how much the pooled keep-alive connections actually saved us
+    print("Printer connection stats: %s" % (apitools.sessionStats()))
+    apitools.closeSessions()
+
+    print("Argus has exited!")
+
+
+if __name__ == "__main__":
+    conffile = './config/ultimonitor.conf'
+    main(conffile)
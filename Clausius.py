@@ -19,63 +19,151 @@ of heat a truer and sounder basis.
 from __future__ import division, print_function, absolute_import
 
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import ligmos.utils as utils
-from ligmos.workers import connSetup
 
-from ultimonitor import confparser, printer
+from ultimonitor import confparser, printer, apitools, classes, sinks
+from ultimonitor import metrics, profiling
 
 
-def startCollections(printerip, runner, db=None, loopInterval=30):
+def collectOnce(printerip, flowTracker, tags=None):
     """
+    One collection cycle for a single printer. Returns the temperature
+    and system packets, which are empty if the printer didn't answer.
     """
+    tempPkts = []
+    sysPkts = []
+    cycleStart = time.monotonic()
+
+    # Do a check of everything we care about
+    stats = printer.statusCheck(printerip)
+
+    # Did our status check work?
+    if stats != {}:
+        # Collect the temperatures. nsamps is only used the first time;
+        #   after that the tracker sizes the query from the time since
+        #   the last fetch and we only get back samples that are new
+        #   They come back as columns (a classes.flowBlock) since the
+        #   sinks can write them out as-is, no packets needed
+        tempPkts = printer.tempFlow(printerip, nsamps=450,
+                                    tracker=flowTracker, tags=tags,
+                                    asBlock=True)
+
+        # Collect the overall system info
+        sysPkts = printer.systemStats(printerip, tags=tags)
+    else:
+        metrics.errors.inc(kind="unreachable")
+
+    metrics.cycleDuration.observe(time.monotonic() - cycleStart,
+                                  loop="collector")
+
+    return tempPkts, sysPkts
+
+
+def napTime(runner, loopInterval):
+    """
+    Take a nap in our infinite loop
+    """
+    if runner.halt is False:
+        print("Sleeping for %d seconds..." % (int(loopInterval)))
+        # Sleep for bigsleep, but in small chunks to check abort
+        for _ in range(int(loopInterval)):
+            time.sleep(1)
+            if runner.halt is True:
+                break
+
+
+def startCollections(printerip, runner, outputs=None, loopInterval=30,
+                     profiler=None):
+    """
+    outputs is a list of sinks (see ultimonitor.sinks) like the database
+    (via a dbwriter.batchWriter, so a slow or dead database never holds
+    up the collection loop) and/or the local archive.
+
+    profiler is an optional profiling.cycleProfiler to run over some of
+    the cycles.
+    """
+    # Keeps track of what temperature samples we've already stored
+    flowTracker = classes.tempFlowTracker()
 
     while runner.halt is False:
-        # Do a check of everything we care about
-        stats = printer.statusCheck(printerip)
-
-        # Did our status check work?
-        if stats != {}:
-            # Collect the temperatures. Remember: nsamps should be slightly
-            #   greater than 10xloopTime since the sample rate is 10 Hz
-            tempPkts = printer.tempFlow(printerip, nsamps=450)
-
-            # Collect the overall system info
-            sysPkts = printer.systemStats(printerip)
-
-            if db is not None:
-                if tempPkts != []:
-                    try:
-                        db.singleCommit(tempPkts,
-                                        table=db.tablename,
-                                        timeprec='ms')
-                    except Exception as e:
-                        # Errors seen so far:
-                        #   influxdb.exceptions.InfluxDBServerError
-                        # (My) error strings caught elsewhere:
-                        #   Authentication error!
-                        #   INFLUXDB ERROR
-                        print("DATABASE COMMIT ERROR!")
-                        print(str(e))
-                if sysPkts != []:
-                    try:
-                        db.singleCommit(sysPkts,
-                                        table=db.tablename,
-                                        timeprec='ms')
-                    except Exception as e:
-                        # Errors seen so far:
-                        # influxdb.exceptions.InfluxDBServerError
-                        print("DATABASE COMMIT ERROR!")
-                        print(str(e))
-
-        # Take a nap in our infinite loop
-        if runner.halt is False:
-            print("Sleeping for %d seconds..." % (int(loopInterval)))
-            # Sleep for bigsleep, but in small chunks to check abort
-            for _ in range(int(loopInterval)):
-                time.sleep(1)
-                if runner.halt is True:
-                    break
+        with profiling.profileCycle(profiler):
+            tempPkts, sysPkts = collectOnce(printerip, flowTracker)
+
+            sinks.sendOff(outputs, tempPkts)
+            sinks.sendOff(outputs, sysPkts)
+
+        napTime(runner, loopInterval)
+
+    if profiler is not None:
+        profiler.close()
+
+
+def storeCollection(fut, name, outputs):
+    """
+    Hand what a finished collectOnce got to the sinks
+    """
+    try:
+        tempPkts, sysPkts = fut.result()
+    except Exception as err:
+        print("COLLECTION FAILED FOR PRINTER %s!" % (name))
+        print(str(err))
+        metrics.errors.inc(kind="collector")
+        return
+
+    sinks.sendOff(outputs, tempPkts)
+    sinks.sendOff(outputs, sysPkts)
+
+
+def startFleet(printers, runner, outputs=None, loopInterval=30,
+               maxWorkers=4):
+    """
+    Poll a whole bunch of printers at once, at most maxWorkers at a time.
+
+    Every point gets tagged with the printer name so they can be told
+    apart, and one printer falling over doesn't take the rest with it.
+    Each printer is on its own schedule, so a slow or unreachable one
+    can't hold the others up past what their temperature buffers hold.
+    Everything is handed off to the (shared) sinks.
+    """
+    trackers = {}
+    nextPoll = {}
+    for name in printers:
+        trackers.update({name: classes.tempFlowTracker()})
+        nextPoll.update({name: 0.})
+
+    # Just like monitoring.monitorFleet; keep checking who is due and
+    #   hand them to the pool as they come up
+    futures = {}
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        while runner.halt is False:
+            now = time.monotonic()
+            busy = list(futures.values())
+            for name in printers:
+                if name in busy or nextPoll[name] > now:
+                    continue
+                fut = pool.submit(collectOnce, printers[name].ip,
+                                  trackers[name], tags={"printer": name})
+                futures.update({fut: name})
+                # Schedule from when the cycle started
+                nextPoll[name] = now + loopInterval
+
+            if futures == {}:
+                # Nobody is due yet, so nap until the first one is
+                nextDue = min(nextPoll.values())
+                time.sleep(min(max(nextDue - time.monotonic(), 0.), 1.))
+                continue
+
+            done, _ = wait(list(futures.keys()), timeout=1.,
+                           return_when=FIRST_COMPLETED)
+            for fut in done:
+                storeCollection(fut, futures.pop(fut), outputs)
+
+        # Anything already collected still gets stored on the way out
+        done, _ = wait(list(futures.keys()))
+        for fut in done:
+            storeCollection(fut, futures.pop(fut), outputs)
 
 
 if __name__ == "__main__":
@@ -85,14 +173,43 @@ if __name__ == "__main__":
     # Start logging to a file
     utils.logs.setup_logging(logName="./logs/clausius.log", nLogs=10)
 
+    # Material profiles we've already looked up and parsed before
+    printer.loadMaterialCache("./config/materials.json")
+
     # Set up our signal
     runner = utils.common.HowtoStopNicely()
 
-    # Set up our database object
-    #   With contortions because I'm not using my own API in the usual way
-    db = connSetup.connIDB({'database': cDict['databaseSetup']})['database']
-
-    printerip = cDict['printerSetup'].ip
-    startCollections(printerip, runner, db=db)
+    # The database (and maybe the archive), all written in the background
+    outputs, lwriter = sinks.makeOutputs(cDict,
+                                         spoolfile="./spool/clausius.spool")
+
+    # Metrics, if asked for; they only go to the database, since the
+    #   archive is for the printer data
+    dbOutputs = [o for o in outputs if isinstance(o, sinks.influxSink)]
+    mserver, mreporter = metrics.startMetrics(cDict['metrics'],
+                                              outputs=dbOutputs,
+                                              tags={"program": "clausius"})
+
+    # Profile some of the cycles, if asked
+    profiler = profiling.fromConfig(cDict['profiling'], label="clausius")
+
+    if len(cDict['printers']) > 1:
+        print("Fleet mode; collecting from %d printers" %
+              (len(cDict['printers'])))
+        if profiler is not None:
+            print("Profiling is only for a single printer; ignoring it")
+        startFleet(cDict['printers'], runner, outputs=outputs)
+    else:
+        printerip = cDict['printerSetup'].ip
+        startCollections(printerip, runner, outputs=outputs,
+                         profiler=profiler)
+
+    # We were asked to stop nicely, so flush whatever is still in hand
+    metrics.stopMetrics(mserver, mreporter)
+    sinks.closeOutputs(outputs, lwriter)
+
+    # Show how much the pooled keep-alive connections actually saved us
+    print("Printer connection stats: %s" % (apitools.sessionStats()))
+    apitools.closeSessions()
 
     print("Clausius has exited!")
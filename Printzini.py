@@ -19,7 +19,8 @@ from __future__ import division, print_function, absolute_import
 from ligmos import utils
 
 from ultimonitor import confparser
-from ultimonitor import leds, monitoring
+from ultimonitor import monitoring, apitools, printer, metrics, sinks
+from ultimonitor import profiling
 
 
 def main(conffile):
@@ -34,56 +35,58 @@ def main(conffile):
     squashPiCam = False
     squashUltiCam = False
 
-    # These are our color options, given as a dict of color names and their
-    #   associated HSV (!NOT RGB!) properties which are actually sent to the
-    #   case LEDs via the printer API
-    hsvCols = leds.pallettBobRoss()
-
-    # The numerical codes are seen in "printer/diagnostics/temperature_flow/"
-    #   See also: griffin/printer/drivers/marlin/applicationLayer.py
-    #
-    # When printing, 0 denotes hotend #1 and 1 denotes hotend #2. We
-    #   can just simplify things and call both "printing" for now
-    # TODO: Figure out if there are additional valid states in 2 thru 9
-    flowStateMap = {0: 'printing',
-                    1: 'printing',
-                    10: 'idle',
-                    11: 'pausing',
-                    12: 'paused',
-                    13: 'resuming',
-                    14: 'pre_print',
-                    15: 'post_print',
-                    16: 'wait_cleanup',
-                    17: 'wait_user_action'}
-
-    # NOTE: There are 3 additional states (error, maintenance, booting) that
-    #   aren't captured in the flowStateMap since they originate elsewhere
-    #   in the Ultimaker griffin engine
-    statusColors = {"idle": hsvCols["PrussianBlue"],
-                    "printing": hsvCols["TitaniumWhite"],
-                    "pausing": hsvCols["IndianYellow"],
-                    "paused": hsvCols["CadmiumYellow"],
-                    "resuming": hsvCols["IndianYellow"],
-                    "pre_print": hsvCols["SapGreen"],
-                    "post_print": hsvCols["BrightBlue"],
-                    "wait_cleanup": hsvCols["BrightGreen"],
-                    "wait_user_action": hsvCols["BrightRed"],
-                    "error": hsvCols["BrightRed"],
-                    "maintenance": hsvCols["CadmiumYellow"],
-                    "booting": hsvCols["PhthaloGreen"]}
+    # What the printer's state codes mean, and what color goes with each
+    flowStateMap, statusColors = monitoring.stateMaps()
 
     # Start logging to a file
     utils.logs.setup_logging(logName="./logs/printzini.log", nLogs=10)
 
+    # Material profiles we've already looked up and parsed before
+    printer.loadMaterialCache("./config/materials.json")
+
     # Set up our signal
     runner = utils.common.HowtoStopNicely()
 
+    # Metrics, if asked for.  Reporting them to the database needs a
+    #   writer of our own, since we don't otherwise write anything there
+    outputs, lwriter = None, None
+    mset = cDict['metrics']
+    if mset is not None and float(mset.reportinterval) > 0 and\
+       cDict['databaseSetup'] is not None:
+        spoolfile = "./spool/printzini.spool"
+        outputs, lwriter = sinks.makeOutputs(cDict, spoolfile=spoolfile,
+                                             archive=False)
+    mserver, mreporter = metrics.startMetrics(mset, outputs=outputs,
+                                              tags={"program": "printzini"})
+
+    # Profile some of the cycles, if asked
+    profiler = profiling.fromConfig(cDict['profiling'], label="printzini")
+
     # Actually monitor
-    monitoring.monitorUltimaker(cDict, flowStateMap, statusColors, runner,
+    if len(cDict['printers']) > 1:
+        print("Fleet mode; monitoring %d printers" % (len(cDict['printers'])))
+        if profiler is not None:
+            print("Profiling is only for a single printer; ignoring it")
+        monitoring.monitorFleet(cDict, flowStateMap, statusColors, runner,
                                 loopInterval=30,
                                 squashEmail=squashEmail,
                                 squashPiCam=squashPiCam,
                                 squashUltiCam=squashUltiCam)
+    else:
+        monitoring.monitorUltimaker(cDict, flowStateMap, statusColors, runner,
+                                    loopInterval=30,
+                                    squashEmail=squashEmail,
+                                    squashPiCam=squashPiCam,
+                                    squashUltiCam=squashUltiCam,
+                                    profiler=profiler)
+
+    metrics.stopMetrics(mserver, mreporter)
+    if outputs is not None:
+        sinks.closeOutputs(outputs, lwriter)
+
+    # Show how much the pooled keep-alive connections actually saved us
+    print("Printer connection stats: %s" % (apitools.sessionStats()))
+    apitools.closeSessions()
 
     print("Printzini has exited normally!  Enjoy the world of 3D.")
 
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Micro-benchmarks for the collector and monitor hot paths.
+
+Covers temperature_flow packet and line protocol construction
+(1 - 800 samples), formatStatus, dbq.queryConstructor,
+leds.pallettBobRoss and a full statusCheck against a local simulated
+printer.  statusCheck is timed both cold (the endpoint and material
+caches emptied and the keep-alive sessions closed before every call,
+like the first look at a printer) and warm.  Results are written as JSON
+so runs on the Pi can be compared before/after a change:
+
+    python benchmarks/hotpaths.py --output before.json
+    (change stuff)
+    python benchmarks/hotpaths.py --output after.json --compare before.json
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import statistics
+import subprocess
+from types import SimpleNamespace
+from collections import OrderedDict
+
+# So this runs from a checkout without installing anything
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import dbq
+from ultimonitor import printer, leds, simulator, lineproto, apitools
+
+
+def timeIt(func, repeat=7, mintime=0.2):
+    """
+    Time func() the way timeit does it on the command line; figure out how
+    many loops take at least mintime, then do that repeat times.
+    Everything comes back in seconds per call.
+    """
+    timer = timeit.Timer(func)
+    nloops = 1
+    while True:
+        if timer.timeit(nloops) >= mintime:
+            break
+        nloops *= 2
+
+    runs = [t/nloops for t in timer.repeat(repeat=repeat, number=nloops)]
+
+    return {"loops": nloops,
+            "repeat": repeat,
+            "min": min(runs),
+            "median": statistics.median(runs),
+            "mean": statistics.mean(runs),
+            "stdev": statistics.stdev(runs) if repeat > 1 else 0.}
+
+
+def cannedStats():
+    """
+    What statusCheck hands back mid-print.
+    """
+    stats = OrderedDict()
+    stats.update({"PrintSetup": {"Extruder1": "AA 0.4",
+                                 "Material1": "PLA Ultimaker Red "
+                                              "(2.85 mm, 1.24 g/cm^3)",
+                                 "Extruder2": "BB 0.4",
+                                 "Material2": "PVA Ultimaker Natural "
+                                              "(2.85 mm, 1.23 g/cm^3)",
+                                 "BedType": "glass"}})
+    stats.update({"Status": "printing"})
+    stats.update({"JobParameters": {"Name": "UM3E_benchy",
+                                    "TimeStart": "2026-10-18T12:00:00",
+                                    "Source": "WEB_API",
+                                    "Username": "rhamilton",
+                                    "UUID": "d3d4daf8-e680-556d-bb6c",
+                                    "BedTempSetp": 60.,
+                                    "Extruder1Setp": 210.,
+                                    "Extruder2Setp": 0.,
+                                    "ElapsedTime": 1.25,
+                                    "EstimatedDuration": 3.5,
+                                    "JobState": "printing",
+                                    "Progress": 35.714}})
+
+    return stats
+
+
+def cannedQuery():
+    """
+    Stand-in for a databaseQuery configuration section.
+    """
+    database = SimpleNamespace(type="influxdb", host="dbhost", port=8086,
+                               user=None, password=None)
+
+    return SimpleNamespace(database=database,
+                           tablename="printerStats",
+                           metricname="temperatures",
+                           fields=["temperature0", "target0",
+                                   "temperature1", "target1",
+                                   "bed_temperature", "bed_target"],
+                           fieldlabels=["T0", "T0Setp", "T1", "T1Setp",
+                                        "Bed", "BedSetp"],
+                           tagnames="printer",
+                           tagvals=["lab1", "lab2", "lab3"],
+                           rangehours=48)
+
+
+def coldStatusCheck(ip):
+    """
+    statusCheck with nothing cached and no open connections
+    """
+    apitools.invalidateCache()
+    printer.clearMaterialCache()
+    apitools.closeSessions()
+
+    return printer.statusCheck(ip)
+
+
+def runBenchmarks(nsamps, latency=0., repeat=7, mintime=0.2):
+    """
+    """
+    results = {}
+    sim = simulator.simulatedPrinter("bench")
+    bootepoch = time.time() - sim.uptime()
+
+    for n in nsamps:
+        tres = sim.temperatureFlow(n)
+        res = timeIt(lambda: printer.flowToPackets(tres, bootepoch),
+                     repeat=repeat, mintime=mintime)
+        res.update({"perSample": res["median"]/n})
+        results.update({"tempFlow.packets.%04d" % (n): res})
+
+        res = timeIt(lambda: lineproto.encodeBlock(
+                     printer.flowToBlock(tres, bootepoch)),
+                     repeat=repeat, mintime=mintime)
+        res.update({"perSample": res["median"]/n})
+        results.update({"tempFlow.lineproto.%04d" % (n): res})
+
+    stats = cannedStats()
+    results.update({"formatStatus":
+                    timeIt(lambda: printer.formatStatus(stats),
+                           repeat=repeat, mintime=mintime)})
+
+    q = cannedQuery()
+    results.update({"dbq.queryConstructor":
+                    timeIt(lambda: dbq.queryConstructor(q, dtime=48),
+                           repeat=repeat, mintime=mintime)})
+
+    results.update({"leds.pallettBobRoss":
+                    timeIt(leds.pallettBobRoss,
+                           repeat=repeat, mintime=mintime)})
+
+    # A real round trip over HTTP, against a printer on localhost
+    sims = simulator.startSimulators(count=1, baseport=0, latency=latency)
+    server = sims[0][0]
+    ip = simulator.simulatorURL(server)
+    try:
+        res = timeIt(lambda: coldStatusCheck(ip),
+                     repeat=repeat, mintime=mintime)
+        res.update({"simulatedLatency": latency})
+        results.update({"statusCheck.simulated.cold": res})
+
+        # Caches and connections from the last call are all still good
+        res = timeIt(lambda: printer.statusCheck(ip),
+                     repeat=repeat, mintime=mintime)
+        res.update({"simulatedLatency": latency})
+        results.update({"statusCheck.simulated.warm": res})
+    finally:
+        server.shutdown()
+
+    return results
+
+
+def gitCommit():
+    """
+    """
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=here,
+                                         stderr=subprocess.DEVNULL)
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return commit
+
+
+def compareRuns(new, old):
+    """
+    Print median time ratios (new/old) for everything in both runs.
+    """
+    print("%-30s %12s %12s %8s" % ("benchmark", "old (us)", "new (us)",
+                                    "ratio"))
+    for key in sorted(new["results"]):
+        if key not in old["results"]:
+            continue
+        o = old["results"][key]["median"]*1e6
+        n = new["results"][key]["median"]*1e6
+        print("%-30s %12.2f %12.2f %8.3f" % (key, o, n, n/o))
+
+
+def main():
+    """
+    """
+    parser = argparse.ArgumentParser(description="Hot path benchmarks")
+    parser.add_argument("--output", default="./benchresults.json")
+    parser.add_argument("--compare", default=None,
+                        help="Previous results file to compare against")
+    parser.add_argument("--nsamps", default="1,10,100,450,800",
+                        help="Comma separated temperature_flow sizes")
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="Simulated printer latency (s) for statusCheck")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--mintime", type=float, default=0.2)
+    args = parser.parse_args()
+
+    nsamps = [int(n) for n in args.nsamps.split(",")]
+    results = runBenchmarks(nsamps, latency=args.latency,
+                            repeat=args.repeat, mintime=args.mintime)
+
+    run = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "commit": gitCommit(),
+           "python": platform.python_version(),
+           "machine": platform.machine(),
+           "platform": platform.platform(),
+           "results": results}
+
+    with open(args.output, "w") as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+
+    for key in sorted(results):
+        print("%-30s %12.2f us" % (key, results[key]["median"]*1e6))
+    print("Results written to %s" % (args.output))
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            old = json.load(f)
+        compareRuns(run, old)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,22 +15,65 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+import os
+import calendar
+import threading
 from collections import OrderedDict
 from datetime import datetime as dt
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-from influxdb import DataFrameClient
+import pandas as pd
+from influxdb import DataFrameClient, InfluxDBClient
 
+from ultimonitor import tempstats
 
-def queryConstructor(db, dtime=48, debug=False):
-    """
-    db is type databaseQuery, which includes databaseConfig as
-    dbinfo.db.  More info in 'confHerder'.
 
-    dtime is time from present (in hours) to query back
+# One client per host/port/user/database, reused for every query to it
+_clients = {}
+_clientLock = threading.Lock()
 
-    Allows grouping of the results by a SINGLE tag with multiple values.
+# Query results, keyed by the server and the query itself (without any
+#   times in it).  Each entry remembers which time bucket it was last
+#   brought up to date in; repeats within that bucket are free, and later
+#   ones only have to ask the database for what's new since then.
+_results = OrderedDict()
+_resultLock = threading.Lock()
+_resultCounts = {"hits": 0, "tails": 0, "misses": 0, "evictions": 0,
+                 "uncached": 0}
+_resultRows = 0
+# Most results to keep, and most rows (over every DataFrame) to keep in
+#   them; a week of raw 10 Hz temperatures is ~6 million rows on its own,
+#   so the count alone doesn't say much about memory
+resultCacheSize = 16
+resultCacheRows = 2000000
+# Seconds per time bucket
+resultBucket = 60.
+# Seconds of already cached data to fetch again with each tail, to catch
+#   points that were written to the database late (batched writes)
+resultOverlap = 120.
 
-    No checking if you want all values for a given tag, so be explicit for now.
+# Aggregate functions we'll hand to InfluxDB; percentiles are given as
+#   pNN (like p95 or p99.9) and turned into PERCENTILE("field", NN)
+aggregations = ['mean', 'median', 'max', 'min', 'stddev', 'count',
+                'sum', 'spread', 'first', 'last']
+
+# GROUP BY time() intervals to choose from, in seconds
+niceIntervals = [1, 2, 5, 10, 15, 30,
+                 60, 120, 300, 600, 900, 1800,
+                 3600, 7200, 10800, 21600, 43200, 86400]
+
+# How many points per field to aim for if aggregating without an interval
+defaultPoints = 1000
+
+# Points per chunk when streaming results, which is about how many rows
+#   each block handed back by streamResults will have
+chunkSize = 10000
+
+
+def queryHours(dtime):
+    """
+    Range of the query in hours, which might've come in as a string
     """
     if isinstance(dtime, str):
         try:
@@ -39,6 +82,154 @@ def queryConstructor(db, dtime=48, debug=False):
             print("Can't convert %s to int!" % (dtime))
             dtime = 1
 
+    return dtime
+
+
+def influxTime(t):
+    """
+    UTC datetime to the string form InfluxQL wants for a time
+    """
+    return t.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def durationString(secs):
+    """
+    Seconds to an InfluxQL duration literal, in the biggest unit that fits
+    """
+    secs = int(secs)
+    for unit, usecs in [('d', 86400), ('h', 3600), ('m', 60)]:
+        if secs % usecs == 0:
+            return "%d%s" % (secs // usecs, unit)
+
+    return "%ds" % (secs)
+
+
+def durationSeconds(dstr):
+    """
+    InfluxQL duration literal (like 30s or 5m) to seconds
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    dstr = dstr.strip().lower()
+
+    return int(dstr[:-1])*units[dstr[-1]]
+
+
+def chooseInterval(span, npoints=defaultPoints):
+    """
+    Smallest nice GROUP BY time() interval that keeps a span (seconds)
+    down to about npoints points; 48 hours in 1000 points is 5m.
+    """
+    want = span/max(int(npoints), 1)
+    for secs in niceIntervals:
+        if secs >= want:
+            return durationString(secs)
+
+    # Really long ranges just get a whole number of days
+    return durationString(86400*(int(want // 86400) + 1))
+
+
+def queryAggregation(db, dtime=48, aggregate=None, interval=None,
+                     npoints=None):
+    """
+    Work out what (if any) aggregation a query wants, from the arguments
+    or if they're not given, the aggregate, interval and npoints keys of
+    its configuration section.
+
+    aggregate is one function for all fields or one per field, either as
+    a list or comma separated.  Without an interval, one is picked to give
+    about npoints points over dtime hours.
+
+    Returns the list of functions (one per field, or None for raw
+    values) and the interval to GROUP BY time() on.
+    """
+    if aggregate is None:
+        aggregate = getattr(db, 'aggregate', None)
+    if aggregate is None or aggregate == []:
+        return None, None
+
+    if isinstance(db.fields, list):
+        nfields = len(db.fields)
+    else:
+        nfields = 1
+
+    if isinstance(aggregate, str):
+        aggregate = aggregate.split(",")
+    aggs = []
+    for each in aggregate:
+        each = each.strip().lower()
+        if each not in aggregations:
+            try:
+                if not each.startswith('p') or\
+                   not 0 < float(each[1:]) <= 100:
+                    raise ValueError
+            except ValueError:
+                print("Unknown aggregation %s! Using mean instead" % (each))
+                each = 'mean'
+        aggs.append(each)
+    if len(aggs) == 1:
+        aggs = aggs*nfields
+    elif len(aggs) != nfields:
+        print("%d aggregations for %d fields! Using %s for all" %
+              (len(aggs), nfields, aggs[0]))
+        aggs = [aggs[0]]*nfields
+
+    if interval is None:
+        interval = getattr(db, 'interval', None)
+    if interval is None:
+        if npoints is None:
+            npoints = getattr(db, 'npoints', defaultPoints)
+        interval = chooseInterval(dtime*3600., npoints)
+
+    return aggs, interval
+
+
+def fieldSelector(field, label=None, agg=None):
+    """
+    One entry in the SELECT list, wrapped in its aggregate if there is one.
+    Aggregates get the field name as their label by default, otherwise
+    InfluxDB calls the column 'mean' or whatever.
+    """
+    if agg is None:
+        sel = '"%s"' % (field)
+    else:
+        if agg.startswith('p'):
+            sel = 'PERCENTILE("%s", %s)' % (field, agg[1:])
+        else:
+            sel = '%s("%s")' % (agg.upper(), field)
+        if label is None:
+            label = field
+
+    if label is not None:
+        sel += ' AS "%s"' % (label)
+
+    return sel
+
+
+def queryConstructor(db, dtime=48, debug=False, endtime=None,
+                     starttime=None, aggregate=None, interval=None,
+                     npoints=None):
+    """
+    db is type databaseQuery, which includes databaseConfig as
+    dbinfo.db.  More info in 'confHerder'.
+
+    dtime is time from present (in hours) to query back
+
+    If endtime (a UTC datetime) is given, the query window is dtime hours
+    back from then instead of from now(); that's how a batch of queries
+    all get pinned to the same moment.  If starttime is given too, the
+    window is just [starttime, endtime] and dtime is ignored.
+
+    aggregate, interval and npoints ask InfluxDB to do the reduction
+    (see queryAggregation) so we get back a few hundred points per field
+    instead of a couple million; any not given come from db.  The interval
+    is always picked from dtime so tails match up with the full query.
+
+    Allows grouping of the results by a SINGLE tag with multiple values.
+
+    No checking if you want all values for a given tag, so be explicit for now.
+    """
+    dtime = queryHours(dtime)
+
     if db.database.type.lower() == 'influxdb':
         if debug is True:
             print("Searching for %s in %s.%s on %s:%s" % (db.fields,
@@ -57,27 +248,46 @@ def queryConstructor(db, dtime=48, debug=False):
         # TODO: Someone should write a query validator to make sure
         #   this can't run amok.  For now, make sure the user has
         #   only READ ONLY privileges to the database in question!!!
-        query = 'SELECT'
+        aggs, interval = queryAggregation(db, dtime=dtime,
+                                          aggregate=aggregate,
+                                          interval=interval,
+                                          npoints=npoints)
+
+        selects = []
         if isinstance(db.fields, list):
             for i, each in enumerate(db.fields):
                 # Catch possible fn/dn mismatch
                 try:
-                    query += ' "%s" AS "%s"' % (each.strip(),
-                                                db.fieldlabels[i])
-                except IndexError:
-                    query += ' "%s"' % (each.strip())
-                if i != len(db.fields)-1:
-                    query += ','
+                    label = db.fieldlabels[i]
+                except (IndexError, TypeError):
+                    label = None
+                if aggs is not None:
+                    agg = aggs[i]
                 else:
-                    query += ' '
+                    agg = None
+                selects.append(fieldSelector(each.strip(), label, agg))
         else:
-            if db.fieldlabels is not None:
-                query += ' "%s" AS "%s" ' % (db.fields, db.fieldlabels)
+            if aggs is not None:
+                agg = aggs[0]
             else:
-                query += ' "%s" ' % (db.fields)
+                agg = None
+            selects.append(fieldSelector(db.fields, db.fieldlabels, agg))
 
+        query = 'SELECT %s ' % (", ".join(selects))
         query += 'FROM "%s"' % (db.metricname)
-        query += ' WHERE time > now() - %02dh' % (dtime)
+        if endtime is None:
+            query += ' WHERE time > now() - %02dh' % (dtime)
+        elif starttime is not None:
+            query += " WHERE time >= '%s'" % (influxTime(starttime))
+            query += " AND time <= '%s'" % (influxTime(endtime))
+        else:
+            tstamp = influxTime(endtime)
+            query += " WHERE time > '%s' - %02dh" % (tstamp, dtime)
+            query += " AND time <= '%s'" % (tstamp)
+
+        groups = []
+        if interval is not None:
+            groups.append('time(%s)' % (interval))
 
         if tagvals != []:
             query += ' AND ('
@@ -87,15 +297,37 @@ def queryConstructor(db, dtime=48, debug=False):
 
                     if i != len(tagvals)-1:
                         query += ' OR '
-                query += ') GROUP BY "%s"' % (tagnames)
+                query += ')'
+                groups.append('"%s"' % (tagnames))
             else:
                 # If we're here, there was only 1 tag value so we don't need
                 #   to GROUP BY anything
                 query += '"%s"=\'%s\')' % (tagnames, tagvals)
 
+        if groups != []:
+            query += ' GROUP BY %s' % (",".join(groups))
+
         return query
 
 
+def getClient(host, port=8086, dbuser='rand', dbpass='pass',
+              dbname='DBname', clientType=DataFrameClient):
+    """
+    Hand back the shared client (a DataFrameClient, unless clientType
+    says otherwise) for this database, making it the first time thru.
+    Keeps us from setting up a new client (and HTTP session) for every
+    single query.
+    """
+    key = (clientType.__name__, host, port, dbuser, dbname)
+    with _clientLock:
+        idfc = _clients.get(key)
+        if idfc is None:
+            idfc = clientType(host, port, dbuser, dbpass, dbname)
+            _clients.update({key: idfc})
+
+    return idfc
+
+
 def getResultsDataFrame(host, querystr, port=8086,
                         dbuser='rand', dbpass='pass',
                         dbname='DBname'):
@@ -103,7 +335,7 @@ def getResultsDataFrame(host, querystr, port=8086,
     Attempts to distinguish queries that have results grouped by a tag
     vs. those which are just of multiple fields. May be buggy still.
     """
-    idfc = DataFrameClient(host, port, dbuser, dbpass, dbname)
+    idfc = getClient(host, port, dbuser, dbpass, dbname)
 
     results = idfc.query(querystr)
 
@@ -127,30 +359,346 @@ def getResultsDataFrame(host, querystr, port=8086,
     return betterResults
 
 
-def batchQuery(quer, debug=False):
+def seriesFrame(series):
+    """
+    One series out of a raw InfluxDB response (queried with epoch='ms')
+    to a DataFrame indexed by time, like DataFrameClient would give.
+    """
+    frame = pd.DataFrame(series['values'], columns=series['columns'])
+    frame.index = pd.to_datetime(frame.pop('time'), unit='ms', utc=True)
+    frame.index.name = None
+
+    return frame
+
+
+def streamResults(host, querystr, port=8086,
+                  dbuser='rand', dbpass='pass',
+                  dbname='DBname', chunksize=chunkSize):
+    """
+    Like getResultsDataFrame, but for ranges too big to hold all at once.
+
+    InfluxDB sends the results back in chunks of about chunksize points,
+    which are turned into DataFrames one at a time as they come in so
+    memory use stays the same no matter how much comes back.  Yields
+    (tval, frame) where tval is the value of the tag the query was
+    grouped by (None if it wasn't); a series too long for one chunk
+    just shows up again in the next block with the same tval.
+    """
+    # DataFrameClient would try to make one big frame out of all the
+    #   chunks, so use a plain client.  NOTE: influxdb-python only hands
+    #   the chunks over one at a time as they arrive from 5.3 on; before
+    #   that it reads the whole response first
+    idbc = getClient(host, port, dbuser, dbpass, dbname,
+                     clientType=InfluxDBClient)
+    chunks = idbc.query(querystr, epoch='ms', chunked=True,
+                        chunk_size=chunksize)
+
+    for chunk in chunks:
+        for series in chunk.raw.get('series', []):
+            tags = series.get('tags')
+            if tags:
+                tval = list(tags.values())[0]
+            else:
+                tval = None
+            yield tval, seriesFrame(series)
+
+
+def streamQuery(q, endtime=None, debug=False, chunksize=chunkSize):
+    """
+    streamResults for the databaseQuery q, over its usual range
+    (ending at endtime, if given, otherwise now).
+    """
+    query = queryConstructor(q, dtime=q.rangehours, debug=debug,
+                             endtime=endtime)
+
+    return streamResults(q.database.host, query, q.database.port,
+                         dbuser=q.database.user,
+                         dbpass=q.database.password,
+                         dbname=q.tablename, chunksize=chunksize)
+
+
+def exportCSV(blocks, outfile):
+    """
+    Write streamed (tval, frame) blocks out to CSV as they come in.
+    Results grouped by a tag go to one file per tag value, with the value
+    tacked on to the name (temps.csv -> temps_lab1.csv).
+
+    Returns the number of rows written to each file.
+    """
+    base, ext = os.path.splitext(outfile)
+    handles = OrderedDict()
+    nrows = OrderedDict()
+    try:
+        for tval, frame in blocks:
+            if tval is None:
+                fname = outfile
+            else:
+                fname = "%s_%s%s" % (base, tval, ext)
+
+            if fname not in handles:
+                handles.update({fname: open(fname, "w")})
+                nrows.update({fname: 0})
+                header = True
+            else:
+                header = False
+
+            frame.to_csv(handles[fname], header=header, index_label="time")
+            nrows[fname] += len(frame)
+    finally:
+        for f in handles.values():
+            f.close()
+
+    return nrows
+
+
+def streamStats(blocks):
+    """
+    Running statistics (tempstats.runningStats) for every numeric column
+    of streamed (tval, frame) blocks, without ever having more than one
+    block around.  Returns {tval: {column: runningStats}}; nulls
+    (like empty GROUP BY time() buckets) are skipped.
+    """
+    stats = OrderedDict()
+    for tval, frame in blocks:
+        tstats = stats.setdefault(tval, OrderedDict())
+        for col in frame.select_dtypes(include='number').columns:
+            vals = frame[col].dropna().values
+            tstats.setdefault(col, tempstats.runningStats()).update(vals)
+
+    return stats
+
+
+def floorTime(t, secs):
+    """
+    Round a UTC datetime down to a whole multiple of secs (since the epoch)
+    """
+    past = calendar.timegm(t.utctimetuple()) % secs + t.microsecond/1e6
+
+    return t - timedelta(seconds=past)
+
+
+def mergeFrames(old, new, tstart):
+    """
+    Stack new below old, keeping the newer copy of any rows that are in
+    both, and chop off everything before tstart.
+    Either one can be None; if nothing's left, so is the result.
+    """
+    frames = [f for f in [old, new] if f is not None]
+    if frames == []:
+        return None
+
+    frame = pd.concat(frames)
+    frame = frame[~frame.index.duplicated(keep='last')].sort_index()
+    frame = frame[frame.index >= tstart]
+    if frame.empty:
+        frame = None
+
+    return frame
+
+
+def mergeResults(old, new, tstart):
+    """
+    Merge a tail query result into a cached one.  Both are whatever
+    getResultsDataFrame handed back: a DataFrame, a dict of them keyed
+    by tag value, or an empty dict if there was nothing.
+    """
+    tstart = pd.Timestamp(tstart, tz='UTC')
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        merged = {}
+        tvals = list(old.keys()) + [t for t in new.keys() if t not in old]
+        for tval in tvals:
+            frame = mergeFrames(old.get(tval), new.get(tval), tstart)
+            if frame is not None:
+                merged.update({tval: frame})
+        return merged
+
+    # Only one (or neither) is a single DataFrame; an empty dict here
+    #   just means that query came back empty
+    if isinstance(old, dict):
+        old = None
+    if isinstance(new, dict):
+        new = None
+    merged = mergeFrames(old, new, tstart)
+    if merged is None:
+        merged = {}
+
+    return merged
+
+
+def resultRows(result):
+    """
+    Number of rows in a result, however it came back
+    """
+    if isinstance(result, dict):
+        return sum([len(frame) for frame in result.values()])
+
+    return len(result)
+
+
+def cachedQuery(q, endtime, debug=False):
+    """
+    Results for the databaseQuery q over its usual range ending at
+    endtime, via the result cache.  endtime has to be on a resultBucket
+    boundary (see floorTime), so that every result in the cache for a
+    bucket is for exactly the same moment.  Three ways this can go:
+
+        Same query, same time bucket: hand back the cached results.
+        Same query, later bucket: fetch only what's new since the last
+            time (plus resultOverlap) and merge it in.
+        Anything else: the whole query, like normal.
+
+    What comes back might also be what the cache holds, so don't change it!
+    """
+    if floorTime(endtime, resultBucket) != endtime:
+        raise ValueError("cachedQuery endtime must be on a %d s boundary!" %
+                         (resultBucket))
+
+    hours = queryHours(q.rangehours)
+    tstart = endtime - timedelta(hours=hours)
+    key = (q.database.host, q.database.port, q.tablename,
+           " ".join(queryConstructor(q, dtime=hours).split()))
+    bucket = calendar.timegm(endtime.utctimetuple()) // resultBucket
+
+    with _resultLock:
+        entry = _results.get(key)
+        if entry is not None:
+            _results.move_to_end(key)
+            if entry['bucket'] == bucket:
+                _resultCounts['hits'] += 1
+                return entry['result']
+
+    # For aggregated queries, tails have to start on an interval boundary
+    #   so the first one isn't a partial (wrong) version of a cached one.
+    #   The first bucket of the range is labeled at the boundary before it.
+    _, interval = queryAggregation(q, dtime=hours)
+    if interval is not None:
+        isecs = durationSeconds(interval)
+        tstart = floorTime(tstart, isecs)
+
+    if entry is not None and tstart < entry['endtime'] <= endtime:
+        since = entry['endtime'] - timedelta(seconds=resultOverlap)
+        if interval is not None:
+            since = floorTime(since, isecs)
+        query = queryConstructor(q, dtime=hours, debug=debug,
+                                 starttime=max(since, tstart),
+                                 endtime=endtime)
+        tail = getResultsDataFrame(q.database.host, query,
+                                   q.database.port,
+                                   dbuser=q.database.user,
+                                   dbpass=q.database.password,
+                                   dbname=q.tablename)
+        result = mergeResults(entry['result'], tail, tstart)
+        ctype = 'tails'
+    else:
+        query = queryConstructor(q, dtime=hours, debug=debug,
+                                 endtime=endtime)
+        result = getResultsDataFrame(q.database.host, query,
+                                     q.database.port,
+                                     dbuser=q.database.user,
+                                     dbpass=q.database.password,
+                                     dbname=q.tablename)
+        ctype = 'misses'
+
+    global _resultRows
+    nrows = resultRows(result)
+    with _resultLock:
+        _resultCounts[ctype] += 1
+        # Don't let a query for an older time clobber a newer result
+        current = _results.get(key)
+        if current is None or current['endtime'] <= endtime:
+            if current is not None:
+                _resultRows -= _results.pop(key)['rows']
+            if nrows <= resultCacheRows:
+                _results.update({key: {"bucket": bucket,
+                                       "endtime": endtime,
+                                       "result": result,
+                                       "rows": nrows}})
+                _resultRows += nrows
+            else:
+                # Too big to keep at all
+                _resultCounts['uncached'] += 1
+        # Oldest go first
+        while len(_results) > resultCacheSize or\
+                _resultRows > resultCacheRows:
+            _, old = _results.popitem(last=False)
+            _resultRows -= old['rows']
+            _resultCounts['evictions'] += 1
+
+    return result
+
+
+def resultCacheStats():
+    """
+    Counts of hits, tail fetches, full queries and evictions so far,
+    and how much is in there now
+    """
+    with _resultLock:
+        stats = dict(_resultCounts)
+        stats.update({"entries": len(_results), "rows": _resultRows})
+
+    return stats
+
+
+def clearResultCache():
+    """
+    """
+    global _resultRows
+    with _resultLock:
+        _results.clear()
+        _resultRows = 0
+
+
+def batchQuery(quer, debug=False, maxWorkers=8, useCache=True):
     """
     It's important to do all of these queries en-masse, otherwise the results
     could end up being confusing - one set of data could differ by
     one (or several) update cycle times eventually, and that could be super
     confusing when it's really just our view of the state has drifted.
+
+    So every query is pinned to the same end time, and they're all run at
+    once; the whole batch takes about as long as the slowest one.
+    Returns the results (keyed the same as quer) and that end time.
+
+    With useCache, queries go thru the result cache (see cachedQuery)
+    so asking for the same things over and over only costs a query for
+    whatever's new since last time.  Then the end time (and the one
+    that's returned) is the start of the current resultBucket, so the
+    whole batch is still from the same moment, just up to resultBucket
+    seconds ago.
     """
     qdata = OrderedDict()
 
-    for iq in quer.keys():
-        q = quer[iq]
+    dts = dt.utcnow()
+    if useCache is True:
+        dts = floorTime(dts, resultBucket)
 
-        # Should not only pull this out of the loop, but change it to
-        #   use 'bind_params' for extra safety!
-        query = queryConstructor(q, dtime=q.rangehours, debug=debug)
+    futures = OrderedDict()
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        for iq in quer.keys():
+            q = quer[iq]
 
-        td = getResultsDataFrame(q.database.host, query,
-                                 q.database.port,
-                                 dbuser=q.database.user,
-                                 dbpass=q.database.password,
-                                 dbname=q.tablename)
-        qdata.update({iq: td})
+            if useCache is True:
+                futures.update({iq: pool.submit(cachedQuery, q, dts,
+                                                debug=debug)})
+                continue
+
+            # Should change it to use 'bind_params' for extra safety!
+            query = queryConstructor(q, dtime=q.rangehours, debug=debug,
+                                     endtime=dts)
+
+            futures.update({iq: pool.submit(getResultsDataFrame,
+                                            q.database.host, query,
+                                            q.database.port,
+                                            dbuser=q.database.user,
+                                            dbpass=q.database.password,
+                                            dbname=q.tablename)})
+
+        for iq in futures:
+            qdata.update({iq: futures[iq].result()})
 
-    dts = dt.utcnow()
     print("%d queries complete!" % (len(qdata)))
 
     print("Data stored at %s" % (dts))
+
+    return qdata, dts
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Spooling and replay in dbwriter.batchWriter
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import time
+import threading
+
+from ultimonitor import dbwriter
+
+
+class flakyCommit(object):
+    def __init__(self, failures=0):
+        """
+        Fails the first failures calls, then takes everything
+        """
+        self.failures = failures
+        self.calls = 0
+        self.committed = []
+
+    def __call__(self, pkts):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise IOError("database is down")
+        self.committed.extend(pkts)
+
+
+def spooled(spoolfile):
+    """
+    Everything in a spool file, flattened; corrupt lines are skipped
+    """
+    pkts = []
+    if os.path.exists(spoolfile):
+        with open(spoolfile, "r") as f:
+            for line in f:
+                try:
+                    pkts.extend(json.loads(line))
+                except ValueError:
+                    pass
+
+    return pkts
+
+
+def makeWriter(tmp_path, commit, **kwargs):
+    spoolfile = str(tmp_path / "spool" / "test.spool")
+    writer = dbwriter.batchWriter(None, spoolfile=spoolfile, commit=commit,
+                                  flushInterval=0., **kwargs)
+    return writer, spoolfile
+
+
+def waitFor(cond, timeout=5.):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if cond():
+            return True
+        time.sleep(0.01)
+
+    return False
+
+
+def test_failed_commit_spools_then_replays(tmp_path):
+    commit = flakyCommit(failures=1)
+    writer, spoolfile = makeWriter(tmp_path, commit, retryInterval=0.)
+    writer.start()
+
+    writer.put([1, 2, 3])
+    assert waitFor(lambda: writer.stats["spooled"] == 3)
+    assert spooled(spoolfile) == [1, 2, 3]
+
+    # The next good commit replays the spool behind it
+    writer.put([4, 5])
+    writer.stop(timeout=5.)
+
+    assert sorted(commit.committed) == [1, 2, 3, 4, 5]
+    assert writer.stats["replayed"] == 3
+    assert os.path.exists(spoolfile) is False
+    assert os.path.exists(spoolfile + ".replaying") is False
+
+
+def test_replay_keeps_what_still_fails(tmp_path):
+    commit = flakyCommit(failures=2)
+    writer, spoolfile = makeWriter(tmp_path, commit)
+    os.makedirs(os.path.dirname(spoolfile))
+    with open(spoolfile, "w") as f:
+        f.write(json.dumps([1, 2]) + "\n")
+        f.write("[3, 4" + "\n")
+        f.write(json.dumps([5]) + "\n")
+
+    # Database still down; everything goes back
+    writer.replay()
+    assert spooled(spoolfile) == [1, 2, 5]
+    writer.replay()
+    assert spooled(spoolfile) == [1, 2, 5]
+
+    # Now it's up; the corrupt line is skipped
+    writer.replay()
+    assert commit.committed == [1, 2, 5]
+    assert os.path.exists(spoolfile) is False
+
+
+def test_replay_goes_in_chunks(tmp_path):
+    calls = []
+
+    def upThenDown(pkts):
+        calls.append(list(pkts))
+        if len(calls) > 1:
+            raise IOError("database went away again")
+
+    writer, spoolfile = makeWriter(tmp_path, upThenDown, batchSize=3)
+    os.makedirs(os.path.dirname(spoolfile))
+    with open(spoolfile, "w") as f:
+        for pkts in [[1, 2], [3], [4, 5], [6], [7]]:
+            f.write(json.dumps(pkts) + "\n")
+
+    writer.replay()
+
+    # Never more than a chunk in hand, and only what wasn't sent is kept
+    assert calls == [[1, 2, 3], [4, 5, 6]]
+    assert writer.stats["replayed"] == 3
+    assert spooled(spoolfile) == [4, 5, 6, 7]
+    assert os.path.exists(spoolfile + ".replaying") is False
+
+
+def test_leftover_replaying_file(tmp_path):
+    commit = flakyCommit()
+    writer, spoolfile = makeWriter(tmp_path, commit)
+    os.makedirs(os.path.dirname(spoolfile))
+    # A previous run died mid-replay, and also spooled more since
+    with open(spoolfile + ".replaying", "w") as f:
+        f.write(json.dumps([1, 2]) + "\n")
+    with open(spoolfile, "w") as f:
+        f.write(json.dumps([3]) + "\n")
+
+    writer.replay()
+    assert commit.committed == [1, 2]
+    assert os.path.exists(spoolfile + ".replaying") is False
+
+    writer.replay()
+    assert commit.committed == [1, 2, 3]
+    assert os.path.exists(spoolfile) is False
+
+
+def test_halt_while_waiting_to_retry_spools(tmp_path):
+    commit = flakyCommit(failures=1)
+    writer, spoolfile = makeWriter(tmp_path, commit, retryInterval=3600.)
+    writer.start()
+
+    writer.put([1])
+    assert waitFor(lambda: writer.stats["errors"] == 1)
+
+    # Not allowed to try again yet, so this goes straight to the spool
+    writer.put([2])
+    writer.stop(timeout=5.)
+
+    assert commit.committed == []
+    assert sorted(spooled(spoolfile)) == [1, 2]
+
+
+def test_stop_spools_when_commit_hangs(tmp_path):
+    release = threading.Event()
+
+    def hungCommit(pkts):
+        release.wait(10.)
+        raise IOError("timed out eventually")
+
+    writer, spoolfile = makeWriter(tmp_path, hungCommit)
+    writer.start()
+
+    writer.put([1, 2])
+    assert waitFor(lambda: writer.queue.empty())
+    time.sleep(0.1)
+    writer.put([3])
+
+    writer.stop(timeout=0.5)
+    assert writer.is_alive()
+    assert sorted(spooled(spoolfile)) == [1, 2, 3]
+    release.set()
+    writer.join(5.)
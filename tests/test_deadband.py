@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Error bound of the swinging door compression in deadband
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+from ultimonitor import classes, deadband
+
+
+def makeBlock(nsamps=2000, seed=19):
+    """
+    A wandering temperature, and a setpoint that changes a bunch of
+    times along the way.  With this seed, just tacking the transitions
+    onto a single swinging door fit ends up ~0.059 off with a 0.05
+    deadband.
+    """
+    rng = np.random.default_rng(seed)
+    stamps = np.arange(nsamps, dtype=np.int64)*100
+    temp = np.cumsum(rng.normal(0., 0.05, nsamps)) + 25.
+    target = np.repeat(rng.choice([0., 200., 210.], nsamps//100), 100)
+
+    return classes.flowBlock(stamps=stamps,
+                             labels=["temperature0", "target0"],
+                             columns=[temp, target])
+
+
+def worstError(stamps, vals, mask):
+    """
+    Furthest any sample is from the lines between the kept ones
+    """
+    redrawn = np.interp(stamps, stamps[mask], vals[mask])
+
+    return np.max(np.abs(redrawn - vals))
+
+
+def test_deadband_holds_around_transitions():
+    block = makeBlock()
+    dev = deadband.defaultDeadbands["temperature*"]
+    cblock = deadband.deadbandCompressor().compress(block)
+
+    temp, target = cblock.columns
+    tmask, smask = cblock.masks
+    assert worstError(cblock.stamps, temp, tmask) <= dev + 1e-9
+
+    # Transitions (and the sample before each) are kept in every field
+    changed = np.flatnonzero(np.diff(target) != 0)
+    assert len(changed) > 0
+    assert tmask[changed].all() and tmask[changed + 1].all()
+    assert worstError(cblock.stamps, target, smask) == 0.
+
+    # ...and it still actually compresses
+    assert tmask.sum() < len(temp)//2
+
+
+def test_nonfinite_values_are_dropped():
+    stamps = np.arange(10, dtype=np.int64)
+    vals = np.linspace(20., 21., 10)
+    vals[[0, 4]] = np.nan
+    vals[7] = np.inf
+
+    mask = deadband.segmentedDoor(stamps, vals, 0.05)
+    good = np.isfinite(vals)
+    assert not mask[~good].any()
+    assert mask[1] and mask[9]
+    assert worstError(stamps[good], vals[good], mask[good]) <= 0.05 + 1e-9
+
+
+def test_idle_block_keeps_the_ends():
+    stamps = np.arange(100, dtype=np.int64)
+    vals = np.full(100, 24.01)
+
+    mask = deadband.segmentedDoor(stamps, vals, 0.05)
+    assert np.flatnonzero(mask).tolist() == [0, 99]
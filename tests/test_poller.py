@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Subscriber queues and shutdown in poller.sharedPoller
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import threading
+
+import numpy as np
+import pytest
+
+# poller pulls in printer and the notifier, which need these
+pytest.importorskip("ligmos")
+pytest.importorskip("johnnyfive")
+
+from ultimonitor import classes, poller, monitoring
+
+
+def makeSnap(name, start, nsamps=3, status="printing", labels=None):
+    """
+    A snapshot with nsamps samples, stamps (and values) from start
+    """
+    if labels is None:
+        labels = ["temperature0", "active_hotend_or_state"]
+
+    snap = classes.printerSnapshot(name, None)
+    snap.stats = {"Status": status}
+    stamps = np.arange(start, start + nsamps, dtype=np.int64)
+    columns = [stamps.astype(np.float64) for _ in labels]
+    snap.flowBlock = classes.flowBlock(stamps=stamps, labels=labels,
+                                       columns=columns)
+    snap.sysPkts = [{"measurement": "system", "fields": {"t": start}}]
+
+    return snap
+
+
+class listSubscriber(poller.subscriber):
+    def __init__(self, depth=1):
+        """
+        Just keeps everything it's handed
+        """
+        super(listSubscriber, self).__init__("list", depth=depth)
+        self.handled = []
+
+    def handle(self, snap):
+        self.handled.append(snap)
+
+
+def test_full_queue_merges_samples():
+    sub = listSubscriber(depth=1)
+    first = makeSnap("a", 0, status="pausing")
+    second = makeSnap("a", 3)
+    third = makeSnap("a", 6)
+    for snap in [first, second, third]:
+        sub.publish(snap)
+
+    snap = sub.nextSnapshot(timeout=0.)
+    assert sub.nextSnapshot(timeout=0.) is None
+    assert list(snap.flowBlock.stamps) == list(range(9))
+    assert list(snap.flowBlock.columns[0]) == list(range(9))
+    assert snap.stats is third.stats
+    assert len(snap.sysPkts) == 3
+    assert sub.stats["merged"] == 2
+    assert sub.stats["dropped"] == 0
+
+    # The originals are shared with other subscribers; hands off
+    assert list(third.flowBlock.stamps) == [6, 7, 8]
+    assert len(third.sysPkts) == 1
+
+
+def test_deeper_queue_keeps_order():
+    sub = listSubscriber(depth=2)
+    for i in range(4):
+        sub.publish(makeSnap("a", 3*i, status="s%d" % i))
+
+    snaps = [sub.nextSnapshot(timeout=0.) for _ in range(2)]
+    assert sub.nextSnapshot(timeout=0.) is None
+    # The oldest two are folded together, the newest two are left alone
+    assert [s.stats["Status"] for s in snaps] == ["s2", "s3"]
+    assert list(snaps[0].flowBlock.stamps) == list(range(9))
+    assert list(snaps[1].flowBlock.stamps) == [9, 10, 11]
+
+
+def test_printers_take_turns():
+    sub = listSubscriber(depth=3)
+    for snap in [makeSnap("a", 0), makeSnap("a", 3), makeSnap("b", 0)]:
+        sub.publish(snap)
+
+    names = [sub.nextSnapshot(timeout=0.).name for _ in range(3)]
+    assert names == ["a", "b", "a"]
+
+
+def test_mismatched_fields_are_dropped():
+    sub = listSubscriber(depth=1)
+    sub.publish(makeSnap("a", 0, labels=["temperature0"]))
+    sub.publish(makeSnap("a", 3))
+
+    snap = sub.nextSnapshot(timeout=0.)
+    assert list(snap.flowBlock.stamps) == [3, 4, 5]
+    assert sub.stats["dropped"] == 1
+
+
+def test_merge_masks():
+    older = makeSnap("a", 0).flowBlock
+    newer = makeSnap("a", 3).flowBlock
+    newer.masks = [np.array([True, False, True]), None]
+
+    block = poller.mergeBlocks(older, newer)
+    assert list(block.masks[0]) == [True, True, True, True, False, True]
+    assert list(block.masks[1]) == [True]*6
+
+    # Nothing to merge with
+    empty = classes.flowBlock()
+    assert poller.mergeBlocks(empty, newer) is newer
+    assert poller.mergeBlocks(older, None) is older
+
+
+def test_monitor_uses_the_pollers_flow_state(monkeypatch):
+    seen = []
+
+    def fakeProcess(mstate, stats, flowBlock, *args, **kwargs):
+        seen.append(kwargs.get("flowState"))
+        return stats
+
+    monkeypatch.setattr(monitoring, "processStatus", fakeProcess)
+    monkeypatch.setattr(monitoring, "pollInterval", lambda *a, **k: 30.)
+
+    pConfig = classes.threeDimensionalPrinter()
+    cDict = {"printerSetup": pConfig, "printers": {"a": pConfig},
+             "email": None, "picam": None}
+    sub = poller.monitorSubscriber(cDict, {}, {}, None, picam=False,
+                                   ulticam=False)
+
+    # No new samples, but the poller still knows what it's doing
+    snap = makeSnap("a", 0, nsamps=0)
+    snap.printer = pConfig
+    snap.flowState = 2
+    sub.handle(snap)
+    assert seen == [2]
+
+
+class slowPoller(poller.sharedPoller):
+    def takeSnapshot(self, name):
+        """
+        Slow enough that halt shows up while it's still going
+        """
+        time.sleep(0.3)
+        return makeSnap(name, 0)
+
+
+class fakeRunner(object):
+    def __init__(self):
+        self.halt = False
+
+
+def test_inflight_snapshots_are_published_on_halt():
+    sub = listSubscriber(depth=5)
+    printers = {"a": None, "b": None}
+    poll = slowPoller(printers, [sub], loopInterval=60.)
+
+    runner = fakeRunner()
+    stopper = threading.Timer(0.1, setattr, args=(runner, "halt", True))
+    stopper.start()
+    poll.run(runner)
+    stopper.join()
+
+    assert poll.stats["snapshots"] == 2
+    names = sorted([sub.nextSnapshot(timeout=0.).name for _ in range(2)])
+    assert names == ["a", "b"]
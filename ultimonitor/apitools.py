@@ -16,56 +16,389 @@ Further description.
 from __future__ import division, print_function, absolute_import
 
 import json
+import time
+import fnmatch
+import threading
+from collections import OrderedDict
+
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
 
+from . import metrics
 
-def setProperty(apiid, apikey, printerip, endpoint, vals, goodVal=204):
+# orjson is quite a bit quicker at chewing thru the big temperature_flow
+#   replies, but it's optional; fall back to the standard library
+try:
+    import orjson
+    jsonLoads = orjson.loads
+except ImportError:
+    jsonLoads = json.loads
+
+
+# One requests.Session per printer, so every query to the same printer
+#   rides on an already open keep-alive connection rather than doing a
+#   fresh TCP handshake each time.  Shared by printer, leds and cameras.
+_sessions = {}
+_sessionLock = threading.Lock()
+
+# Enough connections in each pool to cover concurrent queries against the
+#   API (port 80) and the camera (port 8080) of a single printer
+poolConnections = 4
+poolMaxSize = 8
+
+# (connect, read) seconds for API queries.  A pooled connection can go
+#   half-open (like when the printer reboots) and without a timeout the
+#   read would just sit there forever, tying up whatever thread it's on
+queryTimeout = (5., 30.)
+
+
+# How long (seconds) a good reply from an endpoint stays good. First
+#   match wins; anything not matched (status, temperatures, print_job...)
+#   is never cached.  Patterns are matched with any slashes at the ends
+#   of the endpoint stripped off
+endpointTTL = OrderedDict([("system/uptime", 0.),
+                           ("system/memory", 0.),
+                           ("system/*", 6.*3600.),
+                           ("printer/bed/type", 6.*3600.),
+                           ("printer/heads/*/extruders/*/hotend/id", 300.),
+                           ("printer/heads/*/extruders/*/hotend/serial",
+                            300.)])
+
+# Endpoints with a sample count or a GUID in them, and what they're called
+#   in the metrics instead, so each one is one label rather than a new one
+#   for every different nsamps or material.  Same matching as endpointTTL
+endpointTemplates = OrderedDict([("printer/diagnostics/temperature_flow/*",
+                                  "printer/diagnostics/temperature_flow/<n>"),
+                                 ("materials/*", "materials/<guid>")])
+
+_cache = {}
+_cacheLock = threading.Lock()
+
+# One HTTPDigestAuth per printer and API id, kept around so it remembers
+#   the last digest challenge; then every PUT after the first can send
+#   its Authorization header right away instead of eating a 401 first
+_auths = {}
+_authLock = threading.Lock()
+_cacheStats = {"hits": 0, "misses": 0, "expired": 0, "invalidated": 0}
+
+
+def printerHost(printerip):
     """
-    REQUIRES API information for authentication.
+    Strip any scheme/path off of printerip so it can be used as a key.
+    """
+    host = printerip.split("://")[-1]
+    host = host.split("/")[0]
 
-    With great power comes great responsibility.
+    return host
 
-    vals should be a dict, which gets turned into JSON before sending.
+
+def apiLocation(printerip):
+    """
+    Turn a bare IP/hostname into the API base URL; anything that already
+    looks like a URL is passed thru untouched.
     """
     if printerip.startswith("http") is False:
         apiloc = "http://%s/api/v1/" % (printerip)
     else:
         apiloc = printerip
 
+    return apiloc
+
+
+class countingAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        """
+        An HTTPAdapter that counts the requests it sends and the TCP
+        connections urllib3 opens for it, even ones from pools that got
+        thrown away since.
+        """
+        self.countLock = threading.Lock()
+        self.sent = 0
+        self.opened = 0
+        super(countingAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        """
+        """
+        super(countingAdapter, self).init_poolmanager(*args, **kwargs)
+        pclasses = {}
+        for scheme, base in self.poolmanager.pool_classes_by_scheme.items():
+            pclasses.update({scheme: self.countingPool(base)})
+        self.poolmanager.pool_classes_by_scheme = pclasses
+
+    def countingPool(self, base):
+        """
+        A subclass of the urllib3 pool class base that tells us whenever
+        it opens a new connection
+        """
+        adapter = self
+
+        class pool(base):
+            def _new_conn(self):
+                with adapter.countLock:
+                    adapter.opened += 1
+                return super(pool, self)._new_conn()
+
+        return pool
+
+    def send(self, request, **kwargs):
+        """
+        """
+        with self.countLock:
+            self.sent += 1
+
+        return super(countingAdapter, self).send(request, **kwargs)
+
+
+def getSession(printerip):
+    """
+    Return the pooled keep-alive session for the given printer, creating
+    it on the first call.
+    """
+    host = printerHost(printerip)
+
+    with _sessionLock:
+        sess = _sessions.get(host)
+        if sess is None:
+            sess = requests.Session()
+            adapter = countingAdapter(pool_connections=poolConnections,
+                                      pool_maxsize=poolMaxSize)
+            sess.mount("http://", adapter)
+            sess.mount("https://", adapter)
+            _sessions.update({host: sess})
+
+    return sess
+
+
+def sessionStats(printerip=None):
+    """
+    Connection reuse counters for one (or all) of the printer sessions.
+
+    'requests' is the number of HTTP requests actually sent,
+    'connections' is the number of TCP connections urllib3 opened for them,
+    and 'reused' is the difference; the bigger that is, the better.
+    """
+    if printerip is not None:
+        hosts = [printerHost(printerip)]
+    else:
+        with _sessionLock:
+            hosts = list(_sessions.keys())
+
+    stats = {}
+    for host in hosts:
+        with _sessionLock:
+            sess = _sessions.get(host)
+        if sess is None:
+            continue
+
+        # Both schemes are mounted on the same adapter; only count it once
+        nreqs = 0
+        nconns = 0
+        for adapter in set(sess.adapters.values()):
+            if isinstance(adapter, countingAdapter):
+                with adapter.countLock:
+                    nreqs += adapter.sent
+                    nconns += adapter.opened
+
+        stats.update({host: {"requests": nreqs,
+                             "connections": nconns,
+                             "reused": max(nreqs - nconns, 0)}})
+
+    return stats
+
+
+def closeSessions():
+    """
+    Close all the pooled sessions, dropping their open connections.
+    """
+    with _sessionLock:
+        for host in _sessions:
+            _sessions[host].close()
+        _sessions.clear()
+
+    with _authLock:
+        _auths.clear()
+
+
+def getAuth(printerip, apiid, apikey):
+    """
+    Return the persistent digest authentication for this printer/API id.
+
+    requests keeps the nonce from the last challenge inside the auth
+    object (per thread), and if the printer decides it's gone stale it
+    just challenges again and requests handles that.
+    """
+    key = (printerHost(printerip), apiid)
+    with _authLock:
+        auth = _auths.get(key)
+        if auth is None or auth.password != apikey:
+            auth = HTTPDigestAuth(apiid, apikey)
+            _auths.update({key: auth})
+
+    return auth
+
+
+def endpointTemplate(endpoint):
+    """
+    The endpoint as it's labelled in the metrics
+    """
+    endpoint = endpoint.strip("/")
+    for pattern in endpointTemplates:
+        if fnmatch.fnmatchcase(endpoint, pattern):
+            return endpointTemplates[pattern]
+
+    return endpoint
+
+
+def endpointLifetime(endpoint):
+    """
+    Look up how long a reply from endpoint can be cached, in seconds.
+    """
+    endpoint = endpoint.strip("/")
+    for pattern in endpointTTL:
+        if fnmatch.fnmatchcase(endpoint, pattern):
+            return endpointTTL[pattern]
+
+    return 0.
+
+
+def cacheGet(printerip, endpoint, ttl):
+    """
+    Returns the cached reply, or None if there isn't a fresh one.
+    """
+    key = (printerHost(printerip), endpoint.strip("/"))
+    now = time.monotonic()
+    with _cacheLock:
+        hit = _cache.get(key)
+        if hit is None:
+            _cacheStats["misses"] += 1
+            return None
+        if now - hit[0] > ttl:
+            del _cache[key]
+            _cacheStats["expired"] += 1
+            _cacheStats["misses"] += 1
+            return None
+
+        _cacheStats["hits"] += 1
+        return hit[1]
+
+
+def cachePut(printerip, endpoint, reply):
+    """
+    """
+    key = (printerHost(printerip), endpoint.strip("/"))
+    with _cacheLock:
+        _cache.update({key: (time.monotonic(), reply)})
+
+
+def invalidateCache(printerip=None, endpoint=None):
+    """
+    Throw away cached replies; for one printer, for one endpoint (prefix),
+    or everything if neither is given.  Call this whenever the printer
+    changes state, like at the start of a job, since the hardware could
+    have been swapped around in between.
+    """
+    host = None
+    if printerip is not None:
+        host = printerHost(printerip)
+    if endpoint is not None:
+        endpoint = endpoint.strip("/")
+
+    with _cacheLock:
+        for key in list(_cache.keys()):
+            if host is not None and key[0] != host:
+                continue
+            if endpoint is not None and key[1].startswith(endpoint) is False:
+                continue
+            del _cache[key]
+            _cacheStats["invalidated"] += 1
+
+
+def cacheStats():
+    """
+    Hit/miss counters for the endpoint cache, plus how many are held.
+    """
+    with _cacheLock:
+        stats = dict(_cacheStats)
+        stats.update({"entries": len(_cache)})
+
+    return stats
+
+
+def setProperty(apiid, apikey, printerip, endpoint, vals, goodVal=204):
+    """
+    REQUIRES API information for authentication.
+
+    With great power comes great responsibility.
+
+    vals should be a dict, which gets turned into JSON before sending.
+    Returns True if the printer took it.
+    """
+    apiloc = apiLocation(printerip)
+
     queryendpoint = apiloc + endpoint
 
     # Set up the needed authentication
     # requests.post(apiloc + "auth/request", data={"application": })
-    auth = HTTPDigestAuth(apiid, apikey)
+    auth = getAuth(printerip, apiid, apikey)
     headers = {'Content-Type': 'application/json',
                'Accept': 'application/json'}
 
     jvals = json.dumps(vals)
     print("Sending %s to %s" % (jvals, queryendpoint))
-    rp = requests.put(queryendpoint, headers=headers,
-                      json=vals, auth=auth, timeout=5.)
+    sess = getSession(printerip)
+    try:
+        with metrics.apiLatency.time(printer=printerHost(printerip),
+                                     method="PUT",
+                                     endpoint=endpointTemplate(endpoint)):
+            rp = sess.put(queryendpoint, headers=headers,
+                          json=vals, auth=auth, timeout=5.)
+    except Exception as err:
+        print("PUT request to %s failed!" % (queryendpoint))
+        print(str(err))
+        metrics.errors.inc(kind="api")
+        return False
 
     if rp.status_code != goodVal:
         print("PUT request to %s failed!" % (queryendpoint))
         print(rp)
+        metrics.errors.inc(kind="api")
+        return False
+
+    return True
 
 
-def queryChecker(printerip, endpoint, goodStat=200, fill=None, debug=False):
+def queryChecker(printerip, endpoint, goodStat=200, fill=None, debug=False,
+                 ttl=None, timeout=None):
     """
+    Good replies from slow-changing endpoints are cached for the time
+    given in endpointTTL, unless ttl (seconds) is given; ttl=0 always
+    goes to the printer.  timeout defaults to queryTimeout.
     """
-    if printerip.startswith("http") is False:
-        apiloc = "http://%s/api/v1/" % (printerip)
-    else:
-        apiloc = printerip
+    if ttl is None:
+        ttl = endpointLifetime(endpoint)
+    if timeout is None:
+        timeout = queryTimeout
+
+    if ttl > 0:
+        req = cacheGet(printerip, endpoint, ttl)
+        if req is not None:
+            return req
+
+    apiloc = apiLocation(printerip)
 
     queryendpoint = apiloc + endpoint
 
     try:
-        req = requests.get(queryendpoint)
+        with metrics.apiLatency.time(printer=printerHost(printerip),
+                                     method="GET",
+                                     endpoint=endpointTemplate(endpoint)):
+            req = getSession(printerip).get(queryendpoint, timeout=timeout)
     except Exception as err:
         # TODO: Catch the right exception (socket.gaierror?)
         print(str(err))
+        metrics.errors.inc(kind="api")
         req = {}
 
     if req != {}:
@@ -74,7 +407,9 @@ def queryChecker(printerip, endpoint, goodStat=200, fill=None, debug=False):
             print(req.status_code)
             print(req.content)
         if req.status_code == goodStat:
-            req = json.loads(req.content)
+            req = jsonLoads(req.content)
+            if ttl > 0:
+                cachePut(printerip, endpoint, req)
         else:
             # NOTE: You'll get in here if an endpoint responds 404
             req = {}
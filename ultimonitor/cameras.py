@@ -15,34 +15,188 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
-from requests import get as httpget
+import os
+import time
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
 from requests.exceptions import ConnectionError as RCE
 
+from . import apitools as api
+from . import metrics
+
+
+# Captures run in here so they can overlap with each other and with
+#   building the rest of the email.  A grab that times out can't be
+#   cancelled, so each camera only gets one grab going at a time (see
+#   _lastGrabs); a wedged camera then ties up one worker at most
+_camPool = ThreadPoolExecutor(max_workers=4)
+_lastGrabs = {}
+_grabLock = threading.Lock()
+
+# How long (seconds) to wait on each source before giving up on it
+snapTimeouts = {"ulticam": 10., "picam": 20.}
 
-def grab_ultimaker(printerip):
+
+def grab_ultimaker(printerip, timeout=5.):
     """
     NOTE: This returns the whole requests HTTP get object
+
+    The image itself is in img.content; nothing is written to disk.
+    """
+    host = api.printerHost(printerip)
+    if ":" in host:
+        # An explicit port (like the simulator) means the camera is there too
+        imgloc = "http://%s/?action=snapshot" % (host)
+    else:
+        imgloc = "http://%s:8080/?action=snapshot" % (host)
+
+    print("Attempting to grab image from %s" % (imgloc))
+
+    # Same pooled session as the API queries, just a different port
+    img = api.getSession(printerip).get(imgloc, timeout=timeout)
+    # Check the HTTP response;
+    #   200 - 400 == True
+    #   400 - 600 == False
+    #   Other way to do it might be to check if img.status_code == 200
+    if img.ok is True:
+        print("Good grab!")
+    else:
+        # This will be caught elsewhere
+        print("Bad grab :(")
+        img = None
+        raise RCE
+
+    return img
+
+
+# RAM backed scratch space for the PiCam (it's there on the Pi)
+ramDir = "/dev/shm"
+
+
+def scratchDir():
+    """
+    Somewhere in RAM for the PiCam to write to, or None if there isn't
+    such a place
+    """
+    if os.path.isdir(ramDir):
+        return ramDir
+
+    return None
+
+
+def grab_picam(picam):
+    """
+    Capture from the Raspberry Pi camera via picamhelpers, which applies
+    all the settings from the picam config section itself, and return the
+    image bytes.
+
+    picamhelpers can only capture to a file, so it gets a scratch
+    directory in RAM that's cleaned up right after.  If there's no RAM
+    disk we don't take the picture at all rather than writing every
+    image to the SD card.
+    """
+    scratchRoot = scratchDir()
+    if scratchRoot is None:
+        raise IOError("No RAM disk (%s) for PiCam captures; not writing"
+                      " them to the SD card instead" % (ramDir))
+
+    # Only usable on an actual Pi, so wait until we need it
+    import picamhelpers as pch
+
+    scratch = tempfile.mkdtemp(prefix="picam", dir=scratchRoot)
+    try:
+        snapname = pch.capture.piCamCapture(picam, scratch)
+        if snapname is None:
+            raise IOError("PiCamera capture failed!")
+        with open(snapname, "rb") as f:
+            img = f.read()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return img
+
+
+def _grabUltimakerBytes(printerip, timeout):
     """
-    imgloc = "http://%s:8080/?action=snapshot" % (printerip)
-
-    # I don't care much about the filename since I operate on the actual
-    #   image itself (in img.content), but it's nice to save
-    outfile = "instasnap.jpg"
-    print("Attempting to write image to %s" % (outfile))
-
-    with open(outfile, "wb") as f:
-        img = httpget(imgloc, timeout=5.)
-        # Check the HTTP response;
-        #   200 - 400 == True
-        #   400 - 600 == False
-        #   Other way to do it might be to check if img.status_code == 200
-        if img.ok is True:
-            print("Good grab!")
-            f.write(img.content)
-        else:
-            # This will be caught elsewhere
-            print("Bad grab :(")
-            img = None
-            raise RCE
+    """
+    with metrics.cameraLatency.time(camera="ulticam"):
+        img = grab_ultimaker(printerip, timeout=timeout)
+
+    return img.content
+
+
+def _grabPiCamBytes(picam):
+    """
+    """
+    with metrics.cameraLatency.time(camera="picam"):
+        img = grab_picam(picam)
 
     return img
+
+
+def submitGrab(key, func, *args):
+    """
+    Start a grab for the camera key, unless its last one is still going;
+    returns the future, or None if it was skipped.
+    """
+    with _grabLock:
+        last = _lastGrabs.get(key)
+        if last is not None and last.done() is False:
+            print("%s camera is still busy with its last grab; skipping" %
+                  (key[0]))
+            return None
+        fut = _camPool.submit(func, *args)
+        _lastGrabs.update({key: fut})
+
+    return fut
+
+
+def startCaptures(picam=None, ulticam=None):
+    """
+    Kick off grabs from whichever cameras were given, all at once.
+    Returns a dict of futures to hand to collectCaptures later; a camera
+    whose last grab hasn't finished yet is left out (so gets no picture).
+    """
+    snaps = {}
+    if ulticam is not None:
+        fut = submitGrab(("ulticam", api.printerHost(ulticam.ip)),
+                         _grabUltimakerBytes, ulticam.ip,
+                         snapTimeouts["ulticam"])
+        if fut is not None:
+            snaps.update({"ulticam": fut})
+    if picam is not None:
+        fut = submitGrab(("picam", None), _grabPiCamBytes, picam)
+        if fut is not None:
+            snaps.update({"picam": fut})
+
+    return snaps
+
+
+def collectCaptures(snaps):
+    """
+    Wait for each capture up to its own timeout.  Returns a dict of the
+    image bytes, with None for anything that failed or took too long.
+    """
+    images = {}
+    waitStart = time.monotonic()
+    for source in snaps:
+        # Measured from when we started waiting, not cumulative
+        remaining = waitStart + snapTimeouts[source] - time.monotonic()
+        try:
+            images.update({source: snaps[source].result(
+                timeout=max(remaining, 0.))})
+        except FutureTimeout:
+            print("%s camera timed out!" % (source))
+            metrics.errors.inc(kind="camera")
+            images.update({source: None})
+        except Exception as err:
+            print("%s camera capture failed!" % (source))
+            print(str(err))
+            metrics.errors.inc(kind="camera")
+            images.update({source: None})
+
+    return images
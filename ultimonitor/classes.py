@@ -36,8 +36,126 @@ class jobInProgress(object):
 
 class threeDimensionalPrinter(object):
     def __init__(self):
+        self.name = None
+        self.section = None
         self.ip = None
         self.type = None
         self.apiid = None
         self.apikey = None
         self.enabled = True
+
+
+class flowBlock(object):
+    def __init__(self, stamps=None, labels=None, columns=None, tags=None,
+                 meas='temperatures'):
+        """
+        A bunch of temperature samples kept as columns rather than one
+        packet per sample.  stamps are integer milliseconds since the
+        epoch, and columns line up with labels.  masks, if not None, has a
+        boolean array (or None for all of them) per column saying which
+        values to actually store; see deadband.
+        """
+        if stamps is None:
+            stamps = []
+        if labels is None:
+            labels = []
+        if columns is None:
+            columns = []
+        self.stamps = stamps
+        self.labels = labels
+        self.columns = columns
+        self.tags = tags
+        self.meas = meas
+        self.masks = None
+
+    def __len__(self):
+        return len(self.stamps)
+
+
+class printerSnapshot(object):
+    def __init__(self, name=None, printerConfig=None):
+        """
+        One look at a printer, as taken by poller.sharedPoller and handed
+        to every subscriber.  Treat it as read-only; they all share it!
+        """
+        self.name = name
+        self.printer = printerConfig
+        # time.time() when it was taken
+        self.taken = None
+        # printer.statusCheck
+        self.stats = {}
+        # New temperature samples since the last snapshot (a flowBlock)
+        #   and the newest active_hotend_or_state we know of
+        self.flowBlock = None
+        self.flowState = None
+        # printer.systemStats
+        self.sysPkts = []
+
+
+class archiveSettings(object):
+    def __init__(self):
+        self.directory = "./archive"
+        self.flushinterval = 3600.
+        self.compression = "zstd"
+        self.enabled = True
+
+
+class profilingSettings(object):
+    def __init__(self):
+        self.directory = "./profiles"
+        # Profile this many cycles, skipping the first few and then
+        #   taking every so many after that
+        self.cycles = 10
+        self.every = 10
+        self.skip = 1
+        self.enabled = True
+
+
+class metricsSettings(object):
+    def __init__(self):
+        # 0 turns off the /metrics server, and the database reports.
+        #   An empty host serves on every interface
+        self.host = "127.0.0.1"
+        self.port = 9101
+        self.reportinterval = 60.
+        self.enabled = True
+
+
+class monitorState(object):
+    def __init__(self, printerConfig=None):
+        self.printer = printerConfig
+        # Initial parameters to compare against
+        self.pJob = {"JobParameters": {"UUID": 8675309}}
+        self.curProg = -9999
+        self.prevProg = -9999
+        self.notices = None
+        self.lastStatus = None
+        # Polling cadence bookkeeping
+        self.actualStatus = None
+        self.failures = 0
+        self.idleCycles = 0
+        self.idleSince = None
+        self.nextPoll = 0.
+        # Temperature samples since last time, and the job's running stats
+        self.flowTracker = tempFlowTracker(reportGaps=False)
+        self.jobStats = None
+        # leds.ledController, made the first time it's needed
+        self.ledControl = None
+
+
+class tempFlowTracker(object):
+    def __init__(self, maxSamples=800, minSamples=10, margin=1.25,
+                 reportGaps=True):
+        # Printer-uptime timestamp (seconds) of the newest sample ingested
+        self.lastSampleTime = None
+        # time.monotonic() of the last successful fetch
+        self.lastFetch = None
+        # Measured from the data itself; starts at the nominal ~10 Hz
+        self.sampleRate = 10.
+        # Size of the printer's temperature_flow ring buffer
+        self.maxSamples = maxSamples
+        self.minSamples = minSamples
+        self.margin = margin
+        self.reportGaps = reportGaps
+        self.ngaps = 0
+        self.gapSeconds = 0.
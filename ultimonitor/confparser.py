@@ -15,6 +15,8 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+from collections import OrderedDict
+
 import johnnyfive as j5
 from ligmos.workers import confUtils
 from ligmos.utils import confparsers
@@ -24,6 +26,37 @@ from picamhelpers import classes as picamclass
 from . import classes
 
 
+def parsePrinters(eConf):
+    """
+    Collect all of the enabled printerSetup* sections into a dict keyed
+    by printer name.  The name comes from the 'name' key if given, then
+    whatever follows 'printerSetup' in the section name, then the IP.
+    """
+    printers = OrderedDict()
+    for section in eConf:
+        if section.startswith('printerSetup') is False:
+            continue
+
+        pConfig = confUtils.assignConf(eConf[section],
+                                       classes.threeDimensionalPrinter,
+                                       backfill=False)
+        pConfig.section = section
+        if pConfig.name is None:
+            suffix = section[len('printerSetup'):].strip(" -_:.")
+            if suffix != "":
+                pConfig.name = suffix
+            else:
+                pConfig.name = pConfig.ip
+
+        if pConfig.name in printers:
+            print("WARNING: DUPLICATE PRINTER NAME %s; SKIPPING %s" %
+                  (pConfig.name, section))
+        else:
+            printers.update({pConfig.name: pConfig})
+
+    return printers
+
+
 def parseConf(confName):
     """
     Might eventually find a way to make this more generic and just
@@ -34,16 +67,39 @@ def parseConf(confName):
 
     expectedSectionNames = ['printerSetup', 'email',
                             'picam',
-                            'databaseSetup', 'databaseQuery']
+                            'databaseSetup', 'databaseQuery',
+                            'archive', 'metrics', 'profiling']
+
+    # Only there if you want what they turn on, so don't complain
+    optionalSectionNames = ['archive', 'metrics', 'profiling']
 
     returnable = {}
+
+    # Any enabled section starting with printerSetup is a printer; more
+    #   than one of them means we're running in fleet mode
+    printers = parsePrinters(eConf)
+    returnable.update({"printers": printers})
+
     for section in expectedSectionNames:
         # By default we only store the keys specified in the class.
         #   But of course there are exceptions, mainly due to laziness
         #   and deadlines
         backfill = False
         if section == 'printerSetup':
-            clstype = classes.threeDimensionalPrinter
+            # Already parsed above, along with any other printers
+            clstype = None
+            validSect = {section: None}
+            for pConfig in printers.values():
+                if pConfig.section == section:
+                    validSect = {section: pConfig}
+            if validSect[section] is None:
+                if len(printers) > 0:
+                    # Not a problem as long as some other printer was given
+                    validSect = {section: list(printers.values())[0]}
+                else:
+                    print("WARNING: MISSING EXPECTED CONFIGURATION SECTION!")
+                    print("%s NOT FOUND OR NOT ENABLED IN %s" %
+                          (section, confName))
         elif section == 'email':
             clstype = j5.classes.emailSNMP
             backfill = True
@@ -52,6 +108,12 @@ def parseConf(confName):
         elif section == 'databaseSetup':
             clstype = ligmosclass.baseTarget
             backfill = True
+        elif section == 'archive':
+            clstype = classes.archiveSettings
+        elif section == 'metrics':
+            clstype = classes.metricsSettings
+        elif section == 'profiling':
+            clstype = classes.profilingSettings
         else:
             clstype = None
 
@@ -69,9 +131,10 @@ def parseConf(confName):
 
                 validSect = {section: actualConfig}
             except KeyError:
-                print("WARNING: MISSING EXPECTED CONFIGURATION SECTION!")
-                print("%s NOT FOUND OR NOT ENABLED IN %s" %
-                      (section, confName))
+                if section not in optionalSectionNames:
+                    print("WARNING: MISSING EXPECTED CONFIGURATION SECTION!")
+                    print("%s NOT FOUND OR NOT ENABLED IN %s" %
+                          (section, confName))
                 validSect = {section: None}
 
         returnable.update(validSect)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Background database writer, so the collectors never wait on the database.
+
+Packets are handed off to a bounded queue and a worker thread merges them
+into big batches before committing.  If the database is unreachable the
+batches get appended to a local spool file, which is replayed once the
+database starts answering again.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import time
+import queue
+import shutil
+import threading
+
+from . import metrics
+
+
+class batchWriter(threading.Thread):
+    def __init__(self, db, spoolfile="./spool/clausius.spool",
+                 maxQueue=100, batchSize=5000, flushInterval=10.,
+                 retryInterval=30., commit=None):
+        super(batchWriter, self).__init__(name="batchWriter")
+        self.daemon = True
+
+        self.db = db
+        # Anything that takes a list of packets and raises if it failed
+        if commit is None:
+            commit = self.influxCommit
+        self.commit = commit
+
+        self.spoolfile = spoolfile
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.retryInterval = retryInterval
+
+        self.queue = queue.Queue(maxsize=maxQueue)
+        self.spoolLock = threading.Lock()
+        self.halt = threading.Event()
+        self.nextRetry = 0.
+        # The batch the worker is holding right now, in case stop() has
+        #   to give up on it
+        self.inflight = []
+
+        # put/spool happen in the caller's thread, the rest in the worker
+        self.statLock = threading.Lock()
+        self.stats = {"queued": 0, "committed": 0, "batches": 0,
+                      "spooled": 0, "replayed": 0, "errors": 0}
+
+    def count(self, key, n):
+        """
+        """
+        with self.statLock:
+            self.stats[key] += n
+
+    def influxCommit(self, pkts):
+        """
+        """
+        self.db.singleCommit(pkts, table=self.db.tablename, timeprec='ms')
+
+    def put(self, pkts):
+        """
+        Hand off a list of packets. Never blocks; if the queue is full
+        the packets go straight into the spool instead.
+        """
+        if pkts == [] or pkts is None:
+            return
+
+        try:
+            self.queue.put_nowait(pkts)
+            self.count("queued", len(pkts))
+            metrics.queueDepth.set(self.queue.qsize(), queue="database")
+        except queue.Full:
+            print("WARNING: Database writer queue full; spooling to disk")
+            self.spool(pkts)
+
+    def spool(self, pkts):
+        """
+        Append a batch to the end of the spool file, one JSON list per line.
+        """
+        with self.spoolLock:
+            spooldir = os.path.dirname(self.spoolfile)
+            if spooldir != "" and os.path.isdir(spooldir) is False:
+                os.makedirs(spooldir)
+            with open(self.spoolfile, "a") as f:
+                f.write(json.dumps(pkts) + "\n")
+        self.count("spooled", len(pkts))
+        metrics.packetsSpooled.inc(len(pkts))
+
+    def tryCommit(self, pkts):
+        """
+        Returns True if the database took them, otherwise spools them.
+        """
+        try:
+            with metrics.commitLatency.time():
+                self.commit(pkts)
+            self.count("committed", len(pkts))
+            self.count("batches", 1)
+            metrics.packetsCommitted.inc(len(pkts))
+            return True
+        except Exception as e:
+            # Errors seen so far:
+            #   influxdb.exceptions.InfluxDBServerError
+            # (My) error strings caught elsewhere:
+            #   Authentication error!
+            #   INFLUXDB ERROR
+            print("DATABASE COMMIT ERROR! Spooling %d packets" % (len(pkts)))
+            print(str(e))
+            self.count("errors", 1)
+            metrics.errors.inc(kind="commit")
+            self.nextRetry = time.monotonic() + self.retryInterval
+            self.spool(pkts)
+            return False
+
+    def replay(self):
+        """
+        Try to push everything in the spool file into the database.
+
+        The spool is moved aside first so new failures can keep appending
+        to a fresh one; anything that still won't go in is put back.
+        """
+        replayfile = self.spoolfile + ".replaying"
+        with self.spoolLock:
+            # A leftover from a previous run that died mid-replay
+            if os.path.exists(replayfile) is False:
+                if os.path.exists(self.spoolfile) is False:
+                    return
+                os.rename(self.spoolfile, replayfile)
+
+        # Read and sent a chunk at a time, since after a long outage the
+        #   spool can be more than we'd want to hold in memory at once
+        print("Replaying spooled packets from %s" % (replayfile))
+        with open(replayfile, "r") as f:
+            chunk = []
+            chunkLines = []
+            for i, line in enumerate(f):
+                try:
+                    pkts = json.loads(line)
+                except ValueError:
+                    # Probably a half-written line from a crash; nothing
+                    #   to do
+                    print("Skipping corrupt spool line %d" % (i))
+                    continue
+
+                chunk.extend(pkts)
+                chunkLines.append(line)
+                if len(chunk) < self.batchSize:
+                    continue
+
+                if self.replayChunk(chunk) is False:
+                    self.respool(chunkLines, f)
+                    break
+                chunk = []
+                chunkLines = []
+            else:
+                if chunk != [] and self.replayChunk(chunk) is False:
+                    self.respool(chunkLines, f)
+
+        os.remove(replayfile)
+
+    def replayChunk(self, pkts):
+        """
+        Returns True if the database took them
+        """
+        try:
+            with metrics.commitLatency.time():
+                self.commit(pkts)
+            self.count("replayed", len(pkts))
+            metrics.packetsCommitted.inc(len(pkts))
+            return True
+        except Exception as e:
+            print("Database still unavailable; keeping the spool")
+            print(str(e))
+            self.count("errors", 1)
+            metrics.errors.inc(kind="commit")
+            self.nextRetry = time.monotonic() + self.retryInterval
+            return False
+
+    def respool(self, lines, rest):
+        """
+        Put the lines that didn't go in, and whatever's left unread in
+        the open file rest, back in the spool
+        """
+        with self.spoolLock:
+            with open(self.spoolfile, "a") as f:
+                for line in lines:
+                    if line.endswith("\n") is False:
+                        line += "\n"
+                    f.write(line)
+                shutil.copyfileobj(rest, f)
+
+    def run(self):
+        """
+        """
+        batch = []
+        batchStart = None
+        while self.halt.is_set() is False or self.queue.empty() is False:
+            try:
+                pkts = self.queue.get(timeout=1.)
+                metrics.queueDepth.set(self.queue.qsize(), queue="database")
+                if batchStart is None:
+                    batchStart = time.monotonic()
+                batch.extend(pkts)
+                self.inflight = batch
+            except queue.Empty:
+                pass
+
+            if batch != []:
+                full = len(batch) >= self.batchSize
+                stale = time.monotonic() - batchStart >= self.flushInterval
+                if full or stale or self.halt.is_set():
+                    if time.monotonic() < self.nextRetry:
+                        # Don't hammer a database that's already down
+                        self.spool(batch)
+                    elif self.tryCommit(batch) is True:
+                        self.replay()
+                    batch = []
+                    self.inflight = batch
+                    batchStart = None
+            elif time.monotonic() >= self.nextRetry and\
+                    os.path.exists(self.spoolfile):
+                self.nextRetry = time.monotonic() + self.retryInterval
+                self.replay()
+
+        # Shouldn't be anything left, but just in case
+        if batch != []:
+            self.spool(batch)
+            self.inflight = []
+
+    def drain(self):
+        """
+        Spool everything still in the queue, without committing any of it
+        """
+        pkts = []
+        while True:
+            try:
+                pkts.extend(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if pkts != []:
+            self.spool(pkts)
+
+        return len(pkts)
+
+    def stop(self, timeout=60.):
+        """
+        Flush whatever we're holding and wait for the worker to finish.
+        If it's still stuck (on a hung commit, say) after timeout, the
+        queue and the batch it was working on are spooled instead; being
+        a daemon thread, they'd otherwise vanish when we exit.  If that
+        commit does go thru after all, writing the same points again
+        later just overwrites them.
+        """
+        self.halt.set()
+        self.join(timeout=timeout)
+        if self.is_alive():
+            print("WARNING: Database writer didn't finish; spooling the rest")
+            inflight = list(self.inflight)
+            if inflight != []:
+                self.spool(inflight)
+            self.drain()
+
+        with self.statLock:
+            stats = dict(self.stats)
+        print("Database writer stats: %s" % (stats))
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Swinging door compression of the temperature samples.
+
+Sitting idle, the temperatures wander around by a few hundredths of a
+degree for hours, but we'd still store every single 10 Hz sample.  Each
+field gets a deadband, and only the samples needed to redraw it (as
+straight lines between the points that were kept) to within that
+deadband are kept.  Any time a setpoint or the printer state changes,
+that sample and the one before it are kept for every field, so
+transitions are exact; the lines are fit separately on either side of
+them, so the deadband still holds right up to the transition.  The first
+and last samples of every block are always kept too.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import fnmatch
+from collections import OrderedDict
+
+import numpy as np
+
+from . import classes
+
+
+# Largest error allowed for each field (fnmatch patterns); 0 keeps every
+#   change, and fields that don't match anything are kept as-is
+defaultDeadbands = OrderedDict([("temperature*", 0.05),
+                                ("bed_temperature", 0.05),
+                                ("heater*", 0.02),
+                                ("bed_heater", 0.02),
+                                ("target*", 0.),
+                                ("bed_target", 0.),
+                                ("active_hotend_or_state", 0.)])
+
+# Fields whose changes count as transitions
+transitionFields = ["target*", "bed_target", "active_hotend_or_state"]
+
+
+def parseDeadbands(dbstr):
+    """
+    Deadbands from a config string like 'temperature*:0.05, heater*:0.02'
+    """
+    deadbands = OrderedDict()
+    for each in dbstr.split(","):
+        if each.strip() == "":
+            continue
+        pat, val = each.rsplit(":", 1)
+        deadbands.update({pat.strip(): float(val)})
+
+    return deadbands
+
+
+def swingingDoor(times, vals, dev):
+    """
+    Which samples to keep so that straight lines between them are never
+    more than dev away from the rest.  Returns a boolean mask.
+    """
+    nvals = len(vals)
+    keep = np.zeros(nvals, dtype=bool)
+    if nvals == 0:
+        return keep
+    keep[0] = True
+    keep[-1] = True
+
+    # Idle is the usual case; if everything fits within dev, so does a
+    #   straight line from the first sample to the last
+    if np.ptp(vals) <= dev:
+        return keep
+
+    times = times.tolist()
+    vals = vals.tolist()
+
+    # upper/lower are the door; the range of slopes from the anchor that
+    #   stay within dev of every sample since it.  A sample can end the
+    #   line only if the slope to it is still inside the door.
+    anchor = 0
+    upper = np.inf
+    lower = -np.inf
+    for i in range(1, nvals):
+        dt = times[i] - times[anchor]
+        if dt <= 0:
+            continue
+
+        slope = (vals[i] - vals[anchor])/dt
+        if slope > upper or slope < lower:
+            # Can't get here in a straight line, so the previous sample
+            #   has to be kept and it becomes the new anchor
+            anchor = i - 1
+            keep[anchor] = True
+            upper = np.inf
+            lower = -np.inf
+            dt = times[i] - times[anchor]
+            if dt <= 0:
+                continue
+
+        upper = min(upper, (vals[i] + dev - vals[anchor])/dt)
+        lower = max(lower, (vals[i] - dev - vals[anchor])/dt)
+
+    return keep
+
+
+def segmentedDoor(times, vals, dev, breaks=None):
+    """
+    swingingDoor, but the samples where breaks is True are always kept
+    and each stretch between them is fit on its own, so they're the ends
+    of lines rather than tacked on afterwards (which could leave the
+    samples around them up to 2*dev off).  NaN/inf values are never kept
+    since they can't be stored anyways, and are skipped when fitting.
+    """
+    keep = np.zeros(len(vals), dtype=bool)
+    good = np.flatnonzero(np.isfinite(vals))
+    if len(good) == 0:
+        return keep
+    times = times[good]
+    vals = vals[good]
+
+    ends = {0, len(good) - 1}
+    if breaks is not None:
+        ends.update(np.flatnonzero(breaks[good]).tolist())
+    ends = sorted(ends)
+
+    sub = np.zeros(len(good), dtype=bool)
+    sub[ends] = True
+    for first, last in zip(ends[:-1], ends[1:]):
+        if last - first > 1:
+            sub[first:last+1] |= swingingDoor(times[first:last+1],
+                                              vals[first:last+1], dev)
+    keep[good] = sub
+
+    return keep
+
+
+def matchField(label, patterns):
+    """
+    First pattern matching the label, or None
+    """
+    for pat in patterns:
+        if fnmatch.fnmatch(label, pat):
+            return pat
+
+    return None
+
+
+class deadbandCompressor(object):
+    def __init__(self, deadbands=None, transitions=None):
+        if deadbands is None:
+            deadbands = defaultDeadbands
+        if transitions is None:
+            transitions = transitionFields
+        self.deadbands = deadbands
+        self.transitions = transitions
+
+        self.stats = {"blocks": 0, "pointsIn": 0, "pointsOut": 0}
+
+    def compress(self, block):
+        """
+        Returns a new classes.flowBlock sharing block's data, with masks
+        saying which values of each field to keep.  block itself isn't
+        touched, so it's still fine to hand to the archive or whatever.
+        """
+        nsamps = len(block)
+        if nsamps == 0:
+            return block
+
+        stamps = np.asarray(block.stamps)
+        columns = [np.asarray(col) for col in block.columns]
+
+        # Rows where a setpoint/state changed, plus the row before
+        trans = np.zeros(nsamps, dtype=bool)
+        for lab, col in zip(block.labels, columns):
+            if matchField(lab, self.transitions) is not None:
+                changed = np.flatnonzero(np.diff(col) != 0)
+                trans[changed] = True
+                trans[changed + 1] = True
+
+        masks = []
+        for lab, col in zip(block.labels, columns):
+            pat = matchField(lab, self.deadbands.keys())
+            if pat is None:
+                masks.append(None)
+                continue
+            masks.append(segmentedDoor(stamps, col.astype(np.float64),
+                                       self.deadbands[pat], breaks=trans))
+
+        kept = sum([nsamps if m is None else int(m.sum()) for m in masks])
+        self.stats["blocks"] += 1
+        self.stats["pointsIn"] += nsamps*len(columns)
+        self.stats["pointsOut"] += kept
+
+        cblock = classes.flowBlock(block.stamps, block.labels, block.columns,
+                                   tags=block.tags, meas=block.meas)
+        cblock.masks = masks
+
+        return cblock
+
+    def ratio(self):
+        """
+        Points in per point kept, so far
+        """
+        if self.stats["pointsOut"] == 0:
+            return 1.
+
+        return self.stats["pointsIn"]/self.stats["pointsOut"]
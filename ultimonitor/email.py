@@ -15,21 +15,29 @@ from __future__ import division, print_function, absolute_import
 
 import imghdr
 
-import requests.exceptions as rqex
-
 import johnnyfive as j5
-import picamhelpers as pch
 
 from . import cameras
 
 
 def makeEmailUpdate(etype, jobid, jobname, strStat, emailConfig,
-                    picam=None, ulticam=None):
+                    picam=None, ulticam=None, printername=None,
+                    snaps=None):
     """
+    printername is only given in fleet mode, where it's tacked onto the
+    front of the subject so you know which printer is talking to you.
+
+    The camera grabs are started first thing and run in the background
+    while the message is put together; pass in snaps (from
+    cameras.startCaptures) to start them even earlier than that.
     """
     # First make sure we have at least a null string for the
     #   standard footer that is included with every email
     if emailConfig is not None:
+        # Get the cameras going while we do the words
+        if snaps is None:
+            snaps = cameras.startCaptures(picam=picam, ulticam=ulticam)
+
         eFrom = emailConfig.user
         eTo = emailConfig.toaddr
 
@@ -66,6 +74,9 @@ def makeEmailUpdate(etype, jobid, jobname, strStat, emailConfig,
             body += " know you're really done otherwise!"
             body += "\nHere are the final temperature statistics:"
 
+        if printername is not None:
+            subject = "[%s] %s" % (printername, subject)
+
         # Now append the rest of the stuff
         body += "\n\n"
         body += strStat
@@ -76,32 +87,25 @@ def makeEmailUpdate(etype, jobid, jobname, strStat, emailConfig,
         msg = j5.email.constructMail(subject, body, eFrom, eTo,
                                      fromname=emailConfig.fromname)
 
-        # Now grab and attach the images, if they were requested
-        if ulticam is not None:
-            # It's really just an http GET request so it's easy
-            try:
-                img = cameras.grab_ultimaker(ulticam.ip)
-            except rqex.ReadTimeout:
-                print("Ultimaker camera failed to respond!")
-                print("Badness 10000")
-                img = None
-            if img is not None:
-                # Attach it to the message
-                msg.add_attachment(img.content, maintype='image',
-                                   subtype=imghdr.what(None, img.content),
-                                   filename="UltimakerSideView.jpg")
-
-        if picam is not None:
-            snapname = pch.capture.piCamCapture(picam, picam.savepath)
-
-            if snapname is not None:
-                with open(snapname, 'rb') as pisnap:
-                    piimg = pisnap.read()
-                    msg.add_attachment(piimg, maintype='image',
-                                       subtype=imghdr.what(None, piimg),
-                                       filename="UltimakerTopView.png")
-            else:
-                print("PiCamera capture failed!")
+        # Now attach the images, if they were requested and came back
+        images = cameras.collectCaptures(snaps)
+
+        img = images.get("ulticam")
+        if img is not None:
+            msg.add_attachment(img, maintype='image',
+                               subtype=imghdr.what(None, img),
+                               filename="UltimakerSideView.jpg")
+        elif "ulticam" in images:
+            print("Ultimaker camera failed to respond!")
+            print("Badness 10000")
+
+        piimg = images.get("picam")
+        if piimg is not None:
+            msg.add_attachment(piimg, maintype='image',
+                               subtype=imghdr.what(None, piimg),
+                               filename="UltimakerTopView.png")
+        elif "picam" in images:
+            print("PiCamera capture failed!")
     else:
         print("Emails disabled; returning.")
         msg = None
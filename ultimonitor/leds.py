@@ -15,6 +15,7 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+import time
 import colorsys
 
 from . import apitools as api
@@ -72,28 +73,134 @@ def pallettBobRoss():
     return hsvHappyColors
 
 
-def ledCheck(printerConfig, statusColors, statusStr):
+def sameColor(actualLED, desiredLED):
     """
+    (I don't care about the blink property for now)
     """
-    # Checking/setting status LED colors
-    actualLED = api.queryChecker(printerConfig.ip, "printer/led")
-    desiredLED = statusColors[statusStr]
-
-    ledChange = False
-    # I can evantually just collapse this if I explicitly remove
-    #   the 'blink' property in the actualLED dict
-    for cprop in actualLED:
-        # (I don't care about the blink property for now)
-        if cprop != 'blink':
-            if actualLED[cprop] != desiredLED[cprop]:
-                print("%s mismatch!" % (cprop))
-                print("Expected %s but it's currently %s" %
-                      (desiredLED[cprop], actualLED[cprop]))
-                ledChange = True
-                # Bail early because we already know we have to change
-                break
-
-    if ledChange is True:
-        api.setProperty(printerConfig.apiid,
-                        printerConfig.apikey,
-                        printerConfig.ip, "printer/led", desiredLED)
+    for cprop in desiredLED:
+        if cprop != 'blink' and actualLED.get(cprop) != desiredLED[cprop]:
+            return False
+
+    return True
+
+
+class ledController(object):
+    def __init__(self, printerConfig, statusColors, verifyEvery=10,
+                 minInterval=10.):
+        """
+        Keeps track of what the LEDs are (as far as we know) so that they
+        don't have to be read back from the printer every single cycle.
+
+        The printer is only asked every verifyEvery cycles, after anything
+        went wrong, or the first time; someone could've changed them from
+        the touchscreen after all.  Writes are at most one per minInterval
+        seconds, so a status that flickers thru a few states in a row
+        ends up as one write of wherever it landed.  That write goes out
+        from flush() once minInterval is up, so call it every so often
+        from the same thread as update(); the printer's digest auth is
+        only reused within one thread.
+        """
+        self.printer = printerConfig
+        self.statusColors = statusColors
+        self.verifyEvery = verifyEvery
+        self.minInterval = minInterval
+
+        # Last LED state we know the printer actually has
+        self.confirmed = None
+        self.sinceVerify = 0
+        self.lastWrite = None
+
+        # Status whose write was put off, if any
+        self.pending = None
+
+        self.stats = {"updates": 0, "verifies": 0, "writes": 0,
+                      "deferred": 0, "errors": 0}
+
+    def reset(self):
+        """
+        Forget what we think the LEDs are, so they're checked next time
+        """
+        self.confirmed = None
+        self.pending = None
+
+    def verify(self):
+        """
+        """
+        self.stats["verifies"] += 1
+        actualLED = api.queryChecker(self.printer.ip, "printer/led")
+        if actualLED == {}:
+            self.stats["errors"] += 1
+            self.confirmed = None
+        else:
+            self.confirmed = actualLED
+        self.sinceVerify = 0
+
+    def update(self, statusStr):
+        """
+        Make sure the LEDs are showing the color for statusStr.
+        Returns True if they were changed.
+        """
+        self.stats["updates"] += 1
+        desiredLED = self.statusColors[statusStr]
+
+        self.sinceVerify += 1
+        if self.confirmed is None or self.sinceVerify >= self.verifyEvery:
+            self.verify()
+            if self.confirmed is None:
+                # Couldn't even read them, so writing isn't likely to work
+                return False
+
+        if sameColor(self.confirmed, desiredLED) is True:
+            # Anything still waiting to go out is moot now
+            self.pending = None
+            return False
+
+        now = time.monotonic()
+        if self.lastWrite is not None and\
+           now - self.lastWrite < self.minInterval:
+            # flush() sends it once minInterval is up, with whatever the
+            #   status is by then
+            self.stats["deferred"] += 1
+            self.pending = statusStr
+            return False
+
+        self.pending = None
+        return self.write(statusStr, now)
+
+    def flush(self):
+        """
+        Send the write update() put off, if it's time.  Returns True if
+        the LEDs were changed.
+        """
+        if self.pending is None or self.confirmed is None:
+            return False
+
+        now = time.monotonic()
+        if self.lastWrite is not None and\
+           now - self.lastWrite < self.minInterval:
+            return False
+
+        statusStr = self.pending
+        self.pending = None
+        if sameColor(self.confirmed, self.statusColors[statusStr]) is True:
+            return False
+
+        return self.write(statusStr, now)
+
+    def write(self, statusStr, now):
+        """
+        """
+        desiredLED = self.statusColors[statusStr]
+        print("LEDs should be %s for %s" % (desiredLED, statusStr))
+        self.lastWrite = now
+        good = api.setProperty(self.printer.apiid,
+                               self.printer.apikey,
+                               self.printer.ip, "printer/led", desiredLED)
+        if good is True:
+            self.stats["writes"] += 1
+            self.confirmed = dict(desiredLED)
+        else:
+            self.stats["errors"] += 1
+            self.confirmed = None
+
+        return good
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""InfluxDB line protocol, written directly.
+
+Rather than making a dict for every temperature sample and having the
+influx client serialize them all over again, the columns from tempFlow
+get turned straight into line protocol and POSTed to /write in gzipped
+chunks.  Timestamps are always milliseconds.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import gzip
+
+import numpy as np
+import requests
+
+
+def escapeName(name):
+    """
+    Measurement names; commas and spaces need escaping
+    """
+    return name.replace(",", r"\,").replace(" ", r"\ ")
+
+
+def escapeKey(key):
+    """
+    Tag keys, tag values, and field keys; commas, equals and spaces
+    """
+    key = str(key)
+
+    return key.replace(",", r"\,").replace("=", r"\=").replace(" ", r"\ ")
+
+
+def formatValue(val):
+    """
+    A single field value, typed the way influx wants it
+    """
+    if isinstance(val, (bool, np.bool_)):
+        fval = "true" if val else "false"
+    elif isinstance(val, (int, np.integer)):
+        fval = "%di" % (val)
+    elif isinstance(val, (float, np.floating)):
+        fval = repr(float(val))
+    else:
+        fval = '"%s"' % (str(val).replace("\\", "\\\\").replace('"', r'\"'))
+
+    return fval
+
+
+def seriesKey(meas, tags=None):
+    """
+    The measurement,tag=value,... bit at the start of each line
+    """
+    skey = escapeName(meas)
+    if tags:
+        # Sorted, like influx would do it anyways
+        for tkey in sorted(tags):
+            skey += ",%s=%s" % (escapeKey(tkey), escapeKey(tags[tkey]))
+
+    return skey
+
+
+def formatColumn(col):
+    """
+    A whole column to strings at once.  .tolist() gives native python
+    types so repr() gets the shortest float that round-trips.
+    """
+    if col.dtype.kind == 'f':
+        return [repr(v) for v in col.tolist()]
+    elif col.dtype.kind in 'iu':
+        return ["%di" % (v) for v in col.tolist()]
+    else:
+        return [formatValue(v) for v in col.tolist()]
+
+
+def finiteMasks(columns, masks=None):
+    """
+    NaN and inf can't be written at all, so fold them into the masks
+    for any float columns that have them.  None if nothing's masked.
+    """
+    if masks is None:
+        masks = [None]*len(columns)
+
+    newmasks = []
+    for col, mask in zip(columns, masks):
+        col = np.asarray(col)
+        if col.dtype.kind == 'f':
+            good = np.isfinite(col)
+            if not good.all():
+                mask = good if mask is None else (np.asarray(mask) & good)
+        newmasks.append(mask)
+
+    if all([mask is None for mask in newmasks]):
+        return None
+
+    return newmasks
+
+
+def encodeColumns(meas, stamps, labels, columns, tags=None, masks=None):
+    """
+    Line protocol for a block of samples given as columns (like
+    printer.flowColumns makes), one line per sample.  stamps must be
+    integer milliseconds since the epoch.
+
+    masks (one boolean array, or None for everything, per column) leave
+    out values; a sample with nothing left in it gets no line at all.
+    NaN and inf values are always left out.
+    """
+    if len(stamps) == 0:
+        return []
+
+    masks = finiteMasks(columns, masks)
+
+    prefix = seriesKey(meas, tags) + " "
+    fkeys = [escapeKey(lab) + "=" for lab in labels]
+    strcols = [[fkey + v for v in formatColumn(np.asarray(col))]
+               for fkey, col in zip(fkeys, columns)]
+    stamps = [" %d" % (ts) for ts in np.asarray(stamps).tolist()]
+
+    if masks is None:
+        return [prefix + ",".join(row) + ts
+                for row, ts in zip(zip(*strcols), stamps)]
+
+    for i, mask in enumerate(masks):
+        if mask is not None:
+            strcols[i] = [v if k else None
+                          for v, k in zip(strcols[i], mask.tolist())]
+
+    lines = []
+    for row, ts in zip(zip(*strcols), stamps):
+        row = [v for v in row if v is not None]
+        if row != []:
+            lines.append(prefix + ",".join(row) + ts)
+
+    return lines
+
+
+def encodeBlock(block):
+    """
+    encodeColumns for a classes.flowBlock
+    """
+    return encodeColumns(block.meas, block.stamps, block.labels,
+                         block.columns, tags=block.tags, masks=block.masks)
+
+
+def encodePackets(pkts):
+    """
+    Line protocol for regular old packets (dicts), like systemStats makes.
+    Packets without a time get none, so the database uses its own.
+    NaN and inf fields are left out, and so are packets with no fields.
+    """
+    lines = []
+    for pkt in pkts:
+        fields = ",".join(["%s=%s" % (escapeKey(fkey), formatValue(fval))
+                           for fkey, fval in pkt['fields'].items()
+                           if not (isinstance(fval, (float, np.floating)) and
+                                   not np.isfinite(fval))])
+        if fields == "":
+            continue
+        line = seriesKey(pkt['measurement'], pkt.get('tags')) + " " + fields
+        if pkt.get('time') is not None:
+            line += " %d" % (pkt['time'])
+        lines.append(line)
+
+    return lines
+
+
+def chunkBodies(lines, chunkSize=5000, compress=True):
+    """
+    Yield request bodies of (at most) chunkSize lines each, gzipped if
+    compress is True.
+    """
+    for i in range(0, len(lines), chunkSize):
+        body = "\n".join(lines[i:i+chunkSize]).encode("utf-8")
+        if compress is True:
+            body = gzip.compress(body, compresslevel=5)
+        yield body
+
+
+class lineWriter(object):
+    def __init__(self, host, port=8086, dbname=None, user=None,
+                 password=None, chunkSize=5000, compress=True, timeout=30.,
+                 https=False):
+        """
+        Writes lists of line protocol strings to the /write endpoint;
+        commit() is meant to be handed to dbwriter.batchWriter.
+        """
+        if https is True:
+            proto = "https"
+        else:
+            proto = "http"
+        self.url = "%s://%s:%s/write" % (proto, host, port)
+        self.params = {"db": dbname, "precision": "ms"}
+
+        self.session = requests.Session()
+        if user is not None and str(user) != "None":
+            self.session.auth = (user, password)
+        self.headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if compress is True:
+            self.headers.update({"Content-Encoding": "gzip"})
+
+        self.chunkSize = chunkSize
+        self.compress = compress
+        self.timeout = timeout
+
+        self.stats = {"lines": 0, "requests": 0, "bytes": 0}
+
+    def commit(self, lines):
+        """
+        POST all the lines, chunkSize at a time.  Raises if any chunk
+        doesn't go in; the ones before it already did, but writing the
+        same points again just overwrites them so it's safe to retry.
+        """
+        # Spool files from before have packets (dicts) rather than lines
+        if any([isinstance(line, dict) for line in lines]):
+            lines = [line for line in lines if not isinstance(line, dict)] + \
+                encodePackets([line for line in lines
+                               if isinstance(line, dict)])
+
+        for body in chunkBodies(lines, chunkSize=self.chunkSize,
+                                compress=self.compress):
+            resp = self.session.post(self.url, params=self.params,
+                                     data=body, headers=self.headers,
+                                     timeout=self.timeout)
+            if resp.status_code != 204:
+                raise requests.HTTPError("INFLUXDB ERROR %d: %s" %
+                                         (resp.status_code, resp.text))
+            self.stats["requests"] += 1
+            self.stats["bytes"] += len(body)
+
+        self.stats["lines"] += len(lines)
+
+    def close(self):
+        """
+        """
+        self.session.close()
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Counters, gauges and histograms for figuring out where the time goes.
+
+All the metrics live in this one process-wide registry and are updated
+right where things happen (apitools, dbwriter, notifier, cameras and the
+loops themselves).  With the [metrics] section enabled they're served up
+as Prometheus style text at http://host:port/metrics and/or written to
+the database every reportinterval seconds, one measurement per metric.
+
+Histograms are cumulative buckets plus a sum and count, so they're cheap
+to update and p50/p95 can still be estimated from them afterwards.  The
+ones written to the database are just for what was observed since the
+previous report, so a slow spell shows up rather than being averaged
+away over the whole run.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Seconds; covers a quick cached API reply up to a wedged SMTP server
+defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.,
+                  10., 30., 60.)
+
+_registry = OrderedDict()
+_registryLock = threading.Lock()
+
+
+def labelKey(labels):
+    """
+    Labels as something hashable, always in the same order
+    """
+    return tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+
+def formatLabels(lkey, extra=None):
+    """
+    {a="b",c="d"} for the exposition; extra is another (key, value)
+    """
+    pairs = list(lkey)
+    if extra is not None:
+        pairs.append(extra)
+    if pairs == []:
+        return ""
+
+    esc = [(k, v.replace("\\", r"\\").replace('"', r'\"').replace("\n",
+                                                                  r"\n"))
+           for k, v in pairs]
+
+    return "{" + ",".join(['%s="%s"' % (k, v) for k, v in esc]) + "}"
+
+
+def formatNumber(val):
+    """
+    """
+    if val == float("inf"):
+        return "+Inf"
+
+    return repr(float(val))
+
+
+class counter(object):
+    kind = "counter"
+
+    def __init__(self, name, helpstr=""):
+        """
+        Only ever goes up
+        """
+        self.name = name
+        self.helpstr = helpstr
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+
+    def inc(self, amount=1., **labels):
+        """
+        """
+        lkey = labelKey(labels)
+        with self.lock:
+            self.values[lkey] = self.values.get(lkey, 0.) + amount
+
+    def value(self, **labels):
+        """
+        """
+        with self.lock:
+            return self.values.get(labelKey(labels), 0.)
+
+    def samples(self):
+        """
+        (suffix, label key, extra label, value) for the exposition
+        """
+        with self.lock:
+            return [("", lkey, None, val) for lkey, val in self.values.items()]
+
+    def fields(self):
+        """
+        (label key, fields) for the database
+        """
+        with self.lock:
+            return [(lkey, {"value": float(val)})
+                    for lkey, val in self.values.items()]
+
+    def reset(self):
+        """
+        """
+        with self.lock:
+            self.values = OrderedDict()
+
+
+class gauge(counter):
+    kind = "gauge"
+
+    def set(self, val, **labels):
+        """
+        Goes wherever it's told
+        """
+        with self.lock:
+            self.values[labelKey(labels)] = val
+
+
+class histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, helpstr="", buckets=defaultBuckets):
+        """
+        buckets are the upper edges; +Inf is tacked on at the end
+        """
+        self.name = name
+        self.helpstr = helpstr
+        self.buckets = list(buckets) + [float("inf")]
+        self.lock = threading.Lock()
+        # label key: [bucket counts, sum, count]
+        self.values = OrderedDict()
+        # The same, as of the last fields() call
+        self.reported = {}
+
+    def observe(self, val, **labels):
+        """
+        """
+        lkey = labelKey(labels)
+        with self.lock:
+            entry = self.values.get(lkey)
+            if entry is None:
+                entry = [[0]*len(self.buckets), 0., 0]
+                self.values.update({lkey: entry})
+            for i, edge in enumerate(self.buckets):
+                if val <= edge:
+                    entry[0][i] += 1
+                    break
+            entry[1] += val
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        with hist.time(what="thing"):
+            ...
+        Observed even if it raises, since slow failures are interesting
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def quantile(self, q, counts, total):
+        """
+        Estimate the q-th quantile by interpolating within the bucket it
+        falls in, the same way Prometheus' histogram_quantile does.
+        """
+        if total == 0:
+            return None
+
+        rank = q*total
+        seen = 0
+        lower = 0.
+        for edge, cnt in zip(self.buckets, counts):
+            if seen + cnt >= rank and cnt > 0:
+                if edge == float("inf"):
+                    # No upper edge to go towards; best we can say
+                    return lower
+                return lower + (edge - lower)*(rank - seen)/cnt
+            seen += cnt
+            lower = edge
+
+        return lower
+
+    def totals(self):
+        """
+        (count, sum) over every label combination
+        """
+        with self.lock:
+            return (sum([v[2] for v in self.values.values()]),
+                    sum([v[1] for v in self.values.values()]))
+
+    def samples(self):
+        """
+        """
+        out = []
+        with self.lock:
+            for lkey, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for edge, cnt in zip(self.buckets, counts):
+                    cumulative += cnt
+                    out.append(("_bucket", lkey, ("le", formatNumber(edge)),
+                                cumulative))
+                out.append(("_sum", lkey, None, total))
+                out.append(("_count", lkey, None, count))
+
+        return out
+
+    def fields(self):
+        """
+        count, sum, p50 and p95 of what was observed since the last time
+        this was called
+        """
+        out = []
+        with self.lock:
+            for lkey, (counts, total, count) in self.values.items():
+                last = self.reported.get(lkey)
+                if last is None:
+                    last = [[0]*len(self.buckets), 0., 0]
+                dcounts = [c - lc for c, lc in zip(counts, last[0])]
+                dcount = count - last[2]
+                flds = {"count": dcount, "sum": float(total - last[1])}
+                for q, fname in [(0.5, "p50"), (0.95, "p95")]:
+                    est = self.quantile(q, dcounts, dcount)
+                    if est is not None:
+                        flds.update({fname: float(est)})
+                out.append((lkey, flds))
+                self.reported.update({lkey: [list(counts), total, count]})
+
+        return out
+
+    def reset(self):
+        """
+        """
+        with self.lock:
+            self.values = OrderedDict()
+            self.reported = {}
+
+
+def register(metric):
+    """
+    Add a metric to the registry, or hand back the one already there
+    with the same name.
+    """
+    with _registryLock:
+        if metric.name in _registry:
+            return _registry[metric.name]
+        _registry.update({metric.name: metric})
+
+    return metric
+
+
+# Everything we keep track of.  Labels are added where they're used
+apiLatency = register(histogram("ultimonitor_api_request_seconds",
+                                "Printer API requests, by printer, method "
+                                "and endpoint"))
+cycleDuration = register(histogram("ultimonitor_cycle_seconds",
+                                   "One trip around a poll loop, by loop",
+                                   buckets=(0.1, 0.25, 0.5, 1., 2.5, 5.,
+                                            10., 20., 30., 60., 120.)))
+packetsProduced = register(counter("ultimonitor_points_produced_total",
+                                   "Points handed to the sinks, by "
+                                   "measurement"))
+packetsCommitted = register(counter("ultimonitor_points_committed_total",
+                                    "Points the database took"))
+packetsSpooled = register(counter("ultimonitor_points_spooled_total",
+                                  "Points spooled to disk instead"))
+commitLatency = register(histogram("ultimonitor_commit_seconds",
+                                   "Database commits, successful or not"))
+emailLatency = register(histogram("ultimonitor_email_seconds",
+                                  "Sending one email to the SMTP server"))
+cameraLatency = register(histogram("ultimonitor_camera_seconds",
+                                   "Grabbing one image, by camera"))
+errors = register(counter("ultimonitor_errors_total",
+                          "Things that went wrong, by kind"))
+queueDepth = register(gauge("ultimonitor_queue_depth",
+                            "Items waiting in background queues"))
+
+
+def exposition():
+    """
+    Everything in the registry in the Prometheus text format
+    """
+    with _registryLock:
+        metrics = list(_registry.values())
+
+    lines = []
+    for metric in metrics:
+        lines.append("# HELP %s %s" % (metric.name, metric.helpstr))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for suffix, lkey, extra, val in metric.samples():
+            lines.append("%s%s%s %s" % (metric.name, suffix,
+                                        formatLabels(lkey, extra),
+                                        formatNumber(val)))
+
+    return "\n".join(lines) + "\n"
+
+
+def reportPackets(tags=None):
+    """
+    Everything in the registry as packets for the sinks; one measurement
+    per metric, with its labels (and tags) as tags.
+    """
+    with _registryLock:
+        metrics = list(_registry.values())
+
+    now = int(time.time()*1e3)
+    pkts = []
+    for metric in metrics:
+        for lkey, flds in metric.fields():
+            ptags = dict(lkey)
+            if tags is not None:
+                ptags.update(tags)
+            pkts.append({"measurement": metric.name, "time": now,
+                         "tags": ptags, "fields": flds})
+
+    return pkts
+
+
+def resetMetrics():
+    """
+    Forget all the values, but keep the metrics themselves
+    """
+    with _registryLock:
+        metrics = list(_registry.values())
+
+    for metric in metrics:
+        metric.reset()
+
+
+class metricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        """
+        """
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+
+        body = exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        """
+        Getting scraped every 15 seconds isn't news
+        """
+        pass
+
+
+def startServer(port=9101, host="127.0.0.1"):
+    """
+    Serve the exposition at /metrics in a background thread.  Returns the
+    server; call .shutdown() on it when done.  Only local by default;
+    host "" listens on every interface.
+    """
+    server = ThreadingHTTPServer((host, int(port)), metricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    print("Serving metrics at http://%s:%d/metrics" %
+          (host if host != "" else "0.0.0.0", server.server_address[1]))
+
+    return server
+
+
+class metricsReporter(threading.Thread):
+    def __init__(self, outputs, interval=60., tags=None):
+        """
+        Every interval seconds, hand reportPackets to each of the sinks
+        in outputs (see ultimonitor.sinks).
+        """
+        super(metricsReporter, self).__init__(name="metricsReporter")
+        self.daemon = True
+
+        self.outputs = outputs
+        self.interval = interval
+        self.tags = tags
+        self.halt = threading.Event()
+        self.reports = 0
+
+    def report(self):
+        """
+        """
+        pkts = reportPackets(tags=self.tags)
+        for sink in self.outputs:
+            sink.put(pkts)
+        self.reports += 1
+
+    def run(self):
+        """
+        """
+        while self.halt.wait(self.interval) is False:
+            try:
+                self.report()
+            except Exception as err:
+                print("METRICS REPORT FAILED!")
+                print(str(err))
+
+    def stop(self, timeout=10.):
+        """
+        One last report on the way out, so the final numbers make it in
+        """
+        self.halt.set()
+        self.join(timeout=timeout)
+        try:
+            self.report()
+        except Exception as err:
+            print("METRICS REPORT FAILED!")
+            print(str(err))
+
+
+def startMetrics(mset, outputs=None, tags=None):
+    """
+    Start whatever the [metrics] section (a classes.metricsSettings) asks
+    for; the server if port isn't 0, and the reporter if reportinterval
+    isn't 0 and there's somewhere to send them.  Returns them both, with
+    None for the ones not running.
+    """
+    server = None
+    reporter = None
+    if mset is None:
+        return server, reporter
+
+    host = mset.host
+    if host is None or str(host) == "None":
+        host = "127.0.0.1"
+    port = int(mset.port)
+    if port != 0:
+        try:
+            server = startServer(port=port, host=host)
+        except OSError as err:
+            # Something else is on that port; carry on without it
+            print("METRICS SERVER FAILED TO START ON PORT %d!" % (port))
+            print(str(err))
+
+    interval = float(mset.reportinterval)
+    if interval > 0 and outputs is not None:
+        reporter = metricsReporter(outputs, interval=interval, tags=tags)
+        reporter.start()
+
+    return server, reporter
+
+
+def stopMetrics(server, reporter):
+    """
+    """
+    if reporter is not None:
+        reporter.stop()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
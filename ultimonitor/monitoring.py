@@ -17,43 +17,85 @@ from __future__ import division, print_function, absolute_import
 
 import time
 from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-import johnnyfive as j5
+import numpy as np
 
-from . import email as emailHelper
-from . import leds, printer, classes
+from . import apitools as api
+from .notifier import notificationWorker
+from . import leds, printer, classes, tempstats, metrics, profiling
 
 
-def notificationTree(stats, actualStatus, notices, curProg, prevProg):
+def stateMaps():
     """
+    Returns the map of temperature_flow state codes to words, and the map
+    of those words (plus a few) to LED colors.
+    """
+    # These are our color options, given as a dict of color names and their
+    #   associated HSV (!NOT RGB!) properties which are actually sent to the
+    #   case LEDs via the printer API
+    hsvCols = leds.pallettBobRoss()
+
+    # The numerical codes are seen in "printer/diagnostics/temperature_flow/"
+    #   See also: griffin/printer/drivers/marlin/applicationLayer.py
+    #
+    # When printing, 0 denotes hotend #1 and 1 denotes hotend #2. We
+    #   can just simplify things and call both "printing" for now
+    # TODO: Figure out if there are additional valid states in 2 thru 9
+    flowStateMap = {0: 'printing',
+                    1: 'printing',
+                    10: 'idle',
+                    11: 'pausing',
+                    12: 'paused',
+                    13: 'resuming',
+                    14: 'pre_print',
+                    15: 'post_print',
+                    16: 'wait_cleanup',
+                    17: 'wait_user_action'}
+
+    # NOTE: There are 3 additional states (error, maintenance, booting) that
+    #   aren't captured in the flowStateMap since they originate elsewhere
+    #   in the Ultimaker griffin engine
+    statusColors = {"idle": hsvCols["PrussianBlue"],
+                    "printing": hsvCols["TitaniumWhite"],
+                    "pausing": hsvCols["IndianYellow"],
+                    "paused": hsvCols["CadmiumYellow"],
+                    "resuming": hsvCols["IndianYellow"],
+                    "pre_print": hsvCols["SapGreen"],
+                    "post_print": hsvCols["BrightBlue"],
+                    "wait_cleanup": hsvCols["BrightGreen"],
+                    "wait_user_action": hsvCols["BrightRed"],
+                    "error": hsvCols["BrightRed"],
+                    "maintenance": hsvCols["CadmiumYellow"],
+                    "booting": hsvCols["PhthaloGreen"]}
+
+    return flowStateMap, statusColors
+
+
+def notificationTree(stats, actualStatus, notices, curProg, prevProg,
+                     jobStats=None):
+    """
+    jobStats is the tempstats.jobTempStats for this job, which is where
+    the temperature performance numbers in the emails come from.
     """
     if notices['preamble'] is False:
         print("Collecting print setup information ...")
         strStatus = printer.formatStatus(stats)
         notices['preamble'] = True
 
-    retTemps = {}
-
     emailFlag = False
     noteKey = None
     deets = ""
 
-    #
-    # Grab our temperature metrics from the storage
-    #   database that was specified
-    #
-    # retTemps = printer.tempStats(cDict['printer'].ip)
-    # tstats, dstats = printer.collapseStats(retTemps,
-    #                                        tstats)
-    # deets = printer.formatStatus(dstats)
-    #
-    if retTemps == {}:
-        deets = "Unfortunately, the database was unavailable"
-        deets += " when temperature statistics were queried."
-        deets += "\n\nThat's probably not a good thing, but "
-        deets += "it could just mean that the network "
-        deets += "was interrupted unexpectedly. You should "
-        deets += "probably check on stuff!"
+    # Temperature metrics, collected as we went along
+    if jobStats is not None and jobStats.nsamples() > 0:
+        deets = printer.formatStatus(jobStats.summary())
+    else:
+        deets = "Unfortunately, no temperature samples have been"
+        deets += " collected for this job yet."
+        deets += "\n\nThat could just mean that I only just started"
+        deets += " watching, or that the printer wasn't answering."
+        deets += " You should probably check on stuff!"
 
     # Decision tree time!
     # Skip notifications if we already see a done print at startup
@@ -130,10 +172,6 @@ def notificationTree(stats, actualStatus, notices, curProg, prevProg):
             #     print("Skipping notification for job completion")
             #     emailFlag = False
 
-            # This state also means that we have no temp. stats.
-            #   to report, so set the details string empty
-            deets = ""
-
     return emailFlag, noteKey, deets
 
 
@@ -176,21 +214,320 @@ def idbTempQuery():
     pass
 
 
+def flowStateOf(flowBlock):
+    """
+    The newest active_hotend_or_state in a classes.flowBlock, or None.
+    Samples where it didn't come thru (NaN) are skipped.
+    """
+    if flowBlock is None or len(flowBlock) == 0 or\
+       'active_hotend_or_state' not in flowBlock.labels:
+        return None
+
+    col = flowBlock.columns[flowBlock.labels.index('active_hotend_or_state')]
+    col = np.asarray(col)
+    if col.dtype.kind == 'f':
+        col = col[np.isfinite(col)]
+        if len(col) == 0:
+            return None
+
+    return int(col[-1])
+
+
+def actualState(stats, flowState, statusMap):
+    """
+    We have to do a check in two parts, because some states are from
+    the lower level printer firmware and some states are from the
+    higher level Ultimaker software
+    """
+    if stats['Status'] in ['error', 'maintenance', 'booting']:
+        actualStatus = stats['Status']
+    elif flowState is not None:
+        # Use the lower level status since it's more detailed
+        actualStatus = statusMap.get(flowState, "unknown")
+    else:
+        actualStatus = "unknown"
+
+    return actualStatus
+
+
+def monitorCycle(mstate, statusMap, statusColors, notifier,
+                 email=None, picam=None, ulticam=None, printername=None):
+    """
+    One trip thru the monitoring loop for the printer in mstate.
+
+    All the state that needs to survive between cycles (the job we're
+    watching, notices sent, progress) lives in mstate so that a bunch of
+    printers can be handled side by side.  Emails are handed off to
+    notifier, a notifier.notificationWorker.
+    """
+    printerip = mstate.printer.ip
+    cycleStart = time.monotonic()
+
+    # Do a check of everything we care about
+    stats = printer.statusCheck(printerip)
+
+    flowBlock = None
+    if stats != {} and stats['Status'] != "UNKNOWN":
+        # The "printer/status" endpoint is pretty terse, but the
+        #   "printer/diagnostics/temperature_flow" endpoint is both
+        #   highly detailed (sampled ~10 Hz) and highly specific
+        #   with it's "active_hotend_or_state" parameter. Use that.
+
+        # This returns (as columns) everything new since last time;
+        #   the newest one has the state and the lot of them go into
+        #   the job's temperature stats
+        flowBlock = printer.tempFlow(printerip, tracker=mstate.flowTracker,
+                                     asBlock=True)
+    else:
+        metrics.errors.inc(kind="unreachable")
+
+    stats = processStatus(mstate, stats, flowBlock, statusMap, statusColors,
+                          notifier, email=email, picam=picam, ulticam=ulticam,
+                          printername=printername)
+    metrics.cycleDuration.observe(time.monotonic() - cycleStart,
+                                  loop="monitor")
+
+    return stats
+
+
+def processStatus(mstate, stats, flowBlock, statusMap, statusColors,
+                  notifier, email=None, picam=None, ulticam=None,
+                  printername=None, setLEDs=True, flowState=None):
+    """
+    Everything monitorCycle does once it has the status and the new
+    temperature samples.  Split out so that poller.sharedPoller can hand
+    over snapshots it already took; it has its own LED subscriber,
+    hence setLEDs.  It also already knows the flow state (even when a
+    snapshot has no new samples), so that can be given as flowState
+    instead of being worked out from flowBlock.
+    """
+    printerip = mstate.printer.ip
+
+    # Did our status check work? If the printer didn't answer at all,
+    #   the status will come back as UNKNOWN
+    if stats != {} and stats['Status'] != "UNKNOWN":
+        mstate.failures = 0
+
+        # Anything we've cached about the printer could have changed
+        #   (like a new bed or hotend for a new job) so start fresh
+        if mstate.lastStatus is not None and\
+           stats['Status'] != mstate.lastStatus:
+            print("Printer state changed; clearing cached printer info")
+            api.invalidateCache(printerip)
+        mstate.lastStatus = stats['Status']
+
+        if flowState is None:
+            flowState = flowStateOf(flowBlock)
+        if flowState is not None:
+            flowStateWords = statusMap.get(flowState, "unknown")
+        else:
+            flowStateWords = "unknown"
+        print()
+        if printername is not None:
+            print("Printer: %s" % (printername))
+        print("flowState: %s" % (flowStateWords))
+        print("/printer/state: %s" % (stats['Status']))
+        # If we're not actually printing, it won't be possible to get
+        #   the state from the print_job endpoint because it'll be blank!
+        if stats['JobParameters'] != {}:
+            printjobState = stats['JobParameters']['JobState']
+            print("/print_job/state: %s" % (printjobState))
+        print()
+
+        actualStatus = actualState(stats, flowState, statusMap)
+        mstate.actualStatus = actualStatus
+
+        # Only attempt to change the LED colors if we have a valid status
+        if setLEDs is True and actualStatus.lower() != 'unknown':
+            # NOTE: Pass in the entire printer configuration since
+            #   this is a PUT action and needs API authentication.
+            #   Use actualStatus to capture the full range of states
+            if mstate.ledControl is None:
+                mstate.ledControl = leds.ledController(mstate.printer,
+                                                       statusColors)
+            mstate.ledControl.update(actualStatus)
+
+        # Trigger on the high level status here so I don't have to deal
+        #   *all* the possibilities of the low level one
+        if stats['Status'] == 'printing':
+            # Check if this job is the same as the last job we saw
+            mstate.pJob, mstate.notices = checkJob(stats, mstate.pJob,
+                                                   mstate.notices)
+
+            # New job, new statistics
+            jobuuid = stats['JobParameters']['UUID']
+            if mstate.jobStats is None:
+                mstate.jobStats = tempstats.jobTempStats(jobuuid)
+            elif mstate.jobStats.uuid != jobuuid:
+                mstate.jobStats.reset(jobuuid)
+            if flowBlock is not None:
+                mstate.jobStats.updateBlock(flowBlock)
+
+            mstate.curProg = stats['JobParameters']['Progress']
+            curJobName = stats['JobParameters']['Name']
+            # Just take the first part of the UUID so it's not so long...
+            curJobID = stats['JobParameters']['UUID'].split("-")[0]
+
+            # Only grab info when we're really printing.
+            #   'pre_print' is too early and duration will be missing
+            deets = None
+            noteKey = None
+            emailFlag = False
+
+            if actualStatus.lower() in ['printing',
+                                        'pausing', 'paused', 'resuming',
+                                        'post_print', 'wait_cleanup']:
+                emailFlag, noteKey, deets = notificationTree(stats,
+                                                             actualStatus,
+                                                             mstate.notices,
+                                                             mstate.curProg,
+                                                             mstate.prevProg,
+                                                             mstate.jobStats)
+
+            # Now check the states that we could have gotten into
+            if noteKey is not None:
+                mstate.notices[noteKey] = True
+                print(deets)
+                if emailFlag is True:
+                    print(noteKey)
+                    print(mstate.notices[noteKey])
+                    print(mstate.notices)
+                    # Built and sent in the background, so a slow camera
+                    #   or SMTP server can't hold us up here
+                    notifier.submit(noteKey, curJobID, curJobName,
+                                    deets, email,
+                                    picam=picam, ulticam=ulticam,
+                                    printername=printername)
+                    print("Notification queue: %s" % (notifier.stats()))
+
+            # Need this to set the LED color appropriately
+            actualStatus = stats['JobParameters']['JobState']
+
+            # Update the progress since we're printing
+            print("Previous Progress: ", mstate.prevProg)
+            print("Current Progress: ", mstate.curProg)
+            mstate.prevProg = mstate.curProg
+    else:
+        mstate.failures += 1
+        # Whatever the LEDs were, it's anyone's guess after this
+        if mstate.ledControl is not None:
+            mstate.ledControl.reset()
+        mstate.actualStatus = None
+        if printername is not None:
+            print("PRINTER %s UNREACHABLE!" % (printername))
+        else:
+            print("PRINTER UNREACHABLE!")
+
+    return stats
+
+
+def pollInterval(stats, mstate, loopInterval=30.,
+                 minInterval=5., maxInterval=300., idleAfter=1800.):
+    """
+    How long to wait before looking at this printer again.
+
+    While printing, we estimate when the next notification threshold will
+    be crossed (from the elapsed/total time and progress) and aim to look
+    shortly after it rather than up to a whole loopInterval late.  The
+    in-between states (heating, pausing, finishing) get polled quickly,
+    and anything waiting on a human (paused, wait_user_action,
+    wait_cleanup) at the usual loopInterval.  Only an unreachable printer,
+    or one that's been idle for idleAfter seconds, gets backed off more
+    each cycle.
+    """
+    # Unreachable; back off exponentially
+    if mstate.actualStatus is None:
+        return min(loopInterval*2.**mstate.failures, maxInterval)
+
+    status = mstate.actualStatus.lower()
+
+    if status != 'idle':
+        mstate.idleCycles = 0
+        mstate.idleSince = None
+
+    if status in ['pre_print', 'pausing', 'resuming', 'post_print']:
+        return minInterval
+
+    if status == 'printing' and stats['JobParameters'] != {}:
+        jp = stats['JobParameters']
+
+        # These are the thresholds notificationTree cares about
+        thresholds = [('done10', 10.), ('done50', 50.), ('done90', 90.),
+                      ('end', 100.)]
+        nextThresh = None
+        for key, thresh in thresholds:
+            if mstate.notices is None or mstate.notices.get(key) is False:
+                if thresh > jp['Progress']:
+                    nextThresh = thresh
+                    break
+        if nextThresh is None:
+            return loopInterval
+
+        # Seconds per percent; prefer the printer's own estimate of
+        #   the total, but fall back to how fast it's been going so far
+        if jp['EstimatedDuration'] > 0:
+            secPerPct = jp['EstimatedDuration']*3600./100.
+        elif jp['Progress'] > 0 and jp['ElapsedTime'] > 0:
+            secPerPct = jp['ElapsedTime']*3600./jp['Progress']
+        else:
+            return loopInterval
+
+        untilThresh = (nextThresh - jp['Progress'])*secPerPct
+
+        # Halve the remaining time each look, so we land just past it
+        return max(min(untilThresh/2., loopInterval), minInterval)
+
+    # Waiting on a human, or something else that could change any time
+    if status != 'idle':
+        return loopInterval
+
+    # Just finished (or just started up); someone might be about to start
+    #   another job, and pre_print doesn't last long
+    now = time.monotonic()
+    if mstate.idleSince is None:
+        mstate.idleSince = now
+    if now - mstate.idleSince < idleAfter:
+        return loopInterval
+
+    # Nobody's touched it in a while
+    mstate.idleCycles += 1
+    return min(loopInterval*1.5**(mstate.idleCycles - 1), maxInterval)
+
+
+def sleepUntil(runner, deadline):
+    """
+    Sleep until the given time.monotonic() deadline, in small chunks so
+    we notice if we're asked to stop.  Sleeping to a deadline rather than
+    for a fixed time means a slow cycle doesn't push everything after it
+    later and later.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        print("Running %.1f seconds behind schedule!" % (-remaining))
+        return
+
+    print("Sleeping for %.1f seconds..." % (remaining))
+    while runner.halt is False:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(remaining, 1.))
+
+
 def monitorUltimaker(cDict, statusMap, statusColors, runner,
                      loopInterval=30,
                      squashEmail=False,
                      squashPiCam=False,
-                     squashUltiCam=False):
+                     squashUltiCam=False,
+                     profiler=None):
     """
+    profiler is an optional profiling.cycleProfiler to run over some of
+    the cycles.
     """
     # Initial parameters to compare against
-    pJob = {"JobParameters": {"UUID": 8675309}}
-    curProg = -9999
-    prevProg = -9999
-    notices = None
+    mstate = classes.monitorState(cDict['printerSetup'])
 
     # Some renames, also some debugging and squashing of stuff
-    printerip = cDict['printerSetup'].ip
     email = None
     if squashEmail is False:
         email = cDict['email']
@@ -201,115 +538,99 @@ def monitorUltimaker(cDict, statusMap, statusColors, runner,
     if squashUltiCam is False:
         ulticam = cDict['printerSetup']
 
+    notifier = notificationWorker()
+    notifier.start()
+
     # We use runner here to exit in a sensible way if any signals come up
     while runner.halt is False:
-        # Do a check of everything we care about
-        stats = printer.statusCheck(printerip)
-
-        # Did our status check work?
-        if stats != {}:
-            # The "printer/status" endpoint is pretty terse, but the
-            #   "printer/diagnostics/temperature_flow" endpoint is both
-            #   highly detailed (sampled ~10 Hz) and highly specific
-            #   with it's "active_hotend_or_state" parameter. Use that.
-
-            # This returns a list of influxdb structured packets; since we
-            #   only have one sample, it's a list with len() == 1
-            singleFlow = printer.tempFlow(printerip, nsamps=1)[0]
-            flowState = singleFlow['fields']['active_hotend_or_state']
-            flowStateWords = statusMap[flowState]
-            print()
-            print("flowState: %s" % (flowStateWords))
-            print("/printer/state: %s" % (stats['Status']))
-            # If we're not actually printing, it won't be possible to get
-            #   the state from the print_job endpoint because it'll be blank!
-            if stats['JobParameters'] != {}:
-                printjobState = stats['JobParameters']['JobState']
-                print("/print_job/state: %s" % (printjobState))
-            print()
-
-            # We have to do a check in two parts, because some states are from
-            #   the lower level printer firmware and some states are from the
-            #   higher level Ultimaker software
-            if stats['Status'] in ['error', 'maintenance', 'booting']:
-                actualStatus = stats['Status']
-            else:
-                # Use the lower level status since it's more detailed
-                actualStatus = flowStateWords
-
-            # Only attempt to change the LED colors if we have a valid status
-            if actualStatus.lower() != 'unknown':
-                # NOTE: Pass in the entire printer configuration since
-                #   this is a PUT action and needs API authentication.
-                #   Use actualStatus to capture the full range of states
-                leds.ledCheck(cDict['printerSetup'],
-                              statusColors, actualStatus)
-
-            # Trigger on the high level status here so I don't have to deal
-            #   *all* the possibilities of the low level one
-            if stats['Status'] == 'printing':
-                # Check if this job is the same as the last job we saw
-                pJob, notices = checkJob(stats, pJob, notices)
-
-                curProg = stats['JobParameters']['Progress']
-                curJobName = stats['JobParameters']['Name']
-                # Just take the first part of the UUID so it's not so long...
-                curJobID = stats['JobParameters']['UUID'].split("-")[0]
-
-                # Only grab info when we're really printing.
-                #   'pre_print' is too early and duration will be missing
-                msg = None
-                deets = None
-                noteKey = None
-                emailFlag = False
-
-                if actualStatus.lower() in ['printing',
-                                            'pausing', 'paused', 'resuming',
-                                            'post_print', 'wait_cleanup']:
-                    emailFlag, noteKey, deets = notificationTree(stats,
-                                                                 actualStatus,
-                                                                 notices,
-                                                                 curProg,
-                                                                 prevProg)
-
-                # Now check the states that we could have gotten into
-                if noteKey is not None:
-                    notices[noteKey] = True
-                    print(deets)
-                    if emailFlag is True:
-                        print(noteKey)
-                        print(notices[noteKey])
-                        print(notices)
-                        msg = emailHelper.makeEmailUpdate(noteKey,
-                                                          curJobID,
-                                                          curJobName,
-                                                          deets, email,
-                                                          picam=picam,
-                                                          ulticam=ulticam)
-
-                        # If squashEmail is True, email will be None
-                        if email is not None:
-                            j5.email.sendMail(msg,
-                                              smtploc=email.host,
-                                              port=email.port,
-                                              user=email.user,
-                                              passw=email.password)
-
-                # Need this to set the LED color appropriately
-                actualStatus = stats['JobParameters']['JobState']
-
-                # Update the progress since we're printing
-                print("Previous Progress: ", prevProg)
-                print("Current Progress: ", curProg)
-                prevProg = curProg
-        else:
-            print("PRINTER UNREACHABLE!")
+        cycleStart = time.monotonic()
+        with profiling.profileCycle(profiler):
+            stats = monitorCycle(mstate, statusMap, statusColors, notifier,
+                                 email=email, picam=picam, ulticam=ulticam)
+
+        # Schedule from when the cycle started, not when it ended
+        interval = pollInterval(stats, mstate, loopInterval=loopInterval)
+        sleepUntil(runner, cycleStart + interval)
+
+    notifier.stop()
+    if profiler is not None:
+        profiler.close()
+
+
+def monitorFleet(cDict, statusMap, statusColors, runner,
+                 loopInterval=30,
+                 maxWorkers=4,
+                 squashEmail=False,
+                 squashPiCam=False,
+                 squashUltiCam=False):
+    """
+    Same as monitorUltimaker, but for every printer in cDict['printers']
+    at once using a bounded pool of workers, each on its own adaptive
+    schedule.  A printer that blows up is reported and skipped for that
+    cycle; the others carry on.
 
-        # Take a nap in our infinite loop
-        if runner.halt is False:
-            print("Sleeping for %d seconds..." % (int(loopInterval)))
-            # Sleep for bigsleep, but in small chunks to check abort
-            for _ in range(int(loopInterval)):
-                time.sleep(1)
-                if runner.halt is True:
-                    break
+    The PiCam is physically pointed at one printer, so it's only used
+    for the one given in the main printerSetup section.
+    """
+    printers = cDict['printers']
+
+    email = None
+    if squashEmail is False:
+        email = cDict['email']
+
+    mstates = {}
+    for name in printers:
+        mstates.update({name: classes.monitorState(printers[name])})
+
+    notifier = notificationWorker()
+    notifier.start()
+
+    # Each printer gets polled on its own schedule; we just keep checking
+    #   who is due and hand them to the pool as they come up
+    futures = {}
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        while runner.halt is False:
+            now = time.monotonic()
+            busy = list(futures.values())
+            for name in printers:
+                if name in busy or mstates[name].nextPoll > now:
+                    continue
+
+                picam = None
+                if squashPiCam is False and\
+                   printers[name] is cDict['printerSetup']:
+                    picam = cDict['picam']
+                ulticam = None
+                if squashUltiCam is False:
+                    ulticam = printers[name]
+
+                fut = pool.submit(monitorCycle, mstates[name],
+                                  statusMap, statusColors, notifier,
+                                  email=email, picam=picam, ulticam=ulticam,
+                                  printername=name)
+                futures.update({fut: name})
+                # Schedule from when the cycle started
+                mstates[name].nextPoll = now
+
+            if futures == {}:
+                # Nobody is due yet, so nap until the first one is
+                nextDue = min([m.nextPoll for m in mstates.values()])
+                time.sleep(min(max(nextDue - time.monotonic(), 0.), 1.))
+                continue
+
+            done, _ = wait(list(futures.keys()), timeout=1.,
+                           return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = futures.pop(fut)
+                try:
+                    stats = fut.result()
+                    interval = pollInterval(stats, mstates[name],
+                                            loopInterval=loopInterval)
+                except Exception as err:
+                    print("MONITORING FAILED FOR PRINTER %s!" % (name))
+                    print(str(err))
+                    metrics.errors.inc(kind="monitor")
+                    interval = loopInterval
+                mstates[name].nextPoll += interval
+
+    notifier.stop()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Sends the notification emails in the background.
+
+Building a message means waiting on cameras and sending one means waiting
+on an SMTP server, and neither should ever hold up the monitoring loop.
+Notifications go on a bounded queue and a worker thread builds, sends,
+and retries them (with backoff) on its own time.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import queue
+import threading
+
+import johnnyfive as j5
+
+from . import cameras, metrics
+from . import email as emailHelper
+
+
+class notificationWorker(threading.Thread):
+    def __init__(self, maxQueue=20, maxTries=5, backoff=30.,
+                 maxBackoff=600.):
+        super(notificationWorker, self).__init__(name="notificationWorker")
+        self.daemon = True
+
+        self.queue = queue.Queue(maxsize=maxQueue)
+        self.maxTries = maxTries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.halt = threading.Event()
+        self.statLock = threading.Lock()
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latencies = []
+
+    def submit(self, noteKey, jobid, jobname, deets, email,
+               picam=None, ulticam=None, printername=None):
+        """
+        Queue up a notification; never blocks.  The camera grabs start
+        right now so the pictures match the moment we noticed, even if
+        the email itself has to wait its turn.  Returns False if the
+        queue was full and the notification was dropped.
+        """
+        if email is None:
+            # If squashEmail is True, email will be None
+            return True
+
+        snaps = cameras.startCaptures(picam=picam, ulticam=ulticam)
+        note = {"noteKey": noteKey, "jobid": jobid, "jobname": jobname,
+                "deets": deets, "email": email, "picam": picam,
+                "ulticam": ulticam, "printername": printername,
+                "snaps": snaps, "queued": time.monotonic()}
+        try:
+            self.queue.put_nowait(note)
+            metrics.queueDepth.set(self.queue.qsize(), queue="notifications")
+            return True
+        except queue.Full:
+            print("WARNING: Notification queue full; dropping %s for %s" %
+                  (noteKey, jobid))
+            with self.statLock:
+                self.dropped += 1
+            return False
+
+    def deliver(self, note):
+        """
+        Build and send one notification, retrying with backoff.
+        """
+        email = note['email']
+        msg = emailHelper.makeEmailUpdate(note['noteKey'],
+                                          note['jobid'],
+                                          note['jobname'],
+                                          note['deets'], email,
+                                          picam=note['picam'],
+                                          ulticam=note['ulticam'],
+                                          printername=note['printername'],
+                                          snaps=note['snaps'])
+
+        for attempt in range(self.maxTries):
+            try:
+                with metrics.emailLatency.time():
+                    j5.email.sendMail(msg,
+                                      smtploc=email.host,
+                                      port=email.port,
+                                      user=email.user,
+                                      passw=email.password)
+                with self.statLock:
+                    self.sent += 1
+                    self.latencies.append(time.monotonic() - note['queued'])
+                    self.latencies = self.latencies[-100:]
+                return True
+            except Exception as err:
+                wait = min(self.backoff*2.**attempt, self.maxBackoff)
+                print("Email send failed (try %d of %d): %s" %
+                      (attempt + 1, self.maxTries, str(err)))
+                metrics.errors.inc(kind="email")
+                if attempt + 1 < self.maxTries:
+                    # If we're shutting down, don't hang about
+                    if self.halt.wait(wait) is True:
+                        break
+
+        print("Giving up on %s notification for %s" %
+              (note['noteKey'], note['jobid']))
+        with self.statLock:
+            self.failed += 1
+
+        return False
+
+    def run(self):
+        """
+        """
+        while self.halt.is_set() is False or self.queue.empty() is False:
+            try:
+                note = self.queue.get(timeout=1.)
+                metrics.queueDepth.set(self.queue.qsize(),
+                                       queue="notifications")
+            except queue.Empty:
+                continue
+
+            try:
+                self.deliver(note)
+            except Exception as err:
+                # Don't let one bad message kill the worker
+                print("Notification %s failed to build!" % (note['noteKey']))
+                print(str(err))
+                metrics.errors.inc(kind="email")
+                with self.statLock:
+                    self.failed += 1
+
+    def stats(self):
+        """
+        Queue depth and delivery numbers; latency is from when the
+        notification was queued until the SMTP server took it.
+        """
+        with self.statLock:
+            lats = list(self.latencies)
+            stats = {"depth": self.queue.qsize(),
+                     "sent": self.sent,
+                     "failed": self.failed,
+                     "dropped": self.dropped}
+        if lats != []:
+            stats.update({"latencyLast": lats[-1],
+                          "latencyMean": sum(lats)/len(lats),
+                          "latencyMax": max(lats)})
+
+        return stats
+
+    def stop(self, timeout=60.):
+        """
+        Try to get out whatever is still queued, but don't wait forever.
+        """
+        self.halt.set()
+        self.join(timeout=timeout)
+        print("Notification stats: %s" % (self.stats()))
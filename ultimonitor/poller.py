@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""One poller for everything that wants to know what the printers are up to.
+
+Rather than the monitor and the collector each asking every printer the
+same questions, sharedPoller takes one snapshot (classes.printerSnapshot)
+per printer per cycle and publishes it to each subscriber.  Every
+subscriber has its own thread and its own little queue, so a slow one
+(like the monitor, waiting on a camera) just falls behind on its own;
+the poller and the other subscribers never wait on it.
+
+Each subscriber keeps a few snapshots per printer; the LEDs only care
+about the latest one, the monitor wants to see short lived states too,
+and the collector keeps the deepest queue since it's the one storing
+everything.  When a queue is full the oldest snapshot is folded into
+the next one (see mergeSnapshots) so its samples aren't lost.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import copy
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from . import printer, classes, monitoring, leds, sinks, metrics
+
+
+def mergeBlocks(older, newer):
+    """
+    One classes.flowBlock with the samples of both, older first; None if
+    they can't be lined up (different fields).  Neither one is changed.
+    """
+    if older is None or len(older) == 0:
+        return newer
+    if newer is None or len(newer) == 0:
+        return older
+    if older.labels != newer.labels:
+        return None
+
+    stamps = np.concatenate([np.asarray(older.stamps),
+                             np.asarray(newer.stamps)])
+    columns = [np.concatenate([np.asarray(oc), np.asarray(nc)])
+               for oc, nc in zip(older.columns, newer.columns)]
+    block = classes.flowBlock(stamps=stamps, labels=list(newer.labels),
+                              columns=columns, tags=newer.tags,
+                              meas=newer.meas)
+
+    if older.masks is not None or newer.masks is not None:
+        masks = []
+        for i in range(len(block.labels)):
+            parts = []
+            for blk in [older, newer]:
+                mask = None if blk.masks is None else blk.masks[i]
+                if mask is None:
+                    mask = np.ones(len(blk), dtype=bool)
+                parts.append(np.asarray(mask))
+            masks.append(np.concatenate(parts))
+        block.masks = masks
+
+    return block
+
+
+def mergeSnapshots(older, newer):
+    """
+    A copy of newer with older's samples and system stats in front of
+    its own; everything else (status and so on) is newer's.  Snapshots
+    are shared between subscribers, so neither one is changed.  None if
+    the samples can't be merged.
+    """
+    block = mergeBlocks(older.flowBlock, newer.flowBlock)
+    if block is None:
+        return None
+
+    snap = copy.copy(newer)
+    snap.flowBlock = block
+    snap.sysPkts = list(older.sysPkts) + list(newer.sysPkts)
+
+    return snap
+
+
+class subscriber(threading.Thread):
+    def __init__(self, name, depth=1):
+        """
+        depth is how many snapshots per printer can be waiting; once
+        it's full the oldest one is merged into the one after it.
+        """
+        super(subscriber, self).__init__(name=name)
+        self.daemon = True
+
+        self.depth = depth
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
+        self.halt = threading.Event()
+
+        self.stats = {"received": 0, "handled": 0, "merged": 0,
+                      "dropped": 0, "errors": 0}
+
+    def publish(self, snap):
+        """
+        Never blocks.
+        """
+        with self.cond:
+            waiting = self.pending.get(snap.name)
+            if waiting is None:
+                waiting = deque()
+                self.pending.update({snap.name: waiting})
+            waiting.append(snap)
+            if len(waiting) > self.depth:
+                oldest = waiting.popleft()
+                merged = mergeSnapshots(oldest, waiting[0])
+                if merged is not None:
+                    waiting[0] = merged
+                    self.stats["merged"] += 1
+                else:
+                    self.stats["dropped"] += 1
+            self.stats["received"] += 1
+            self.cond.notify()
+
+    def nextSnapshot(self, timeout=1.):
+        """
+        Oldest waiting snapshot, taking turns between printers; None if
+        nothing showed up in time.
+        """
+        with self.cond:
+            if len(self.pending) == 0:
+                self.cond.wait(timeout)
+            if len(self.pending) == 0:
+                return None
+
+            name = next(iter(self.pending))
+            waiting = self.pending.pop(name)
+            snap = waiting.popleft()
+            if len(waiting) > 0:
+                # Back of the line
+                self.pending.update({name: waiting})
+
+        return snap
+
+    def handle(self, snap):
+        """
+        What to do with each snapshot; subclasses fill this in.
+        """
+        raise NotImplementedError
+
+    def interval(self, name):
+        """
+        How soon (seconds) we'd like to see this printer again, or None
+        if we don't care.
+        """
+        return None
+
+    def tick(self):
+        """
+        Called about once a second on this subscriber's own thread,
+        snapshot or not; for anything that has to happen in between.
+        """
+        pass
+
+    def run(self):
+        """
+        """
+        while self.halt.is_set() is False or len(self.pending) > 0:
+            try:
+                self.tick()
+            except Exception as err:
+                print("%s TICK FAILED!" % (self.name.upper()))
+                print(str(err))
+                self.stats["errors"] += 1
+                metrics.errors.inc(kind=self.name)
+
+            snap = self.nextSnapshot()
+            if snap is None:
+                continue
+
+            try:
+                with metrics.cycleDuration.time(loop=self.name):
+                    self.handle(snap)
+                self.stats["handled"] += 1
+            except Exception as err:
+                # One bad snapshot shouldn't stop the rest
+                print("%s FAILED FOR PRINTER %s!" % (self.name.upper(),
+                                                     snap.name))
+                print(str(err))
+                self.stats["errors"] += 1
+                metrics.errors.inc(kind=self.name)
+
+    def stop(self, timeout=60.):
+        """
+        Finish what's waiting, then quit.
+        """
+        self.halt.set()
+        self.join(timeout=timeout)
+        print("%s stats: %s" % (self.name, self.stats))
+
+
+class monitorSubscriber(subscriber):
+    def __init__(self, cDict, statusMap, statusColors, notifier,
+                 loopInterval=30., email=True, picam=True, ulticam=True):
+        """
+        The job watching and notification part of Printzini.
+        email/picam/ulticam False turn those off.  A few snapshots can
+        wait so that a state that only lasts a cycle or two (like a
+        pause) is still seen while a camera grab holds things up.
+        """
+        super(monitorSubscriber, self).__init__("monitor", depth=5)
+
+        self.cDict = cDict
+        self.statusMap = statusMap
+        self.statusColors = statusColors
+        self.notifier = notifier
+        self.loopInterval = loopInterval
+
+        self.email = None
+        if email is True:
+            self.email = cDict['email']
+        self.picam = picam
+        self.ulticam = ulticam
+
+        self.mstates = {}
+        self.intervals = {}
+
+    def handle(self, snap):
+        """
+        """
+        mstate = self.mstates.get(snap.name)
+        if mstate is None:
+            mstate = classes.monitorState(snap.printer)
+            self.mstates.update({snap.name: mstate})
+
+        # The PiCam is only pointed at the main printer
+        picam = None
+        if self.picam is True and snap.printer is self.cDict['printerSetup']:
+            picam = self.cDict['picam']
+        ulticam = None
+        if self.ulticam is True:
+            ulticam = snap.printer
+
+        if len(self.cDict['printers']) > 1:
+            printername = snap.name
+        else:
+            printername = None
+
+        # LEDs are their own subscriber; the flow state is the poller's,
+        #   so the two of them always agree on it
+        stats = monitoring.processStatus(mstate, snap.stats, snap.flowBlock,
+                                         self.statusMap, self.statusColors,
+                                         self.notifier, email=self.email,
+                                         picam=picam, ulticam=ulticam,
+                                         printername=printername,
+                                         setLEDs=False,
+                                         flowState=snap.flowState)
+
+        interval = monitoring.pollInterval(stats, mstate,
+                                           loopInterval=self.loopInterval)
+        self.intervals.update({snap.name: interval})
+
+    def interval(self, name):
+        """
+        """
+        return self.intervals.get(name)
+
+
+class ledSubscriber(subscriber):
+    def __init__(self, statusMap, statusColors, verifyEvery=10,
+                 minInterval=10.):
+        """
+        Keeps the case LEDs matching the printer state.
+        """
+        super(ledSubscriber, self).__init__("leds", depth=1)
+
+        self.statusMap = statusMap
+        self.statusColors = statusColors
+        self.verifyEvery = verifyEvery
+        self.minInterval = minInterval
+
+        self.controls = {}
+
+    def handle(self, snap):
+        """
+        """
+        control = self.controls.get(snap.name)
+        if control is None:
+            control = leds.ledController(snap.printer, self.statusColors,
+                                         verifyEvery=self.verifyEvery,
+                                         minInterval=self.minInterval)
+            self.controls.update({snap.name: control})
+
+        if snap.stats == {} or snap.stats['Status'] == "UNKNOWN":
+            # Whatever the LEDs were, it's anyone's guess after this
+            control.reset()
+            return
+
+        actualStatus = monitoring.actualState(snap.stats, snap.flowState,
+                                              self.statusMap)
+        if actualStatus.lower() != 'unknown':
+            control.update(actualStatus)
+
+    def tick(self):
+        """
+        Any LED writes that were put off go out from here, so they use
+        the same thread (and digest auth) as the rest
+        """
+        for control in self.controls.values():
+            control.flush()
+
+
+class collectorSubscriber(subscriber):
+    def __init__(self, outputs, loopInterval=30., depth=20):
+        """
+        The Clausius part; everything goes to the sinks in outputs.
+        Every snapshot has its own samples, so a few are allowed to
+        pile up if the sinks are slow.
+        """
+        super(collectorSubscriber, self).__init__("collector", depth=depth)
+
+        self.outputs = outputs
+        self.loopInterval = loopInterval
+
+    def handle(self, snap):
+        """
+        """
+        if snap.flowBlock is not None:
+            sinks.sendOff(self.outputs, snap.flowBlock)
+        sinks.sendOff(self.outputs, snap.sysPkts)
+
+    def interval(self, name):
+        """
+        The printer only keeps ~80 seconds of samples, so no matter how
+        bored the monitor is we still have to come back this often.
+        """
+        return self.loopInterval
+
+
+class sharedPoller(object):
+    def __init__(self, printers, subscribers, loopInterval=30.,
+                 maxWorkers=4, nsamps=450):
+        """
+        printers is the dict of printer configurations (name: config) from
+        confparser; points are tagged with the printer name if there's
+        more than one of them, just like Clausius does.
+        """
+        self.printers = printers
+        self.subscribers = subscribers
+        self.loopInterval = loopInterval
+        self.maxWorkers = maxWorkers
+        self.nsamps = nsamps
+
+        self.trackers = {}
+        self.flowStates = {}
+        self.nextPoll = {}
+        for name in printers:
+            self.trackers.update({name: classes.tempFlowTracker()})
+            self.flowStates.update({name: None})
+            self.nextPoll.update({name: 0.})
+
+        self.stats = {"snapshots": 0, "unreachable": 0, "errors": 0}
+
+    def takeSnapshot(self, name):
+        """
+        Everything anyone wants to know about the printer, asked once.
+        """
+        pConfig = self.printers[name]
+        if len(self.printers) > 1:
+            tags = {"printer": name}
+        else:
+            tags = None
+
+        snap = classes.printerSnapshot(name, pConfig)
+        snap.taken = time.time()
+        cycleStart = time.monotonic()
+        snap.stats = printer.statusCheck(pConfig.ip)
+
+        if snap.stats != {} and snap.stats['Status'] != "UNKNOWN":
+            snap.flowBlock = printer.tempFlow(pConfig.ip, nsamps=self.nsamps,
+                                              tracker=self.trackers[name],
+                                              tags=tags, asBlock=True)
+            snap.sysPkts = printer.systemStats(pConfig.ip, tags=tags)
+
+            # A snapshot taken right after another might not have any
+            #   new samples, so hang on to the last state we saw
+            flowState = monitoring.flowStateOf(snap.flowBlock)
+            if flowState is not None:
+                self.flowStates[name] = flowState
+            snap.flowState = self.flowStates[name]
+        else:
+            self.stats["unreachable"] += 1
+            metrics.errors.inc(kind="unreachable")
+
+        metrics.cycleDuration.observe(time.monotonic() - cycleStart,
+                                      loop="poller")
+
+        return snap
+
+    def interval(self, name):
+        """
+        Soonest that any subscriber wants to see this printer again
+        """
+        wants = [sub.interval(name) for sub in self.subscribers]
+        wants = [w for w in wants if w is not None]
+        if wants == []:
+            return self.loopInterval
+
+        return min(wants)
+
+    def run(self, runner):
+        """
+        Poll every printer on its own schedule until runner says stop.
+        """
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            while runner.halt is False:
+                now = time.monotonic()
+                busy = list(futures.values())
+                for name in self.printers:
+                    if name in busy or self.nextPoll[name] > now:
+                        continue
+                    fut = pool.submit(self.takeSnapshot, name)
+                    futures.update({fut: name})
+                    # Schedule from when the poll started
+                    self.nextPoll[name] = now
+
+                if futures == {}:
+                    nextDue = min(self.nextPoll.values())
+                    time.sleep(min(max(nextDue - time.monotonic(), 0.), 1.))
+                    continue
+
+                done, _ = wait(list(futures.keys()), timeout=1.,
+                               return_when=FIRST_COMPLETED)
+                for fut in done:
+                    self.finished(fut, futures.pop(fut))
+
+            # Whatever was already asked for still gets handed out,
+            #   since its samples are gone from the printer's buffer
+            done, _ = wait(list(futures.keys()))
+            for fut in done:
+                self.finished(fut, futures.pop(fut))
+
+        print("Poller stats: %s" % (self.stats))
+
+    def finished(self, fut, name):
+        """
+        Publish what a finished takeSnapshot came back with, and work out
+        when to poll the printer next.
+        """
+        try:
+            snap = fut.result()
+        except Exception as err:
+            print("POLLING FAILED FOR PRINTER %s!" % (name))
+            print(str(err))
+            self.stats["errors"] += 1
+            metrics.errors.inc(kind="poller")
+            self.nextPoll[name] += self.loopInterval
+            return
+
+        self.stats["snapshots"] += 1
+        for sub in self.subscribers:
+            sub.publish(snap)
+
+        # The monitor's say is from the snapshot before this one, since
+        #   it's only just getting this one now
+        self.nextPoll[name] += self.interval(name)
@@ -15,17 +15,38 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+import os
+import json
+import time
+import math
+import tempfile
+import threading
 import datetime as dt
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import xmltodict
 
 from ligmos.utils import packetizer
 
 from . import apitools as api
+from . import classes
 
 
-def systemStats(printerip):
+# Parsed material summaries keyed by material GUID, oldest first.
+#   A GUID always points at the same profile, so these never go stale;
+#   a new GUID showing up in printer/heads/0 is just a miss.
+_materialCache = OrderedDict()
+_materialLock = threading.Lock()
+_materialCacheFile = None
+# Only one save at a time, since the statusCheck workers can all find new
+#   materials at once
+_materialSaveLock = threading.Lock()
+materialCacheSize = 32
+
+
+def systemStats(printerip, tags=None):
     """
     Query the printer for memory
     """
@@ -36,7 +57,7 @@ def systemStats(printerip):
 
         pkt = packetizer.makeInfluxPacket(meas=['system'],
                                           fields=mem,
-                                          tags=None)
+                                          tags=tags)
     else:
         # Silly.
         pkt = []
@@ -44,7 +65,196 @@ def systemStats(printerip):
     return pkt
 
 
-def tempFlow(printerip, nsamps=800, debug=False):
+def flowSampleCount(tracker, nsamps=800):
+    """
+    Figure out how many temperature_flow samples we need to ask for to
+    cover the time since the last successful fetch, given the measured
+    sample rate and a little safety margin.  Capped at the printer's
+    buffer size since it won't give us more than that anyways.
+    """
+    if tracker.lastFetch is None:
+        # First time thru, so we have no idea; take what we were given
+        nsamps = min(nsamps, tracker.maxSamples)
+    else:
+        elapsed = time.monotonic() - tracker.lastFetch
+        nsamps = int(math.ceil(elapsed*tracker.sampleRate*tracker.margin))
+        nsamps += tracker.minSamples
+        nsamps = max(min(nsamps, tracker.maxSamples), tracker.minSamples)
+
+    return nsamps
+
+
+def trackFlow(tracker, uptimeSec, times):
+    """
+    Given the sample times (seconds since boot) from a temperature_flow
+    query, return the index of the first sample newer than anything we've
+    already ingested and update the tracker's high-water mark.
+
+    Also reports (and records) any gap between the last ingested sample
+    and the oldest sample the printer still had in its buffer.
+    """
+    # Printer rebooted, so the high-water mark is meaningless now.
+    #   Uptime only comes back in whole seconds, hence the slop
+    if tracker.lastSampleTime is not None and\
+       uptimeSec + 1 < tracker.lastSampleTime:
+        print("Printer uptime went backwards; resetting temperature_flow HWM")
+        tracker.lastSampleTime = None
+
+    first = 0
+    if tracker.lastSampleTime is not None:
+        first = int(np.searchsorted(times, tracker.lastSampleTime,
+                                    side='right'))
+
+        # If the oldest sample returned is still newer than our HWM by
+        #   more than a couple of sample periods, we couldn't go back far
+        #   enough and there's a hole in the data
+        if len(times) > 0 and first == 0:
+            gap = times[0] - tracker.lastSampleTime
+            if gap > 2./tracker.sampleRate:
+                if tracker.reportGaps is True:
+                    print("WARNING: temperature_flow gap of %.1f seconds!" %
+                          (gap))
+                tracker.ngaps += 1
+                tracker.gapSeconds += gap
+
+    if len(times) > 1 and times[-1] > times[0]:
+        tracker.sampleRate = float((len(times) - 1)/(times[-1] - times[0]))
+
+    if len(times) > 0:
+        tracker.lastSampleTime = float(times[-1])
+    tracker.lastFetch = time.monotonic()
+
+    return first
+
+
+def _toFloat(val):
+    """
+    """
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def flowColumn(vals):
+    """
+    One column of the reply as an array.  It's only an integer column if
+    every value in it is an integer; anything missing (None) or that
+    isn't a number makes it float64, with NaN for the bad values.
+    """
+    if all(type(v) is int for v in vals):
+        return np.array(vals, dtype=np.int64)
+
+    try:
+        # None becomes NaN here all by itself
+        return np.array(vals, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array([_toFloat(v) for v in vals], dtype=np.float64)
+
+
+def flowColumns(tres, bklst=None):
+    """
+    Decode the list-of-lists temperature_flow reply into columns.
+
+    Returns the sample times (seconds since boot) as a float64 array, the
+    labels that survived the blacklist, and a matching list of column
+    arrays.  Columns that came back as integers (like the state) stay
+    integers, otherwise influx will complain about the field type changing.
+    """
+    flabs = tres[0]
+    if bklst is None:
+        bklst = []
+
+    # Translate the blacklisted labels to the indices we actually keep
+    gi = [k for k, lab in enumerate(flabs) if lab not in bklst]
+    labels = [flabs[k] for k in gi]
+
+    if len(tres) < 2:
+        return np.zeros(0), labels, [np.zeros(0) for _ in gi]
+
+    # Short rows get padded out with None so they still line up
+    nlabs = len(flabs)
+    rows = tres[1:]
+    if any(len(row) != nlabs for row in rows):
+        rows = [(list(row) + [None]*nlabs)[:nlabs] for row in rows]
+    cols = list(zip(*rows))
+
+    times = flowColumn(cols[0]).astype(np.float64)
+    columns = [flowColumn(cols[k]) for k in gi]
+
+    return times, labels, columns
+
+
+def flowPackets(stamps, labels, columns, meas='temperatures', tags=None):
+    """
+    Turn the (already filtered) columns into influxdb packets, one per
+    sample.  stamps must be integer milliseconds since the epoch.
+    """
+    allpkts = []
+
+    # .tolist() hands back native python ints/floats in one shot
+    stamps = stamps.tolist()
+    columns = [col.tolist() for col in columns]
+    for ts, row in zip(stamps, zip(*columns)):
+        pkt = packetizer.makeInfluxPacket(meas=[meas],
+                                          ts=ts, fields=dict(zip(labels, row)),
+                                          tags=tags)
+        # Have to do pkt[0] because makeInfluxPacket is still
+        #   annoying and quirky
+        allpkts.append(pkt[0])
+
+    return allpkts
+
+
+def flowToBlock(tres, bootepoch, uptimeSec=None, tracker=None,
+                tags=None):
+    """
+    Everything tempFlow does with a temperature_flow reply once it has it;
+    bootepoch is the printer's boot time in seconds since the epoch.
+    Returns a classes.flowBlock with just the new samples.
+    """
+    # For the Ultimaker 3e, the flow sensor hardware was removed before
+    #   the printer shipped so the following are always 0 or 65535;
+    #   We exclude them from the results because that's annoying.
+    # NOTE: case isn't checked, so they must be *exact* matches!
+    #       Also - "Time" is skipped because we store that differently
+    bklst = ['Time',
+             'flow_sensor0', 'flow_steps0',
+             'flow_sensor1', 'flow_steps1']
+
+    # At this point, if the query is successful, tres is a list of
+    #   lists,  the first of which is the labels and the rest are
+    #   lists of values matching those labels.
+    times, labels, columns = flowColumns(tres, bklst=bklst)
+
+    # Skip anything we've already seen
+    if tracker is not None:
+        first = trackFlow(tracker, uptimeSec, times)
+        times = times[first:]
+        columns = [col[first:] for col in columns]
+
+    # Make the timestamps real timestamps rather than just an offset
+    #   from boot, in milliseconds for influx.
+    #   NOTE: It CAN NOT be a float! Must be an Int :(
+    stamps = np.rint((bootepoch + times)*1e3).astype(np.int64)
+
+    return classes.flowBlock(stamps, labels, columns, tags=tags)
+
+
+def flowToPackets(tres, bootepoch, uptimeSec=None, tracker=None,
+                  tags=None):
+    """
+    flowToBlock, but handing back one packet per sample
+    """
+    block = flowToBlock(tres, bootepoch, uptimeSec=uptimeSec,
+                        tracker=tracker, tags=tags)
+
+    return flowPackets(block.stamps, block.labels, block.columns,
+                       meas=block.meas, tags=block.tags)
+
+
+def tempFlow(printerip, nsamps=800, tracker=None, tags=None, debug=False,
+             asBlock=False):
     """
     Query the printer for temperatures, and format/prepare them for storage.
 
@@ -53,11 +263,22 @@ def tempFlow(printerip, nsamps=800, debug=False):
     60 seconds, which could vary depending on some picture stuff, this
     will be a pretty good representation of the performance/stability.
 
+    If a tempFlowTracker is given as tracker, nsamps is instead sized from
+    the time since the last fetch and only samples newer than the last
+    one ingested are returned, so nothing gets written twice.
+
+    tags are attached to every packet, which is how the printers are told
+    apart from each other in fleet mode.
+
+    With asBlock, the samples come back as one classes.flowBlock (columns)
+    instead of a list of packets, which is a lot cheaper if they're just
+    going to be written out by lineproto or the archive.
+
     Entirely designed for putting into an influxdb database. If you want
     another database type, well, point it at a different formatting
     function in the conditional check on tres.
     """
-    boottime = None
+    bootepoch = None
     # Temperature timestamps are in seconds since boot ... kinda.
     #   It *looks* like Ultimaker uses time.monotonic() in a lot of places,
     #   and the reference point for that is *technically* undefined according
@@ -66,109 +287,161 @@ def tempFlow(printerip, nsamps=800, debug=False):
     #   clock changes in general. Ugh.
     uptimeSec = api.queryChecker(printerip, "/system/uptime")
     if uptimeSec != {}:
-        # You may be tempted to choose .utcnow() instead of now(); but,
-        #   that'd be a mistake.  Influx tries to be fancy for you,
-        #   so it's easier to just get the regular time and hope for the best
-        #   Otherwise you'll be tracing UTC offsets in the dashboard(s)
-        #   for literally ever, which is the worst.
-        boottime = dt.datetime.now() - dt.timedelta(seconds=uptimeSec)
+        # This is the same as the old dt.datetime.now() - uptime dance,
+        #   just kept as seconds since the epoch so the timestamps can all
+        #   be done in one vectorized add below. Influx still gets the
+        #   regular time, so no tracing UTC offsets in the dashboard(s).
+        bootepoch = time.time() - uptimeSec
         if debug is True:
-            print("Calculated datetime data offset: ", boottime)
+            print("Calculated datetime data offset: ",
+                  dt.datetime.fromtimestamp(bootepoch))
 
     # This query is a house of cards; if it fails because the printer
     #   is unreachable, literally everything will implode. So check that
     #   the return value isn't empty!!!
+    if tracker is not None:
+        nsamps = flowSampleCount(tracker, nsamps=nsamps)
     endpoint = "/printer/diagnostics/temperature_flow/%d" % (nsamps)
     tres = api.queryChecker(printerip, endpoint)
 
-    if tres != {} and boottime is not None:
-        # For the Ultimaker 3e, the flow sensor hardware was removed before
-        #   the printer shipped so the following are always 0 or 65535;
-        #   We exclude them from the results because that's annoying.
-        # NOTE: case isn't checked, so they must be *exact* matches!
-        #       Also - "Time" is skipped because we store that differently
-        bklst = ['Time',
-                 'flow_sensor0', 'flow_steps0',
-                 'flow_sensor1', 'flow_steps1']
-
-        allpkts = []
-
-        for i, points in enumerate(tres):
-            # At this point, if the query is successful, tres is a list of
-            #   lists,  the first of which is the labels and the rest are
-            #   lists of values matching those labels.
-            if i == 0:
-                flabs = points
-                # Translate the blacklisted labels to
-                if bklst != []:
-                    gi = [k for k, lab in enumerate(flabs) if lab not in bklst]
-                else:
-                    gi = []
-            else:
-                # Make an influxdb packet, but first do some contortions
-                #   to make the timestamp a real timestamp rather than
-                #   just an offset from boot
-                ts = boottime + dt.timedelta(seconds=points[0])
-                # Convert it to milliseconds for influx
-                #   NOTE: It CAN NOT be a float! Must be an Int :(
-                #         If we omit ndigits to round() it'll return an int
-                ts = round(float(ts.strftime("%s.%f"))*1e3)
-
-                # Grab the non-blacklisted items and construct our packet
-                #   I can't think of a good way to put this into a set of
-                #   non-confusing list comprehensions so I'm breaking it out
-                fields = {}
-                for idx in gi:
-                    fields.update({flabs[idx]: points[idx]})
-
-                pkt = packetizer.makeInfluxPacket(meas=['temperatures'],
-                                                  ts=ts, fields=fields,
-                                                  tags=None)
-                # Have to do pkt[0] because makeInfluxPacket is still
-                #   annoying and quirky
-                allpkts.append(pkt[0])
+    if tres != {} and bootepoch is not None:
+        if asBlock is True:
+            allpkts = flowToBlock(tres, bootepoch, uptimeSec=uptimeSec,
+                                  tracker=tracker, tags=tags)
+        else:
+            allpkts = flowToPackets(tres, bootepoch, uptimeSec=uptimeSec,
+                                    tracker=tracker, tags=tags)
     else:
         print("ERROR: Printer query failed!")
         # This happens when the printer query fails
-        allpkts = []
+        if asBlock is True:
+            allpkts = classes.flowBlock(tags=tags)
+        else:
+            allpkts = []
 
     return allpkts
 
 
+def parseMaterial(mXML):
+    """
+    Boil a material XML document down to a one line summary.  Returns the
+    summary and whether the parse actually worked.
+    """
+    # This is a potential failure point to wrap it for now
+    try:
+        # Only parse the thing once, it's not cheap on the Pi
+        fdm = xmltodict.parse(mXML)['fdmmaterial']
+        matMeta = fdm['metadata']['name']
+        matProp = fdm['properties']
+        good = True
+    except Exception as err:
+        # TODO: Catch the right exception for xmltodict
+        print(str(err))
+        matMeta = None
+        matProp = None
+        good = False
+
+    if matMeta is not None:
+        matBrand = matMeta['brand']
+        matName = matMeta['material']
+        matColor = matMeta['color']
+    else:
+        matBrand, matName, matColor = "UNKNOWN", "UNKNOWN", "UNKNOWN"
+
+    if matProp is not None:
+        matDiameter = matProp['diameter']
+        matDensity = matProp['density']
+    else:
+        matDiameter, matDensity = "UNKNOWN", "UNKNOWN"
+
+    material = "%s %s %s" % (matName, matBrand, matColor)
+    material += " (%s mm, %s g/cm^3)" % (matDiameter, matDensity)
+
+    return material, good
+
+
+def loadMaterialCache(cachefile):
+    """
+    Load previously parsed material summaries from cachefile, and keep
+    saving new ones there from now on.  A missing file is fine.
+    """
+    global _materialCacheFile
+    _materialCacheFile = cachefile
+
+    try:
+        with open(cachefile, 'r') as f:
+            saved = json.load(f)
+    except (OSError, IOError, ValueError):
+        saved = {}
+
+    with _materialLock:
+        for guid in saved:
+            _materialCache.update({guid: saved[guid]})
+        while len(_materialCache) > materialCacheSize:
+            _materialCache.popitem(last=False)
+
+
+def saveMaterialCache(cachefile):
+    """
+    Written to a temporary file that then replaces the real one, so
+    there's never a half written cache file lying around.
+    """
+    with _materialSaveLock:
+        with _materialLock:
+            saved = dict(_materialCache)
+
+        tmpname = None
+        try:
+            cachedir = os.path.dirname(os.path.abspath(cachefile))
+            fd, tmpname = tempfile.mkstemp(dir=cachedir, prefix=".materials-",
+                                           suffix=".tmp")
+            with os.fdopen(fd, 'w') as f:
+                json.dump(saved, f, indent=2)
+            os.replace(tmpname, cachefile)
+        except (OSError, IOError) as err:
+            print("Couldn't save material cache to %s" % (cachefile))
+            print(str(err))
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+
+
+def clearMaterialCache():
+    """
+    Forget every material summary (in memory; the cache file stays)
+    """
+    with _materialLock:
+        _materialCache.clear()
+
+
 def getMaterial(printerip, headinfo, extruder=0):
     """
     Don't need API id/key because these are all GET requests
+
+    Material profiles never change for a given GUID, so the summary is
+    only fetched and parsed the first time we see that GUID loaded.
     """
     mat = headinfo['extruders'][extruder]['active_material']['guid']
+
+    with _materialLock:
+        material = _materialCache.get(mat)
+        if material is not None:
+            _materialCache.move_to_end(mat)
+            return material
+
     mXML = api.queryChecker(printerip, "materials/" + mat)
 
     # Make sure the material query didn't croak for some reason
     if mXML != {}:
-        # This is a potential failure point to wrap it for now
-        try:
-            matMeta = xmltodict.parse(mXML)['fdmmaterial']['metadata']['name']
-            matProp = xmltodict.parse(mXML)['fdmmaterial']['properties']
-        except Exception as err:
-            # TODO: Catch the right exception for xmltodict
-            print(str(err))
-            matMeta = None
-            matProp = None
-
-        if matMeta is not None:
-            matBrand = matMeta['brand']
-            matName = matMeta['material']
-            matColor = matMeta['color']
-        else:
-            matBrand, matName, matColor = "UNKNOWN", "UNKNOWN", "UNKNOWN"
-
-        if matProp is not None:
-            matDiameter = matProp['diameter']
-            matDensity = matProp['density']
-        else:
-            matDiameter, matDensity = "UNKNOWN", "UNKNOWN"
-
-        material = "%s %s %s" % (matName, matBrand, matColor)
-        material += " (%s mm, %s g/cm^3)" % (matDiameter, matDensity)
+        material, good = parseMaterial(mXML)
+
+        # Don't remember failures, we'll want to try again next time
+        if good is True:
+            with _materialLock:
+                _materialCache.update({mat: material})
+                while len(_materialCache) > materialCacheSize:
+                    _materialCache.popitem(last=False)
+            if _materialCacheFile is not None:
+                saveMaterialCache(_materialCacheFile)
     else:
         material = "UNKNOWN"
 
@@ -199,37 +472,60 @@ def getPrinterInfo(printerip):
     return returnable
 
 
-def statusCheck(printerip):
+def statusCheck(printerip, maxWorkers=6):
     """
     Don't need API id/key because these are all GET requests
+
+    The independent queries are all fired off at once, so a cycle only
+    takes about as long as its slowest chain of dependent requests; the
+    materials have to wait for the head info, and the bed temperature and
+    print job only get asked for once we know we're printing.
     """
     returnable = OrderedDict()
 
-    # Get a few basic updates
-    status = api.queryChecker(printerip, "printer/status", fill="UNKNOWN")
-
-    # We don't store this, but we pull lots of stuff out of it. We treat it
-    #   slightly differently as the above since there are multiple values
-    #   to set to "UNKNOWN" in case the printer is unreachable
-    headinfo = api.queryChecker(printerip, "printer/heads/0")
-    if headinfo != {}:
-        ext1 = headinfo['extruders'][0]['hotend']['id']
-        ext2 = headinfo['extruders'][1]['hotend']['id']
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        # Get a few basic updates
+        fStatus = pool.submit(api.queryChecker, printerip,
+                              "printer/status", fill="UNKNOWN")
+        fHead = pool.submit(api.queryChecker, printerip, "printer/heads/0")
+        fBed = pool.submit(api.queryChecker, printerip,
+                           "printer/bed/type", fill="UNKNOWN")
+
+        # Once we know the status, we know whether to ask about the job
+        status = fStatus.result()
+        if status == "printing":
+            fBedTemp = pool.submit(api.queryChecker, printerip,
+                                   "printer/bed/temperature")
+            fJob = pool.submit(api.queryChecker, printerip, "print_job")
+
+        # We don't store this, but we pull lots of stuff out of it. We treat
+        #   it slightly differently as the above since there are multiple
+        #   values to set to "UNKNOWN" in case the printer is unreachable
+        headinfo = fHead.result()
+        if headinfo != {}:
+            ext1 = headinfo['extruders'][0]['hotend']['id']
+            ext2 = headinfo['extruders'][1]['hotend']['id']
+
+            # NOTE: There is an additional paranoia check in these for
+            #   query fails
+            fMat1 = pool.submit(getMaterial, printerip, headinfo, extruder=0)
+            fMat2 = pool.submit(getMaterial, printerip, headinfo, extruder=1)
+            material1 = fMat1.result()
+            material2 = fMat2.result()
+        else:
+            ext1 = "UNKNOWN"
+            material1 = "UNKNOWN"
+            ext2 = "UNKNOWN"
+            material2 = "UNKNOWN"
 
-        # NOTE: There is an additional paranoia check in these for query fails
-        material1 = getMaterial(printerip, headinfo, extruder=0)
-        material2 = getMaterial(printerip, headinfo, extruder=1)
-    else:
-        ext1 = "UNKNOWN"
-        material1 = "UNKNOWN"
-        ext2 = "UNKNOWN"
-        material2 = "UNKNOWN"
+        bedtype = fBed.result()
 
-    bedtype = api.queryChecker(printerip, "printer/bed/type", fill="UNKNOWN")
+        if status == "printing":
+            bedtemp = fBedTemp.result()
+            printjob = fJob.result()
 
     if status == "printing":
-        # Yay, we're printing!  Query some more!
-        bedtemp = api.queryChecker(printerip, "printer/bed/temperature")
+        # Yay, we're printing!  bedtemp and printjob were queried above
         try:
             if bedtemp != {}:
                 ext1temps = headinfo['extruders'][0]['hotend']['temperature']
@@ -241,7 +537,6 @@ def statusCheck(printerip):
             print(str(err))
 
         # Another multi-parameter check sequence
-        printjob = api.queryChecker(printerip, "print_job")
         if printjob != {}:
             jobname = printjob['name']
             jobstart = printjob['datetime_started']
@@ -311,7 +606,10 @@ def formatStatus(stats):
                 elif key == 'Progress':
                     retStr += "\t%s: %.3f %%\n" % (key, stats[sect][key])
                 elif key in ['BedTempSetp',
-                             'Extruder1Setp', 'Extruder2Setp']:
+                             'Extruder1Setp', 'Extruder2Setp',
+                             'Mean', 'StdDev', 'Min', 'Max',
+                             'SetpErrMean', 'SetpErrMeanAbs',
+                             'SetpErrMaxAbs']:
                     retStr += "\t%s: %.3f C\n" % (key, stats[sect][key])
                 else:
                     retStr += "\t%s: %s\n" % (key, stats[sect][key])
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Profile a handful of real cycles of a running loop.
+
+With the [profiling] section enabled, cycleProfiler runs cProfile over
+a sample of cycles (skip the first few, then every Nth one until it has
+enough), so it can be left on a Pi that's actually falling behind.  Each
+profiled cycle gets its own .prof file and a line in breakdown.jsonl with
+where the wall clock time went:
+
+    wall        - the whole cycle
+    cpu         - CPU time of the thread running the loop
+    offcpu      - wall - cpu; the loop waiting on the network, or on
+                  the statusCheck worker threads
+    cpuProcess  - CPU time for the whole process, every thread (the
+                  background writers and subscribers too), so it's only
+                  a rough upper bound on what the cycle cost
+    api         - time spent in printer API requests (from metrics); the
+                  parallel statusCheck queries are added up, so this can
+                  be more than wall
+
+Once it has enough cycles it writes report-<label>.txt, the top functions
+over every <label>-*.prof in the directory (so runs from before are
+included too, but not other programs sharing the directory).  That can
+also be made by hand with
+
+    python -m ultimonitor.profiling ./profiles [label]
+
+cProfile only sees the thread that runs the loop too; work done in the
+statusCheck worker threads shows up as time waiting on them.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import io
+import os
+import sys
+import glob
+import json
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager, nullcontext
+
+from . import metrics
+
+
+def aggregateProfiles(files, outfile=None, top=30, sortby="cumulative"):
+    """
+    Add up all the given .prof files and return (and optionally write
+    out) the top functions by sortby, then again by time in the function
+    itself.
+    """
+    files = [f for f in files if os.path.getsize(f) > 0]
+    if files == []:
+        return ""
+
+    stream = io.StringIO()
+    stats = pstats.Stats(files[0], stream=stream)
+    for fname in files[1:]:
+        stats.add(fname)
+
+    stream.write("%d profiled cycles\n" % (len(files)))
+    stats.strip_dirs()
+    stats.sort_stats(sortby).print_stats(top)
+    stats.sort_stats("tottime").print_stats(top)
+
+    report = stream.getvalue()
+    if outfile is not None:
+        with open(outfile, "w") as f:
+            f.write(report)
+
+    return report
+
+
+def labelProfiles(outdir, label=None):
+    """
+    The .prof files in outdir made by cycleProfilers with this label, or
+    all of them if label is None
+    """
+    if label is None:
+        pattern = "*.prof"
+    else:
+        pattern = "%s-*.prof" % (label)
+
+    return sorted(glob.glob(os.path.join(outdir, pattern)))
+
+
+class cycleProfiler(object):
+    def __init__(self, outdir="./profiles", label="cycle", ncycles=10,
+                 every=10, skip=1, top=30):
+        """
+        Profile ncycles cycles; skip the first skip of them (startup),
+        then every every-th one after that.
+        """
+        self.outdir = outdir
+        self.label = label
+        self.ncycles = ncycles
+        self.every = max(every, 1)
+        self.skip = skip
+        self.top = top
+
+        self.count = 0
+        self.files = []
+        self.breakdowns = []
+        self.reported = False
+
+    def selected(self):
+        """
+        Is the current cycle one we want?
+        """
+        if len(self.files) >= self.ncycles or self.count <= self.skip:
+            return False
+
+        return (self.count - self.skip - 1) % self.every == 0
+
+    @contextmanager
+    def cycle(self):
+        """
+        with profiler.cycle():
+            (one cycle)
+        """
+        self.count += 1
+        if self.selected() is False:
+            yield
+            return
+
+        apiStart = metrics.apiLatency.totals()
+        cpuStart = time.thread_time()
+        procStart = time.process_time()
+        wallStart = time.monotonic()
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            wall = time.monotonic() - wallStart
+            cpu = time.thread_time() - cpuStart
+            cpuProcess = time.process_time() - procStart
+            apiEnd = metrics.apiLatency.totals()
+            self.save(prof, wall, cpu, cpuProcess, apiEnd[0] - apiStart[0],
+                      apiEnd[1] - apiStart[1])
+
+    def save(self, prof, wall, cpu, cpuProcess, nreqs, apiTime):
+        """
+        Write out the profile and breakdown for the cycle just finished
+        """
+        if os.path.isdir(self.outdir) is False:
+            os.makedirs(self.outdir)
+
+        stamp = time.strftime("%Y%m%dT%H%M%S")
+        fname = os.path.join(self.outdir, "%s-%s-%05d.prof" %
+                             (self.label, stamp, self.count))
+        prof.dump_stats(fname)
+        self.files.append(fname)
+
+        breakdown = {"label": self.label, "cycle": self.count,
+                     "time": stamp, "wall": wall, "cpu": cpu,
+                     "offcpu": max(wall - cpu, 0.), "cpuProcess": cpuProcess,
+                     "api": apiTime,
+                     "apiRequests": nreqs, "profile": os.path.basename(fname)}
+        self.breakdowns.append(breakdown)
+        with open(os.path.join(self.outdir, "breakdown.jsonl"), "a") as f:
+            f.write(json.dumps(breakdown) + "\n")
+
+        print("Profiled cycle %d (%d of %d): %.3f s wall, %.3f s cpu,"
+              " %.3f s in %d API requests" %
+              (self.count, len(self.files), self.ncycles, wall, cpu,
+               apiTime, nreqs))
+
+        if len(self.files) >= self.ncycles:
+            self.report()
+
+    def summary(self):
+        """
+        Mean of each part of the breakdown, over this run's cycles
+        """
+        if self.breakdowns == []:
+            return {}
+
+        summ = {"cycles": len(self.breakdowns)}
+        for key in ["wall", "cpu", "offcpu", "cpuProcess", "api"]:
+            vals = [b[key] for b in self.breakdowns]
+            summ.update({key: sum(vals)/len(vals)})
+
+        return summ
+
+    def report(self):
+        """
+        Top functions over all of this label's profiles in outdir,
+        written to report-<label>.txt
+        """
+        if self.reported is True or self.files == []:
+            return
+
+        allfiles = labelProfiles(self.outdir, self.label)
+        outfile = os.path.join(self.outdir, "report-%s.txt" % (self.label))
+        aggregateProfiles(allfiles, outfile=outfile, top=self.top)
+        self.reported = True
+
+        print("Profiling done; mean breakdown %s" % (self.summary()))
+        print("Top functions from %d profiles written to %s" %
+              (len(allfiles), outfile))
+
+    def close(self):
+        """
+        Report on whatever we got, even if it wasn't all ncycles
+        """
+        self.report()
+
+
+def profileCycle(profiler):
+    """
+    profiler.cycle() if there is one, otherwise nothing
+    """
+    if profiler is None:
+        return nullcontext()
+
+    return profiler.cycle()
+
+
+def fromConfig(pset, label="cycle"):
+    """
+    A cycleProfiler from the [profiling] section (a
+    classes.profilingSettings), or None if it's not there/enabled.
+    """
+    if pset is None:
+        return None
+
+    return cycleProfiler(outdir=pset.directory, label=label,
+                         ncycles=int(pset.cycles), every=int(pset.every),
+                         skip=int(pset.skip))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        profdir = sys.argv[1]
+    else:
+        profdir = "./profiles"
+    if len(sys.argv) > 2:
+        plabel = sys.argv[2]
+    else:
+        plabel = None
+    print(aggregateProfiles(labelProfiles(profdir, plabel)))
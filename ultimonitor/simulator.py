@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""A pretend Ultimaker, for when you don't have a real one handy.
+
+Implements the /api/v1 endpoints used by apitools, printer, leds and
+cameras (plus the ?action=snapshot camera grab) well enough to run the
+monitor and collector against it.  Temperatures come out of a 10 Hz
+ring buffer, jobs start/progress/finish on a schedule, and both latency
+and failures can be dialed in.  Run as many as you like at once:
+
+    python -m ultimonitor.simulator --count 20 --baseport 9000
+
+Then point the printer ip at http://127.0.0.1:9000/api/v1/ and so on.
+Request counts per endpoint are at /sim/stats.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import json
+import math
+import time
+import uuid
+import random
+import base64
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# A 1x1 grey JPEG, which is plenty for imghdr and the email attachment
+snapshotJPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQEASABIAAD/2wBDAP//////////////////////////////////"
+    "////////////////////////////////////////////////////wgALCAABAAEBAREA"
+    "/8QAFBABAAAAAAAAAAAAAAAAAAAAAP/aAAgBAQABPxA=")
+
+flowLabels = ["Time",
+              "temperature0", "target0", "heater0",
+              "flow_sensor0", "flow_steps0",
+              "temperature1", "target1", "heater1",
+              "flow_sensor1", "flow_steps1",
+              "bed_temperature", "bed_target", "bed_heater",
+              "active_hotend_or_state"]
+
+# Same codes as the flowStateMap in Printzini
+flowCodes = {"printing": 0, "idle": 10, "pre_print": 14,
+             "post_print": 15, "wait_cleanup": 16}
+
+materialXML = """<?xml version="1.0" encoding="UTF-8"?>
+<fdmmaterial xmlns="http://www.ultimaker.com/material" version="1.3">
+  <metadata>
+    <name>
+      <brand>%s</brand>
+      <material>%s</material>
+      <color>%s</color>
+    </name>
+    <GUID>%s</GUID>
+  </metadata>
+  <properties>
+    <density>%s</density>
+    <diameter>2.85</diameter>
+  </properties>
+</fdmmaterial>
+"""
+
+
+class simulatedPrinter(object):
+    def __init__(self, name, idleTime=120., jobTime=600., latency=0.,
+                 jitter=0., failRate=0., seed=None):
+        self.name = name
+        self.guid = str(uuid.uuid4())
+        self.boot = time.monotonic() - 3600.
+        self.epoch = time.time() - 3600.
+
+        # Job schedule, in seconds: idle, then preheat, print, cool down,
+        #   waiting for someone to clear the bed, and repeat
+        self.phases = [("idle", idleTime),
+                       ("pre_print", 15.),
+                       ("printing", jobTime),
+                       ("post_print", 15.),
+                       ("wait_cleanup", 30.)]
+        self.cycle = sum([p[1] for p in self.phases])
+
+        self.latency = latency
+        self.jitter = jitter
+        self.failRate = failRate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.materials = [str(uuid.uuid4()), str(uuid.uuid4())]
+        self.led = {"hue": 0., "saturation": 0., "brightness": 100.,
+                    "blink": 0.}
+        self.counts = {}
+
+    def uptime(self):
+        """
+        """
+        return time.monotonic() - self.boot
+
+    def phaseAt(self, t):
+        """
+        Returns the phase name, seconds into the phase, and which job
+        number we're on at uptime t.
+        """
+        njob = int(t // self.cycle)
+        into = t % self.cycle
+        for phase, duration in self.phases:
+            if into < duration:
+                return phase, into, njob
+            into -= duration
+
+        return self.phases[-1][0], 0., njob
+
+    def targets(self, phase):
+        """
+        """
+        if phase in ["pre_print", "printing"]:
+            return 210., 0., 60.
+        else:
+            return 0., 0., 0.
+
+    def sample(self, t):
+        """
+        One temperature_flow row for uptime t.
+        """
+        phase, into, _ = self.phaseAt(t)
+        t0, t1, tb = self.targets(phase)
+
+        def settle(target, scale):
+            if target == 0.:
+                return 24.5 + 0.05*math.sin(t/37.)
+            return target + scale*math.sin(t*2.1) + 0.02*math.sin(t*17.3)
+
+        return [round(t, 2),
+                round(settle(t0, 0.3), 2), t0, 0.3 if t0 > 0 else 0.,
+                0, 65535,
+                round(settle(t1, 0.3), 2), t1, 0.,
+                0, 65535,
+                round(settle(tb, 0.1), 2), tb, 0.2 if tb > 0 else 0.,
+                flowCodes[phase]]
+
+    def temperatureFlow(self, nsamps):
+        """
+        The printer's ring buffer tops out at 800 samples, 10 Hz.
+        """
+        nsamps = max(min(nsamps, 800), 1)
+        last = math.floor(self.uptime()*10.)/10.
+        rows = [flowLabels]
+        for k in range(nsamps - 1, -1, -1):
+            rows.append(self.sample(last - k*0.1))
+
+        return rows
+
+    def job(self):
+        """
+        """
+        t = self.uptime()
+        phase, into, njob = self.phaseAt(t)
+        if phase == "idle":
+            return None
+
+        jobTime = self.phases[2][1]
+        if phase == "pre_print":
+            elapsed = 0.
+        elif phase == "printing":
+            elapsed = into
+        else:
+            elapsed = jobTime
+
+        started = self.epoch + njob*self.cycle + self.phases[0][1]
+        jobid = uuid.uuid5(uuid.NAMESPACE_DNS, "%s-%d" % (self.name, njob))
+
+        return {"name": "%s_job%d" % (self.name, njob),
+                "datetime_started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                                  time.gmtime(started)),
+                "source": "WEB_API",
+                "source_user": "simulator",
+                "uuid": str(jobid),
+                "time_elapsed": int(elapsed),
+                "time_total": int(jobTime),
+                "progress": elapsed/jobTime,
+                "state": phase}
+
+    def route(self, path):
+        """
+        Returns the HTTP code and the reply (which gets JSON encoded)
+        """
+        phase, _, _ = self.phaseAt(self.uptime())
+        t0, t1, tb = self.targets(phase)
+        row = self.sample(self.uptime())
+
+        if path == "system/uptime":
+            return 200, int(self.uptime())
+        elif path == "system/memory":
+            return 200, {"total": 512*1024*1024,
+                         "used": 300*1024*1024 + int(row[1]*1000)}
+        elif path == "system/variant":
+            return 200, "Ultimaker 3 Extended"
+        elif path == "system/name":
+            return 200, self.name
+        elif path == "system/firmware":
+            return 200, "5.2.11.20190503"
+        elif path == "system/guid":
+            return 200, self.guid
+        elif path == "printer/status":
+            if phase == "idle":
+                return 200, "idle"
+            return 200, "printing"
+        elif path == "printer/heads/0":
+            exts = []
+            for i, target in enumerate([t0, t1]):
+                exts.append({"hotend": {"id": ["AA 0.4", "BB 0.4"][i],
+                                        "temperature": {
+                                            "current": row[1 + 5*i],
+                                            "target": target}},
+                             "active_material": {
+                                 "guid": self.materials[i]}})
+            return 200, {"extruders": exts}
+        elif path.startswith("printer/heads/0/extruders/") and\
+                path.endswith("hotend/id"):
+            return 200, ["AA 0.4", "BB 0.4"][int(path.split("/")[4]) % 2]
+        elif path.startswith("materials/"):
+            guid = path.split("/")[1]
+            if guid not in self.materials:
+                return 404, {}
+            if guid == self.materials[0]:
+                xml = materialXML % ("Ultimaker", "PLA", "Red", guid, "1.24")
+            else:
+                xml = materialXML % ("Ultimaker", "PVA", "Natural", guid,
+                                     "1.23")
+            return 200, xml
+        elif path == "printer/bed/type":
+            return 200, "glass"
+        elif path == "printer/bed/temperature":
+            return 200, {"current": row[11], "target": tb}
+        elif path == "print_job":
+            job = self.job()
+            if job is None:
+                return 404, {"message": "Not found"}
+            return 200, job
+        elif path.startswith("printer/diagnostics/temperature_flow/"):
+            return 200, self.temperatureFlow(int(path.split("/")[-1]))
+        elif path == "printer/led":
+            with self.lock:
+                return 200, dict(self.led)
+
+        return 404, {"message": "Not found"}
+
+
+def makeHandler(sim):
+    """
+    """
+    class simHandler(BaseHTTPRequestHandler):
+        # Keep-alive, same as the real printer's web server. Without the
+        #   TCP_NODELAY the headers and body go out in separate segments
+        #   and every reply eats a delayed-ACK stall
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def count(self, key):
+            with sim.lock:
+                sim.counts.update({key: sim.counts.get(key, 0) + 1})
+
+        def reply(self, code, body, ctype="application/json", extra=None):
+            self.send_response(code)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            if extra is not None:
+                for key in extra:
+                    self.send_header(key, extra[key])
+            self.end_headers()
+            self.wfile.write(body)
+
+        def misbehave(self):
+            """
+            Sleep for the configured latency, and maybe fail. Returns True
+            if the request was already answered (badly).
+            """
+            with sim.lock:
+                delay = sim.latency + sim.rng.uniform(0., sim.jitter)
+                fail = sim.rng.random() < sim.failRate
+            if delay > 0:
+                time.sleep(delay)
+            if fail is True:
+                self.count("_failures")
+                self.reply(500, b'{"message": "Simulated failure"}')
+                return True
+            return False
+
+        def apiPath(self):
+            path = self.path.split("?")[0]
+            if path.startswith("/api/v1"):
+                path = path[len("/api/v1"):]
+            # Some queries show up with a doubled slash, just like IRL
+            return "/".join([p for p in path.split("/") if p != ""])
+
+        def do_GET(self):
+            if self.path.startswith("/sim/stats"):
+                with sim.lock:
+                    body = json.dumps(sim.counts).encode()
+                self.reply(200, body)
+                return
+
+            if "action=snapshot" in self.path:
+                self.count("snapshot")
+                if self.misbehave() is False:
+                    self.reply(200, snapshotJPEG, ctype="image/jpeg")
+                return
+
+            path = self.apiPath()
+            self.count(path)
+            if self.misbehave() is True:
+                return
+            code, ans = sim.route(path)
+            self.reply(code, json.dumps(ans).encode())
+
+        def do_PUT(self):
+            path = self.apiPath()
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length)
+
+            # Pretend to be picky about digest auth, so that clients have
+            #   to go thru the challenge like with the real thing.
+            #   The credentials themselves aren't checked.
+            if self.headers.get("Authorization") is None:
+                self.count("_challenges")
+                nonce = uuid.uuid4().hex
+                chal = 'Digest realm="Jedi-API", nonce="%s", ' % (nonce)
+                chal += 'qop="auth", algorithm=MD5'
+                self.reply(401, b'{"message": "Authorization required"}',
+                           extra={"WWW-Authenticate": chal})
+                return
+
+            self.count("PUT " + path)
+            if self.misbehave() is True:
+                return
+            if path == "printer/led":
+                try:
+                    vals = json.loads(data)
+                except ValueError:
+                    self.reply(400, b'{"message": "Bad JSON"}')
+                    return
+                with sim.lock:
+                    for key in vals:
+                        if key in sim.led:
+                            sim.led.update({key: vals[key]})
+                self.reply(204, b"")
+            else:
+                self.reply(404, b'{"message": "Not found"}')
+
+    return simHandler
+
+
+def startSimulators(count=1, host="127.0.0.1", baseport=9000, **kwargs):
+    """
+    Start count simulated printers on consecutive ports, each in its own
+    thread.  Returns a list of (server, simulatedPrinter) pairs; call
+    .shutdown() on the servers to stop them.  A baseport of 0 picks
+    free ports.
+    """
+    sims = []
+    for i in range(count):
+        sim = simulatedPrinter("simulator%03d" % (i), **kwargs)
+        port = 0 if baseport == 0 else baseport + i
+        server = ThreadingHTTPServer((host, port), makeHandler(sim))
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever,
+                                  name="sim-%s" % (sim.name))
+        thread.daemon = True
+        thread.start()
+        sims.append((server, sim))
+
+    return sims
+
+
+def simulatorURL(server):
+    """
+    The 'ip' to give to the rest of ultimonitor for a simulated printer.
+    """
+    return "http://%s:%d/api/v1/" % server.server_address[:2]
+
+
+def main():
+    """
+    """
+    parser = argparse.ArgumentParser(description="Simulated Ultimakers")
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--baseport", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="Base reply latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.,
+                        help="Extra uniform random latency in seconds")
+    parser.add_argument("--failrate", type=float, default=0.,
+                        help="Fraction of requests that get a 500")
+    parser.add_argument("--idletime", type=float, default=120.)
+    parser.add_argument("--jobtime", type=float, default=600.)
+    args = parser.parse_args()
+
+    sims = startSimulators(count=args.count, host=args.host,
+                           baseport=args.baseport,
+                           idleTime=args.idletime, jobTime=args.jobtime,
+                           latency=args.latency, jitter=args.jitter,
+                           failRate=args.failrate)
+    for server, sim in sims:
+        print("%s: %s" % (sim.name, simulatorURL(server)))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server, _ in sims:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Places for the collected packets to go.
+
+Every sink has put(pkts) and close(); the collector just hands each batch
+of packets (or classes.flowBlock of temperatures) to all of them.
+influxSink is the usual database (via the background
+dbwriter.batchWriter), and parquetSink is a local long-term
+archive of compressed Parquet files, one directory per measurement,
+printer and day:
+
+    archive/temperatures/printer=lab1/date=2026-10-18/part-*.parquet
+
+Since it's columnar, reading one field for a month out of the archive
+(see readArchive) only reads that one column.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import time
+import uuid
+import fnmatch
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as pds
+except ImportError:
+    pa = None
+
+from . import classes, lineproto, printer, dbwriter, deadband, metrics
+
+
+# Fields that get stored as float32; temperatures don't need any more
+#   precision than that, and it halves the size of the biggest columns
+float32Fields = ['temperature*', 'target*', 'bed_temperature', 'bed_target']
+
+
+def sendOff(outputs, pkts):
+    """
+    Hand the packets to each of the sinks in turn
+    """
+    if outputs is None:
+        return
+
+    if isinstance(pkts, classes.flowBlock):
+        metrics.packetsProduced.inc(len(pkts), measurement=pkts.meas)
+    elif pkts is not None:
+        for pkt in pkts:
+            metrics.packetsProduced.inc(measurement=pkt['measurement'])
+
+    for sink in outputs:
+        sink.put(pkts)
+
+
+def makeOutputs(cDict, spoolfile="./spool/clausius.spool", archive=True):
+    """
+    Set up the sinks the configuration asks for: always the database,
+    plus the archive if that section is there (and archive is True).
+    Returns them and the lineproto.lineWriter underneath the database one.
+    """
+    # Points are written as gzipped line protocol straight to the
+    #   database's /write endpoint, a few thousand per request
+    dbset = cDict['databaseSetup']
+    chunkSize = getattr(dbset, 'chunksize', None)
+    if chunkSize is None or str(chunkSize) == "None":
+        chunkSize = 5000
+    https = str(getattr(dbset, 'https', False)).lower() in ["true", "yes",
+                                                            "1"]
+    lwriter = lineproto.lineWriter(dbset.host, port=dbset.port,
+                                   dbname=dbset.tablename, user=dbset.user,
+                                   password=dbset.password,
+                                   chunkSize=int(chunkSize), https=https)
+
+    # All the commits happen in the background, batched up, and spooled
+    #   to disk if the database is unavailable
+    writer = dbwriter.batchWriter(None, spoolfile=spoolfile,
+                                  commit=lwriter.commit)
+    writer.start()
+
+    # Optionally thin out the temperatures before they go in
+    dbands = getattr(dbset, 'deadband', None)
+    if dbands is not None and str(dbands) != "None":
+        compressor = deadband.deadbandCompressor(
+            deadbands=deadband.parseDeadbands(dbands))
+    else:
+        compressor = None
+    outputs = [influxSink(writer, compressor=compressor)]
+
+    # Optional local archive too
+    arch = cDict['archive']
+    if arch is not None and archive is True:
+        archiver = parquetSink(arch.directory,
+                               printername=cDict['printerSetup'].name,
+                               flushInterval=float(arch.flushinterval),
+                               compression=arch.compression)
+        outputs.append(archiver)
+
+    return outputs, lwriter
+
+
+def closeOutputs(outputs, lwriter=None):
+    """
+    Flush and close everything makeOutputs made
+    """
+    for sink in outputs:
+        sink.close()
+
+    if lwriter is not None:
+        print("Line protocol writer stats: %s" % (lwriter.stats))
+        lwriter.close()
+
+
+class influxSink(object):
+    def __init__(self, writer, lines=True, compressor=None):
+        """
+        writer is a (started) dbwriter.batchWriter.  If lines is True, its
+        commit takes line protocol (like lineproto.lineWriter.commit) and
+        everything is encoded here; otherwise it gets regular packets.
+
+        compressor is an optional deadband.deadbandCompressor that thins
+        out the temperatures before they go to the database (line
+        protocol only).
+        """
+        self.writer = writer
+        self.lines = lines
+        self.compressor = compressor
+
+    def put(self, pkts):
+        """
+        """
+        if self.compressor is not None and self.lines is True and\
+           isinstance(pkts, classes.flowBlock):
+            pkts = self.compressor.compress(pkts)
+
+        if self.lines is True:
+            if isinstance(pkts, classes.flowBlock):
+                pkts = lineproto.encodeBlock(pkts)
+            else:
+                pkts = lineproto.encodePackets(pkts)
+        elif isinstance(pkts, classes.flowBlock):
+            pkts = printer.flowPackets(pkts.stamps, pkts.labels,
+                                       pkts.columns, meas=pkts.meas,
+                                       tags=pkts.tags)
+
+        self.writer.put(pkts)
+
+    def close(self):
+        """
+        """
+        self.writer.stop()
+        if self.compressor is not None:
+            print("Deadband compression: %s (%.1f:1)" %
+                  (self.compressor.stats, self.compressor.ratio()))
+
+
+class parquetSink(object):
+    def __init__(self, archivedir="./archive", printername="printer",
+                 flushInterval=3600., maxRows=200000, compression="zstd",
+                 floatFields=None):
+        """
+        Packets are held in memory until flushInterval seconds have gone by
+        or maxRows have piled up, then each measurement/printer/day gets
+        its own new part file.  printername is used for packets that don't
+        have a printer tag (i.e. not running in fleet mode).
+        """
+        if pa is None:
+            raise ImportError("pyarrow is needed for the Parquet archive!")
+
+        self.archivedir = archivedir
+        self.printername = printername
+        self.flushInterval = flushInterval
+        self.maxRows = maxRows
+        self.compression = compression
+        if floatFields is None:
+            floatFields = float32Fields
+        self.floatFields = floatFields
+
+        self.lock = threading.Lock()
+        self.buffers = OrderedDict()
+        self.nrows = 0
+        self.bufferStart = None
+
+        self.stats = {"rows": 0, "files": 0, "bytes": 0}
+
+    def printerName(self, tags):
+        """
+        """
+        if tags is not None and 'printer' in tags:
+            pname = tags['printer']
+        else:
+            pname = self.printername
+
+        return pname
+
+    def packetTables(self, pkts):
+        """
+        Packets sorted into their partitions, as (key, table) pairs
+        """
+        now = int(time.time()*1e3)
+        parts = OrderedDict()
+        for pkt in pkts:
+            # systemStats packets don't have a time; the database
+            #   would've used the time it got them, so do the same
+            stamp = pkt.get('time')
+            if stamp is None:
+                stamp = now
+
+            day = time.strftime("%Y-%m-%d", time.gmtime(stamp/1e3))
+            key = (pkt['measurement'], self.printerName(pkt.get('tags')), day)
+
+            row = {"time": stamp}
+            row.update(pkt['fields'])
+            parts.setdefault(key, []).append(row)
+
+        return [(key, self.castTable(pa.Table.from_pylist(rows)))
+                for key, rows in parts.items()]
+
+    def blockTables(self, block):
+        """
+        Same, but straight from the columns of a classes.flowBlock
+        """
+        stamps = np.asarray(block.stamps, dtype=np.int64)
+        pname = self.printerName(block.tags)
+
+        # Almost always just one day, unless it's right around midnight
+        days = stamps // 86400000
+        tables = []
+        for day in np.unique(days):
+            sel = days == day
+            cols = OrderedDict([("time", stamps[sel])])
+            for lab, col in zip(block.labels, block.columns):
+                cols.update({lab: np.asarray(col)[sel]})
+            dstr = time.strftime("%Y-%m-%d", time.gmtime(day*86400))
+            tables.append(((block.meas, pname, dstr),
+                           self.castTable(pa.table(cols))))
+
+        return tables
+
+    def put(self, pkts):
+        """
+        Sort the packets into their partitions; flushes if it's time.
+        """
+        if pkts is None or len(pkts) == 0:
+            return
+
+        if isinstance(pkts, classes.flowBlock):
+            tables = self.blockTables(pkts)
+        else:
+            tables = self.packetTables(pkts)
+
+        with self.lock:
+            for key, table in tables:
+                self.buffers.setdefault(key, []).append(table)
+
+            self.nrows += len(pkts)
+            if self.bufferStart is None:
+                self.bufferStart = time.monotonic()
+
+            stale = time.monotonic() - self.bufferStart >= self.flushInterval
+            if self.nrows >= self.maxRows or stale:
+                self._flush()
+
+    def castTable(self, table):
+        """
+        Make the time column a proper timestamp and the temperature
+        fields float32.
+        """
+        for i, name in enumerate(table.column_names):
+            if name == "time":
+                col = table.column(i).cast(pa.timestamp('ms', tz='UTC'))
+            elif any(fnmatch.fnmatch(name, pat) for pat in self.floatFields):
+                col = table.column(i).cast(pa.float32())
+            else:
+                continue
+            table = table.set_column(i, pa.field(name, col.type), col)
+
+        return table
+
+    def _flush(self):
+        """
+        Write out everything in the buffers; caller holds the lock.
+        """
+        for (meas, pname, day), tables in self.buffers.items():
+            partdir = os.path.join(self.archivedir, meas,
+                                   "printer=%s" % (pname), "date=%s" % (day))
+            if os.path.isdir(partdir) is False:
+                os.makedirs(partdir)
+
+            fname = "part-%s-%s.parquet" % (time.strftime("%H%M%S",
+                                                          time.gmtime()),
+                                            uuid.uuid4().hex[:8])
+            fpath = os.path.join(partdir, fname)
+            try:
+                # Fields can come and go (like memory stats), so fill in
+                #   with nulls rather than refusing to stack them
+                table = pa.concat_tables(tables, promote_options="default")
+                pq.write_table(table, fpath, compression=self.compression)
+            except Exception as err:
+                # Don't take the collector down with us
+                print("ARCHIVE WRITE FAILED FOR %s!" % (fpath))
+                print(str(err))
+                continue
+
+            self.stats["rows"] += table.num_rows
+            self.stats["files"] += 1
+            self.stats["bytes"] += os.path.getsize(fpath)
+
+        self.buffers = OrderedDict()
+        self.nrows = 0
+        self.bufferStart = None
+
+    def flush(self):
+        """
+        """
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        """
+        """
+        self.flush()
+        print("Archive stats: %s" % (self.stats))
+
+
+def readArchive(archivedir="./archive", meas="temperatures", columns=None,
+                printers=None, start=None, end=None):
+    """
+    Read (part of) the Parquet archive back as an Arrow table; use
+    .to_pandas() on it if you want a DataFrame.
+
+    columns are the fields you want (time is always included), and
+    printers/start/end narrow it down to some printers (a name or a list
+    of them) and/or a range of days (given as 'YYYY-MM-DD' strings,
+    inclusive).  Only the matching directories and columns are actually
+    read.
+    """
+    if pa is None:
+        raise ImportError("pyarrow is needed to read the Parquet archive!")
+
+    partitions = pds.partitioning(pa.schema([("printer", pa.string()),
+                                             ("date", pa.string())]),
+                                  flavor="hive")
+    dset = pds.dataset(os.path.join(archivedir, meas), format="parquet",
+                       partitioning=partitions)
+
+    if isinstance(printers, str):
+        printers = [printers]
+
+    filt = None
+    for cond in [pds.field("printer").isin(printers) if printers else None,
+                 pds.field("date") >= start if start else None,
+                 pds.field("date") <= end if end else None]:
+        if cond is not None:
+            filt = cond if filt is None else filt & cond
+
+    if columns is not None:
+        columns = ["time"] + [c for c in columns if c != "time"]
+
+    return dset.to_table(columns=columns, filter=filt)
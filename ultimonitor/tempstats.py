@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Running temperature statistics for a print job.
+
+Fed straight from the temperature_flow samples as they come in, so the
+notifications have real numbers without having to pull the 10 Hz data
+back out of the database.  Memory use is constant no matter how long the
+job runs; each channel just keeps a count, mean, sum of squared
+differences, and extremes.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Printing states from active_hotend_or_state; see flowStateMap
+printingStates = [0, 1]
+
+# Section name for formatStatus, and the temperature/setpoint fields
+channels = OrderedDict([("Extruder1Temps", ("temperature0", "target0")),
+                        ("Extruder2Temps", ("temperature1", "target1")),
+                        ("BedTemps", ("bed_temperature", "bed_target"))])
+
+
+class runningStats(object):
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = None
+        self.max = None
+
+    def update(self, vals):
+        """
+        Fold in a whole block of values at once (Chan et al.'s pairwise
+        combination of Welford accumulators).
+        """
+        vals = np.asarray(vals, dtype=np.float64)
+        nb = vals.size
+        if nb == 0:
+            return
+
+        meanb = vals.mean()
+        m2b = ((vals - meanb)**2).sum()
+
+        ntot = self.n + nb
+        delta = meanb - self.mean
+        self.mean += delta*nb/ntot
+        self.m2 += m2b + delta**2*self.n*nb/ntot
+        self.n = ntot
+
+        vmin = float(vals.min())
+        vmax = float(vals.max())
+        if self.min is None or vmin < self.min:
+            self.min = vmin
+        if self.max is None or vmax > self.max:
+            self.max = vmax
+
+    def stddev(self):
+        """
+        """
+        if self.n < 2:
+            return 0.
+
+        return math.sqrt(self.m2/(self.n - 1))
+
+
+class jobTempStats(object):
+    def __init__(self, uuid=None):
+        self.reset(uuid)
+
+    def reset(self, uuid=None):
+        """
+        Start over for a new job.
+        """
+        self.uuid = uuid
+        self.temps = {}
+        self.errors = {}
+        self.abserrs = {}
+        for chan in channels:
+            self.temps.update({chan: runningStats()})
+            self.errors.update({chan: runningStats()})
+            self.abserrs.update({chan: runningStats()})
+
+    def update(self, pkts):
+        """
+        Add temperature packets (as returned by printer.tempFlow) to the
+        running totals.
+        """
+        if pkts == []:
+            return
+
+        cols = {}
+        for field in pkts[0]['fields']:
+            cols.update({field: np.fromiter((p['fields'][field]
+                                             for p in pkts),
+                                            dtype=np.float64,
+                                            count=len(pkts))})
+
+        self.updateColumns(cols)
+
+    def updateBlock(self, block):
+        """
+        Same, for a classes.flowBlock (printer.tempFlow with asBlock)
+        """
+        if len(block) == 0:
+            return
+
+        self.updateColumns(dict(zip(block.labels, block.columns)))
+
+    def updateColumns(self, cols):
+        """
+        Only samples taken while actually printing count, and only for
+        heaters that have a setpoint at the time.  cols is a dict of
+        field name to array.
+        """
+        if 'active_hotend_or_state' not in cols:
+            return
+        state = np.asarray(cols['active_hotend_or_state'])
+        printing = np.isin(state, printingStates)
+
+        for chan in channels:
+            tfield, sfield = channels[chan]
+            if tfield not in cols:
+                continue
+
+            temp = np.asarray(cols[tfield], dtype=np.float64)
+            setp = np.asarray(cols[sfield], dtype=np.float64)
+
+            # NaN is a sample that didn't come thru, so leave it out
+            good = printing & (setp > 0) & np.isfinite(temp)
+            self.temps[chan].update(temp[good])
+            self.errors[chan].update(temp[good] - setp[good])
+            self.abserrs[chan].update(np.abs(temp[good] - setp[good]))
+
+    def nsamples(self):
+        """
+        """
+        return max([self.temps[chan].n for chan in channels])
+
+    def summary(self):
+        """
+        Everything so far, in a shape that printer.formatStatus knows.
+        Channels that were never heated are left out.
+        """
+        summ = OrderedDict()
+        for chan in channels:
+            temp = self.temps[chan]
+            if temp.n == 0:
+                continue
+
+            summ.update({chan: OrderedDict([
+                ("Mean", temp.mean),
+                ("StdDev", temp.stddev()),
+                ("Min", temp.min),
+                ("Max", temp.max),
+                ("SetpErrMean", self.errors[chan].mean),
+                ("SetpErrMeanAbs", self.abserrs[chan].mean),
+                ("SetpErrMaxAbs", self.abserrs[chan].max),
+                ("Samples", temp.n)])})
+
+        return summ